@@ -7,14 +7,73 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 MODEL_ID = "Janus-Pro-7B"  # Change for other models
 MODEL_PATH = BASE_DIR / "models" / "janus" / MODEL_ID
 MODEL_NAME = "deepseek-ai/"+MODEL_ID
+DRAFT_MODEL_ID = None  # Small model sharing the tokenizer for speculative decoding, e.g. "Janus-Pro-1B"
+DRAFT_MODEL_PATH = BASE_DIR / "models" / "janus" / DRAFT_MODEL_ID if DRAFT_MODEL_ID else None
 WANDERER_IMG_PATH = BASE_DIR / "images" / "wanderer_white_bkg.jpg"
 ENTITY_IMG_PATH = BASE_DIR / "images" / "entity_white_bkg.jpg"
 ENV_IMG_PATH = BASE_DIR / "images" / "env.jpg"
 FINAL_IMG_PATH = BASE_DIR / "images" / "final.png" #Final image to be shown on the GUI
 
+"""Device"""
+DEVICE = "auto"  # "cuda", "cpu" or "auto" (cuda when available)
+DTYPE = "auto"  # "bfloat16", "float16", "float32" or "auto" (bfloat16 on cuda, float32 on cpu)
+CPU_NUM_THREADS = None  # Torch threads on cpu. None: physical cores, capped by the cores available to the process
+ATTN_IMPLEMENTATION = "sdpa"  # "sdpa" (fused PyTorch kernels, also on cpu) or "eager"
+# None, "int8_dynamic" (cpu float32 only) or "int8_weight_only" (bfloat16/float16 on cpu). Applied to the language
+# model, the image generation head and the aligners
+QUANTIZATION = None
+TEXT_ONLY = False  # Only load the language model at startup. The image submodules are loaded by the first image call
+# Accelerator memory budget of the model. Least recently used image submodules are offloaded to RESIDENCY_SLOW_DEVICE
+# when exceeded (e.g. the SigLIP tower and the VQ decoder during text turns). None keeps everything resident
+RESIDENCY_MAX_BYTES = None
+RESIDENCY_SLOW_DEVICE = "cpu"
+
 """LLM Text GEN"""
 TEXT_GEN_MAX_TOKENS = 512
+SPECULATIVE_NUM_DRAFT_TOKENS = 4  # Tokens proposed by the draft model per verification step
+PROMPT_LOOKUP_NUM_TOKENS = 10  # Tokens copied from the prompt per verification step
+PROMPT_LOOKUP_MAX_NGRAM = 3  # Longest suffix n-gram searched in the prompt
+PREFIX_CACHE_MAX_BYTES = 2 * 1024 ** 3  # KV memory budget of the cross-call prompt prefix cache. 0 disables it
+IMG_PREFIX_CACHE_MAX_BYTES = 256 * 1024 ** 2  # Same for the image prompts (CFG rows). 0 disables it
+# The CFG rows are prefilled one by one from their cached prefix when at least this share of the prompt tokens is in
+# the image prefix cache, otherwise in one batch (whose KV is then stored in the cache)
+IMG_PREFIX_MIN_REUSE = 0.5
+RESPONSE_CACHE_DIR = BASE_DIR / "cache" / "responses"  # Greedy replies memoized across launches. None disables it
+RESPONSE_CACHE_MEMORY_ENTRIES = 1024
+RESPONSE_CACHE_MAX_DISK_BYTES = 64 * 1024 ** 2
+IMAGE_ASSET_DIR = BASE_DIR / "cache" / "images"  # VQ token grids of the generated images. None disables it
+IMAGE_ASSET_DECODED_ENTRIES = 16  # Decoded images kept in memory
 CFG_WEIGHT_IMG = 5
+IMG_GEN_COMPILE = None  # torch.compile the image token decode step (with CUDA graphs on cuda). None: on cuda only
+IMG_GEN_CACHE_BUCKET = 128  # Static KV caches are sized to prompt + image tokens, rounded up to this
+IMG_PREVIEW_EVERY_ROWS = 4  # Decode a preview of the partial image every this many token rows (of 24), 0 disables
+IMG_PREVIEW_MAX_OVERHEAD = 0.1  # Previews are skipped while their decoding exceeds this fraction of the token loop
+IMG_PREVIEW_PLACEHOLDER_TOKEN = 0  # VQ code drawn in the rows that are not generated yet
+# The area image is generated in the background once the first line of the talking entity is, or after this many
+# seconds if no line is requested
+ENV_IMG_TEXT_FIRST_TIMEOUT = 30
+
+"""Generation profiles of the different call sites (see src.generation_profiles)"""
+# stop: None (EOS or max_new_tokens only), "closing_quote" or "blank_line"
+TEXT_GEN_PROFILES = {
+    "default": {"max_new_tokens": TEXT_GEN_MAX_TOKENS, "stop": None},
+    # First line of the entity in an area (dialogue_single_exchange_gen_pr), a single quoted sentence. Not for prompts
+    # quoting the conversation: the reply may echo those quotes before its own
+    "dialogue": {"max_new_tokens": 128, "stop": "closing_quote"},
+    # Replies to the wanderer (dialogue_single_update_gen_pr). The prompt quotes the conversation and the reply often
+    # echoes it before the entity's own quote, which _add_entity_update extracts (the last one): stop at a blank line
+    "dialogue_echo": {"max_new_tokens": 128, "stop": "blank_line", "prompt_lookup": True},
+    "paragraph": {"max_new_tokens": 320, "stop": "blank_line"},  # Area descriptions
+    # Replies that mostly copy the prompt (rewrites, summaries), decoded with prompt lookup speculation
+    "rewrite": {"max_new_tokens": 320, "stop": "blank_line", "prompt_lookup": True},
+}
+# cfg_schedule: "constant", "linear" or "cosine" (decaying to no guidance), cfg_interval: (start, end) fractions of the
+# image tokens with guidance. Past the interval the unconditional rows are dropped, which speeds up the last tokens
+IMG_GEN_PROFILES = {
+    "default": {"temperature": 0.00001, "cfg_weight": CFG_WEIGHT_IMG, "parallel_size": 1},
+    "area": {"temperature": 0.00001, "cfg_weight": CFG_WEIGHT_IMG, "parallel_size": 1},
+    "character": {"temperature": 0.00001, "cfg_weight": CFG_WEIGHT_IMG, "parallel_size": 1},
+}
 
 if __name__ == '__main__':
     print(MODEL_PATH.parent)
@@ -5,6 +5,7 @@ import gradio as gr
 import torch
 from transformers import AutoConfig, AutoModelForCausalLM
 from janus.models import MultiModalityCausalLM, VLChatProcessor
+from janus.utils.sampling import sample_tokens
 from PIL import Image
 
 import numpy as np
@@ -99,8 +100,7 @@ def generate(input_ids,
         logit_cond = logits[0::2, :]
         logit_uncond = logits[1::2, :]
         logits = logit_uncond + cfg_weight * (logit_cond - logit_uncond)
-        probs = torch.softmax(logits / temperature, dim=-1)
-        next_token = torch.multinomial(probs, num_samples=1)
+        next_token = sample_tokens(logits, temperature).unsqueeze(dim=-1)
         generated_tokens[:, i] = next_token.squeeze(dim=-1)
         next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
         img_embeds = vl_gpt.prepare_gen_img_embeds(next_token)
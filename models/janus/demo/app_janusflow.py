@@ -4,6 +4,7 @@
 import gradio as gr
 import torch
 from janus.janusflow.models import MultiModalityCausalLM, VLChatProcessor
+from janus.utils.cfg_schedule import CfgSchedule
 from PIL import Image
 from diffusers.models import AutoencoderKL
 import numpy as np
@@ -73,10 +74,15 @@ def multimodal_understanding(image, question, seed, top_p, temperature):
 def generate(
     input_ids,
     cfg_weight: float = 2.0,
-    num_inference_steps: int = 30
+    num_inference_steps: int = 30,
+    cfg_schedule: CfgSchedule = None
 ):
-    # we generate 5 images at a time, *2 for CFG
-    tokens = torch.stack([input_ids] * 10).cuda()
+    # cfg_schedule overrides cfg_weight. Past its interval the unconditional rows are dropped from the batch
+    cfg_schedule = cfg_schedule if cfg_schedule is not None else CfgSchedule(cfg_weight)
+    guided_steps = cfg_schedule.guided_steps(num_inference_steps)
+    # we generate 5 images at a time, *2 for CFG (unless there is no guidance at all)
+    num_rows = 10 if guided_steps > 0 else 5
+    tokens = torch.stack([input_ids] * num_rows).cuda()
     tokens[5:, 1:] = vl_chat_processor.pad_id
     inputs_embeds = vl_gpt.language_model.get_input_embeddings()(tokens)
     print(inputs_embeds.shape)
@@ -92,19 +98,25 @@ def generate(
     dt = torch.zeros_like(z).cuda().to(torch.bfloat16) + dt
     
     # step 2: run ode
-    attention_mask = torch.ones((10, inputs_embeds.shape[1]+577)).to(vl_gpt.device)
+    attention_mask = torch.ones((num_rows, inputs_embeds.shape[1]+577)).to(vl_gpt.device)
     attention_mask[5:, 1:inputs_embeds.shape[1]] = 0
     attention_mask = attention_mask.int()
     for step in range(num_inference_steps):
+        if 0 < step == guided_steps:
+            # no more guidance: keep the 5 conditional rows only
+            inputs_embeds, attention_mask = inputs_embeds[:5], attention_mask[:5]
+            past_key_values = tuple((k[:5], v[:5]) for k, v in past_key_values)
         # prepare inputs for the llm
-        z_input = torch.cat([z, z], dim=0) # for cfg
+        z_input = torch.cat([z, z], dim=0) if step < guided_steps else z # for cfg
         t = step / num_inference_steps * 1000.
         t = torch.tensor([t] * z_input.shape[0]).to(dt)
         z_enc = vl_gpt.vision_gen_enc_model(z_input, t)
         z_emb, t_emb, hs = z_enc[0], z_enc[1], z_enc[2]
         z_emb = z_emb.view(z_emb.shape[0], z_emb.shape[1], -1).permute(0, 2, 1)
         z_emb = vl_gpt.vision_gen_enc_aligner(z_emb)
-        llm_emb = torch.cat([inputs_embeds, t_emb.unsqueeze(1), z_emb], dim=1)
+        # the prompt is only fed at step 0, the next steps reuse its KV cache
+        llm_emb = torch.cat([inputs_embeds, t_emb.unsqueeze(1), z_emb] if step == 0 else [t_emb.unsqueeze(1), z_emb],
+                            dim=1)
 
         # input to the llm
         # we apply attention mask for CFG: 1 for tokens that are not masked, 0 for tokens that are masked.
@@ -113,8 +125,9 @@ def generate(
                                              use_cache=True, 
                                              attention_mask=attention_mask,
                                              past_key_values=None)
+            # keep the KV of the prompt only, t_emb and z_emb change at every step
             past_key_values = []
-            for kv_cache in past_key_values:
+            for kv_cache in outputs.past_key_values:
                 k, v = kv_cache[0], kv_cache[1]
                 past_key_values.append((k[:, :, :inputs_embeds.shape[1], :], v[:, :, :inputs_embeds.shape[1], :]))
             past_key_values = tuple(past_key_values)
@@ -129,8 +142,10 @@ def generate(
         hidden_states = vl_gpt.vision_gen_dec_aligner(vl_gpt.vision_gen_dec_aligner_norm(hidden_states[:, -576:, :]))
         hidden_states = hidden_states.reshape(z_emb.shape[0], 24, 24, 768).permute(0, 3, 1, 2)
         v = vl_gpt.vision_gen_dec_model(hidden_states, hs, t_emb)
-        v_cond, v_uncond = torch.chunk(v, 2)
-        v = cfg_weight * v_cond - (cfg_weight-1.) * v_uncond
+        if step < guided_steps:
+            v_cond, v_uncond = torch.chunk(v, 2)
+            weight = cfg_schedule.weight(step, num_inference_steps)
+            v = weight * v_cond - (weight-1.) * v_uncond
         z = z + dt * v
         
     # step 3: decode with vision_gen_dec and sdxl vae
@@ -14,6 +14,7 @@ import torch
 from transformers import AutoModelForCausalLM
 
 from models.janus.models import MultiModalityCausalLM, VLChatProcessor
+from models.janus.utils.image_generation import get_image_token_generator
 import numpy as np
 import os
 import PIL.Image
@@ -67,26 +68,9 @@ def generate(
 
     inputs_embeds = mmgpt.language_model.get_input_embeddings()(tokens)
 
-    generated_tokens = torch.zeros((parallel_size, image_token_num_per_image), dtype=torch.int).cuda()
-
-    for i in range(image_token_num_per_image):
-        outputs = mmgpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True, past_key_values=outputs.past_key_values if i != 0 else None)
-        hidden_states = outputs.last_hidden_state
-        
-        logits = mmgpt.gen_head(hidden_states[:, -1, :])
-        logit_cond = logits[0::2, :]
-        logit_uncond = logits[1::2, :]
-        
-        logits = logit_uncond + cfg_weight * (logit_cond-logit_uncond)
-        probs = torch.softmax(logits / temperature, dim=-1)
-
-        next_token = torch.multinomial(probs, num_samples=1)
-        generated_tokens[:, i] = next_token.squeeze(dim=-1)
-
-        next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
-        img_embeds = mmgpt.prepare_gen_img_embeds(next_token)
-        inputs_embeds = img_embeds.unsqueeze(dim=1)
-
+    # Static KV cache and compiled decode step, reused by the following calls with the same shape
+    generator = get_image_token_generator(mmgpt, parallel_size, len(input_ids) + image_token_num_per_image)
+    generated_tokens = generator.generate(inputs_embeds, image_token_num_per_image, cfg_weight, temperature)
 
     dec = mmgpt.gen_vision_model.decode_code(generated_tokens.to(dtype=torch.int), shape=[parallel_size, 8, img_size//patch_size, img_size//patch_size])
     dec = dec.to(torch.float32).cpu().numpy().transpose(0, 2, 3, 1)
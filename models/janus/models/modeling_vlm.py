@@ -180,10 +180,36 @@ class MultiModalityPreTrainedModel(PreTrainedModel):
     _skip_keys_device_placement = "past_key_values"
 
 
+IMAGE_SUBMODULES = ("vision_model", "aligner", "gen_vision_model", "gen_aligner", "gen_head", "gen_embed")
+
+
 class MultiModalityCausalLM(MultiModalityPreTrainedModel):
-    def __init__(self, config: MultiModalityConfig):
+    def __init__(self, config: MultiModalityConfig, text_only: bool = False):
+        """
+
+        Args:
+            config (MultiModalityConfig): The model configuration.
+            text_only (bool): Only build the language model. The image submodules (IMAGE_SUBMODULES) are None until
+                build_image_modules is called.
+
+        """
         super().__init__(config)
 
+        if text_only:
+            for name in IMAGE_SUBMODULES:
+                setattr(self, name, None)
+        else:
+            self.build_image_modules()
+
+        language_config = config.language_config
+        self.language_model = LlamaForCausalLM(language_config)
+
+    @property
+    def text_only(self):
+        return self.gen_vision_model is None
+
+    def build_image_modules(self):
+        config = self.config
         vision_config = config.vision_config
         vision_cls = model_name_to_cls(vision_config.cls)
         self.vision_model = vision_cls(**vision_config.params)
@@ -208,9 +234,6 @@ class MultiModalityCausalLM(MultiModalityPreTrainedModel):
             gen_vision_config.params.image_token_size, gen_vision_config.params.n_embed
         )
 
-        language_config = config.language_config
-        self.language_model = LlamaForCausalLM(language_config)
-
     def prepare_inputs_embeds(
         self,
         input_ids: torch.LongTensor,
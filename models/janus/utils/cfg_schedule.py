@@ -0,0 +1,53 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import math
+
+CFG_SCHEDULES = ("constant", "linear", "cosine")
+
+
+class CfgSchedule:
+    """ Classifier-free guidance weight over the steps of a generation loop (image tokens for Janus, ODE steps for
+    JanusFlow).
+
+    Guidance is applied in interval, given as fractions (start, end) of the steps. Inside it the weight is constant,
+    or decays from weight to 1 (plain conditional prediction) with a linear or a cosine shape. Outside it the weight
+    is 1. Past the end of the interval the unconditional branch is not needed anymore, so the loops drop its rows from
+    the batch and the KV cache, which halves the cost of the remaining steps.
+    """
+
+    def __init__(self, weight, schedule="constant", interval=(0.0, 1.0)):
+        if schedule not in CFG_SCHEDULES:
+            raise ValueError(f"Unknown CFG schedule {schedule}, expected one of {CFG_SCHEDULES}")
+        start, end = interval
+        if not 0.0 <= start <= end <= 1.0:
+            raise ValueError(f"The CFG interval must satisfy 0 <= start <= end <= 1, got {interval}")
+        self.base_weight = weight
+        self.schedule = schedule
+        self.interval = (start, end)
+
+    @classmethod
+    def of(cls, cfg_weight):
+        """ cfg_weight as a CfgSchedule, a plain number being a constant weight over all the steps. """
+        return cfg_weight if isinstance(cfg_weight, cls) else cls(float(cfg_weight))
+
+    def guided_steps(self, num_steps):
+        """ Number of leading steps that need the unconditional rows. """
+        return min(num_steps, math.ceil(self.interval[1] * num_steps))
+
+    def weight(self, step, num_steps):
+        """ Guidance weight of step (0-based) out of num_steps. """
+        start, end = self.interval[0] * num_steps, self.guided_steps(num_steps)
+        if not start <= step < end:
+            return 1.0
+        if self.schedule == "constant":
+            return self.base_weight
+        progress = (step - start) / (end - start)  # Reaches 1 at the first step without guidance
+        if self.schedule == "linear":
+            decay = 1.0 - progress
+        else:
+            decay = (1.0 + math.cos(math.pi * progress)) / 2
+        return 1.0 + (self.base_weight - 1.0) * decay
+
+    def __repr__(self):
+        return "CfgSchedule({}, {}, interval={})".format(self.base_weight, self.schedule, self.interval)
@@ -0,0 +1,37 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import os
+import torch
+
+DTYPES = {"bfloat16": torch.bfloat16, "float16": torch.float16, "float32": torch.float32}
+
+
+def resolve_device(device="auto"):
+    """ "auto" selects cuda when available, cpu otherwise. """
+    if device == "auto":
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    return torch.device(device)
+
+
+def resolve_dtype(dtype="auto", device="cpu"):
+    """ "auto" selects bfloat16 on cuda and float32 on cpu, where most kernels lack fast bfloat16 paths. """
+    if isinstance(dtype, torch.dtype):
+        return dtype
+    if dtype == "auto":
+        return torch.bfloat16 if torch.device(device).type == "cuda" else torch.float32
+    return DTYPES[dtype]
+
+
+def configure_cpu_threads(num_threads=None):
+    """ Sets the intra-op threads of torch. By default torch uses the physical cores of the machine, which
+    oversubscribes containers restricted to fewer cores, so the default is capped by the CPU affinity.
+
+    Returns:
+        num_threads (int): The number of threads in use.
+    """
+    if num_threads is None:
+        available = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        num_threads = min(torch.get_num_threads(), available or 1)
+    torch.set_num_threads(num_threads)
+    return num_threads
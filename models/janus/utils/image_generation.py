@@ -0,0 +1,321 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import threading
+import time
+import warnings
+import weakref
+
+import torch
+from transformers import DynamicCache, StaticCache
+
+from ..models import MultiModalityCausalLM
+from .cfg_schedule import CfgSchedule
+from .sampling import GREEDY_TEMPERATURE, sample_tokens
+
+# Model -> {(parallel_size, max_cache_len, compile, cuda_graphs, thread id): ImageTokenGenerator}
+_GENERATORS = weakref.WeakKeyDictionary()
+
+
+class ImageTokenGenerator:
+    """
+
+    The image token loop of Janus (classifier-free guidance, one token per step for each of the parallel_size
+    samples) on a preallocated static KV cache. The cache holds max_cache_len positions for the 2 * parallel_size
+    rows (conditional and unconditional of each sample, interleaved) and is written in place, so every decode step
+    has the same shapes. This makes the step a good fit for torch.compile, and for CUDA graphs on cuda, which remove
+    the per step Python and kernel launch overhead.
+
+    The samples may come from different prompts: shorter prompts are left padded, and the padding is excluded through
+    a static attention mask over the whole cache and per row position offsets. Guidance weight and temperature can
+    also differ per sample, and the guidance can follow a CfgSchedule: once the guidance interval of every sample is
+    over, the unconditional rows are dropped and the remaining tokens are decoded on a cache of the conditional rows
+    only.
+
+    The prompt rows can also be prefilled one by one from a prefix cache of earlier prompts: the unconditional rows
+    are pad tokens framed by BOS and the image start tag, so they differ only by their length, and the conditional
+    rows share the chat template and the wrappers of the game prompts. Only the part of each row that is not cached
+    is then run through the model. Batch 1 forwards are slower per token than the batched prefill, so this only
+    happens when enough of the prompt is cached; otherwise the rows are prefilled in one batch and stored.
+
+    Sampling (sample_tokens: greedy, top-k, top-p or full softmax) stays outside the compiled step, which returns the
+    guided logits, so the tokens only depend on the seed and not on whether the step is compiled.
+
+    An instance must only be used by one thread: its KV cache is written in place, and the CUDA graphs of
+    reduce-overhead are recorded per thread. get_image_token_generator returns a separate instance to each thread.
+
+    """
+
+    def __init__(self, mmgpt: MultiModalityCausalLM, parallel_size: int, max_cache_len: int, compile: bool = None,
+                 cuda_graphs: bool = True):
+        """
+
+        Args:
+            mmgpt (MultiModalityCausalLM): The model.
+            parallel_size (int): Number of images generated together.
+            max_cache_len (int): Prompt length + image tokens the cache can hold.
+            compile (bool, optional): Compile the decode step with torch.compile. None compiles on cuda only, where
+                the CUDA graphs pay off; on cpu the first image would wait for an inductor build.
+            cuda_graphs (bool): On cuda, compile with mode="reduce-overhead" (CUDA graphs). The module weights must
+                then stay in place between calls.
+
+        """
+        language_model = mmgpt.language_model
+        self.mmgpt = mmgpt
+        self.parallel_size = parallel_size
+        self.max_cache_len = max_cache_len
+        self.device = language_model.device
+        self.dtype = language_model.dtype
+        compile = self.device.type == "cuda" if compile is None else compile
+        self.cache = StaticCache(config=language_model.config, max_batch_size=parallel_size * 2,
+                                 max_cache_len=max_cache_len, device=self.device, dtype=self.dtype)
+        self.cond_cache = None  # Conditional rows only, allocated when a schedule first drops the guidance
+        self.compiled = compile
+        self._steps = {"cfg": self.step, "cond": self.cond_step}
+        if compile:
+            mode = "reduce-overhead" if cuda_graphs and self.device.type == "cuda" else None
+            self._steps = {kind: torch.compile(fn, mode=mode, dynamic=False) for kind, fn in self._steps.items()}
+        self.last_prefill = {"tokens": 0, "reused": 0, "seconds": 0.}
+        self.last_guided_steps = 0
+
+    def _forward(self, inputs_embeds, cache_position, attention_mask, position_ids, cache=None):
+        outputs = self.mmgpt.language_model.model(inputs_embeds=inputs_embeds, attention_mask=attention_mask,
+                                                  position_ids=position_ids,
+                                                  past_key_values=self.cache if cache is None else cache,
+                                                  cache_position=cache_position, use_cache=True)
+        return outputs.last_hidden_state[:, -1, :]
+
+    def _logits(self, hidden_states, cfg_weight):
+        logits = self.mmgpt.gen_head(hidden_states)
+        logit_cond = logits[0::2, :]
+        logit_uncond = logits[1::2, :]
+
+        return logit_uncond + cfg_weight * (logit_cond - logit_uncond)
+
+    def step(self, image_ids, cache_position, attention_mask, padding, cfg_weight):
+        """
+
+        Feeds the last sampled token of each sample to its conditional and unconditional rows.
+
+        Args:
+            image_ids (torch.LongTensor): [parallel_size]
+            cache_position (torch.LongTensor): [1] position of the fed token in the cache.
+            attention_mask (torch.LongTensor): [parallel_size * 2, max_cache_len] 0 on the left padding.
+            padding (torch.LongTensor): [parallel_size * 2, 1] left padding of each row.
+            cfg_weight (torch.Tensor): [parallel_size, 1] guidance weights.
+
+        Returns:
+            logits (torch.Tensor): [parallel_size, image_token_size] guided next token logits.
+
+        """
+        inputs_embeds = self.mmgpt.prepare_gen_img_embeds(image_ids.repeat_interleave(2)).unsqueeze(dim=1)
+        hidden_states = self._forward(inputs_embeds, cache_position, attention_mask, cache_position - padding)
+        return self._logits(hidden_states, cfg_weight)
+
+    def cond_step(self, image_ids, cache_position, attention_mask, padding):
+        """
+
+        Feeds the last sampled token of each sample to its conditional row only, after the guidance interval.
+
+        Args:
+            image_ids (torch.LongTensor): [parallel_size]
+            cache_position (torch.LongTensor): [1] position of the fed token in the cache.
+            attention_mask (torch.LongTensor): [parallel_size, max_cache_len] 0 on the left padding.
+            padding (torch.LongTensor): [parallel_size, 1] left padding of each row.
+
+        Returns:
+            logits (torch.Tensor): [parallel_size, image_token_size] next token logits.
+
+        """
+        inputs_embeds = self.mmgpt.prepare_gen_img_embeds(image_ids).unsqueeze(dim=1)
+        hidden_states = self._forward(inputs_embeds, cache_position, attention_mask, cache_position - padding,
+                                      self.cond_cache)
+        return self.mmgpt.gen_head(hidden_states)
+
+    def _drop_uncond(self):
+        """ Copies the KV of the conditional rows to the conditional only cache. """
+        if self.cond_cache is None:
+            language_model = self.mmgpt.language_model
+            self.cond_cache = StaticCache(config=language_model.config, max_batch_size=self.parallel_size,
+                                          max_cache_len=self.max_cache_len, device=self.device, dtype=self.dtype)
+        for layer in range(len(self.cache.key_cache)):
+            self.cond_cache.key_cache[layer].copy_(self.cache.key_cache[layer][0::2])
+            self.cond_cache.value_cache[layer].copy_(self.cache.value_cache[layer][0::2])
+
+    def _prefill_rows(self, inputs_embeds, rows_ids, prefix_cache):
+        """ Prefills each row on its own from the longest prefix of its tokens found in prefix_cache, stores the new
+        KV in prefix_cache and copies the KV of the row to the static cache, after its left padding.
+
+        Returns:
+            hidden_states (torch.Tensor): [parallel_size * 2, D] last hidden state of each row.
+            reused (int): Prompt tokens taken from prefix_cache instead of being prefilled.
+        """
+        language_model = self.mmgpt.language_model
+        prompt_len = inputs_embeds.shape[1]
+        hidden_states, reused = [], 0
+        for row, row_ids in enumerate(rows_ids):
+            padding = prompt_len - len(row_ids)
+            matched, past_key_values = prefix_cache.lookup(row_ids)
+            past_key_values = past_key_values if past_key_values is not None else DynamicCache()
+            outputs = language_model.model(inputs_embeds=inputs_embeds[row:row + 1, padding + matched:],
+                                           past_key_values=past_key_values, use_cache=True)
+            prefix_cache.insert(row_ids, past_key_values)
+            for layer, (k, v) in enumerate(past_key_values.to_legacy_cache()):
+                self.cache.key_cache[layer][row, :, padding:prompt_len] = k[0]
+                self.cache.value_cache[layer][row, :, padding:prompt_len] = v[0]
+            hidden_states.append(outputs.last_hidden_state[0, -1])
+            reused += matched
+        return torch.stack(hidden_states), reused
+
+    def _store_rows(self, rows_ids, prompt_len, prefix_cache):
+        """ Stores the KV of each row, prefilled in one batch, in prefix_cache for the next prompts. """
+        for row, row_ids in enumerate(rows_ids):
+            padding = prompt_len - len(row_ids)
+            prefix_cache.insert(row_ids, [(k[row:row + 1, :, padding:prompt_len], v[row:row + 1, :, padding:prompt_len])
+                                          for k, v in zip(self.cache.key_cache, self.cache.value_cache)])
+
+    def _temperature(self, temperature):
+        """ A float, or one per sample as a [parallel_size, 1] tensor unless they are all greedy. """
+        if not isinstance(temperature, (list, tuple)):
+            return temperature
+        if all(t <= GREEDY_TEMPERATURE for t in temperature):
+            return 0.0
+        return torch.tensor(temperature, dtype=torch.float32, device=self.device).reshape(-1, 1)
+
+    @torch.inference_mode()
+    def generate(self, inputs_embeds, image_token_num_per_image=576, cfg_weight=5.0, temperature=1.0,
+                 generator=None, attention_mask=None, callback=None, token_ids=None, prefix_cache=None, top_k=None,
+                 top_p=None, prefix_min_reuse=0.5):
+        """
+
+        Args:
+            inputs_embeds (torch.Tensor): [parallel_size * 2, prompt_len, D] prompt embeddings, conditional and
+                unconditional rows interleaved.
+            image_token_num_per_image (int): Tokens of the image grid.
+            cfg_weight (Union[float, CfgSchedule, Sequence]): Classifier-free guidance weight or schedule, or one
+                per sample.
+            temperature (Union[float, Sequence[float]]): Sampling temperature, or one per sample. Greedy at
+                GREEDY_TEMPERATURE or below.
+            generator (Union[torch.Generator, List[torch.Generator]], optional): Random generator of the sampling, or
+                one per sample.
+            attention_mask (torch.LongTensor, optional): [parallel_size * 2, prompt_len] 0 on the left padding of
+                shorter prompts. None when no row is padded.
+            callback (Callable[[torch.IntTensor, int], None], optional): Called after each sampled token with
+                generated_tokens and the number of tokens sampled so far, e.g. to decode previews.
+            token_ids (torch.Tensor, optional): [parallel_size * 2, prompt_len] token ids of inputs_embeds, needed
+                with prefix_cache.
+            prefix_cache (RadixPrefixCache, optional): Cache of prompt KV (match_length(token_ids),
+                lookup(token_ids) -> (matched, cache) and insert(token_ids, cache)).
+            top_k (int, optional): Sample among the top_k most likely image tokens.
+            top_p (float, optional): Sample within the top_p probability mass.
+            prefix_min_reuse (float): Share of the prompt tokens found in prefix_cache from which the rows are
+                prefilled one by one from their cached prefix. Below it they are prefilled in one batch, and stored.
+
+        Returns:
+            generated_tokens (torch.IntTensor): [parallel_size, image_token_num_per_image]
+
+        """
+        prompt_len = inputs_embeds.shape[1]
+        if prompt_len + image_token_num_per_image > self.max_cache_len:
+            raise ValueError(f"{prompt_len} prompt + {image_token_num_per_image} image tokens do not fit in a cache "
+                             f"of {self.max_cache_len}")
+        self.cache.reset()
+        if not isinstance(cfg_weight, (list, tuple)):
+            cfg_weight = [cfg_weight] * self.parallel_size
+        schedules = [CfgSchedule.of(w) for w in cfg_weight]
+        # [image_token_num_per_image, parallel_size, 1] weight of each sampled token
+        cfg_weights = torch.tensor([[[schedule.weight(i, image_token_num_per_image)] for schedule in schedules]
+                                    for i in range(image_token_num_per_image)], dtype=torch.float32,
+                                   device=self.device)
+        guided_steps = max(schedule.guided_steps(image_token_num_per_image) for schedule in schedules)
+        self.last_guided_steps = guided_steps
+        temperature = self._temperature(temperature)
+
+        # Static shape mask over the whole cache, the image positions are always attended
+        full_mask = torch.ones((self.parallel_size * 2, self.max_cache_len), dtype=torch.long, device=self.device)
+        if attention_mask is not None:
+            full_mask[:, :prompt_len] = attention_mask
+        prompt_mask = full_mask[:, :prompt_len]
+        padding = prompt_len - prompt_mask.sum(dim=-1, keepdim=True)
+        position_ids = (prompt_mask.cumsum(-1) - 1).masked_fill_(prompt_mask == 0, 1)
+
+        start = time.perf_counter()
+        num_tokens = int(prompt_mask.sum())
+        rows_ids = None
+        if prefix_cache is not None:
+            rows_ids = [token_ids[row, pad:].tolist() for row, pad in enumerate(padding[:, 0].tolist())]
+        batched = rows_ids is None or sum(map(prefix_cache.match_length, rows_ids)) < prefix_min_reuse * num_tokens
+        if batched:
+            hidden_states = self._forward(inputs_embeds, torch.arange(prompt_len, device=self.device), full_mask,
+                                          position_ids)
+            reused = 0
+            if rows_ids is not None:
+                self._store_rows(rows_ids, prompt_len, prefix_cache)
+        else:
+            hidden_states, reused = self._prefill_rows(inputs_embeds, rows_ids, prefix_cache)
+        logits = self._logits(hidden_states, cfg_weights[0])
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        self.last_prefill = {"tokens": num_tokens, "reused": reused, "batched": batched,
+                             "seconds": time.perf_counter() - start}
+        generated_tokens = torch.zeros((self.parallel_size, image_token_num_per_image), dtype=torch.int,
+                                       device=self.device)
+        guided = True  # The cache still holds the unconditional rows
+        for i in range(image_token_num_per_image):
+            next_token = sample_tokens(logits, temperature, top_k, top_p, generator)
+            generated_tokens[:, i] = next_token
+            if callback is not None:
+                callback(generated_tokens, i + 1)
+            if i + 1 == image_token_num_per_image:
+                break
+            cache_position = torch.tensor([prompt_len + i], device=self.device)
+            if i + 1 < guided_steps:
+                logits = self._run_step("cfg", next_token, cache_position, full_mask, padding, cfg_weights[i + 1])
+                continue
+            if guided:
+                self._drop_uncond()
+                full_mask, padding = full_mask[0::2].contiguous(), padding[0::2].contiguous()
+                guided = False
+            logits = self._run_step("cond", next_token, cache_position, full_mask, padding)
+        return generated_tokens
+
+    def _run_step(self, kind, *args):
+        try:
+            return self._steps[kind](*args)
+        except Exception as e:
+            # Only compilation failures (e.g. no C++ compiler for the cpu backend of inductor) fall back to eager,
+            # runtime errors of the step (out of memory, shapes) are raised as they are
+            if not self.compiled or not isinstance(e, _compile_errors()):
+                raise
+            # Running the step again rewrites the same cache position, so it is safe to retry it eagerly
+            warnings.warn(f"Compiling the image decode step failed, running it eagerly: {e}")
+            self._steps = {"cfg": self.step, "cond": self.cond_step}
+            self.compiled = False
+            return self._steps[kind](*args)
+
+
+def _compile_errors():
+    """ Exception types of a failed torch.compile build. """
+    import torch._dynamo.exc
+    import torch._inductor.exc
+    # InductorError is raised as is by recent versions, without BackendCompilerFailed around it
+    return (torch._dynamo.exc.BackendCompilerFailed,) + tuple(
+        getattr(torch._inductor.exc, name) for name in ("CppCompileError", "InductorError")
+        if hasattr(torch._inductor.exc, name))
+
+
+def get_image_token_generator(mmgpt: MultiModalityCausalLM, parallel_size: int, length: int, bucket: int = 128,
+                              compile: bool = None, cuda_graphs: bool = True) -> ImageTokenGenerator:
+    """
+
+    Returns the generator of mmgpt whose static KV cache fits length positions (prompt + image tokens), built on
+    first use and reused by the following calls of the same thread. Cache lengths are rounded up to a multiple of
+    bucket, so that prompts of similar lengths share the cache and the compiled step.
+
+    """
+    max_cache_len = -(-length // bucket) * bucket
+    generators = _GENERATORS.setdefault(mmgpt, {})
+    key = (parallel_size, max_cache_len, compile, cuda_graphs, threading.get_ident())
+    if key not in generators:
+        generators[key] = ImageTokenGenerator(mmgpt, parallel_size, max_cache_len, compile, cuda_graphs)
+    return generators[key]
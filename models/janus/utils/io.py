@@ -11,25 +11,131 @@
 #
 #
 import json
+from pathlib import Path
 from typing import Dict, List
 
 import PIL.Image
 import torch
 import base64
 import io
-from transformers import AutoModelForCausalLM
+from accelerate import init_empty_weights
+from safetensors import safe_open
+from transformers import AutoConfig, AutoModelForCausalLM
 
 from models.janus.models import MultiModalityCausalLM, VLChatProcessor
+from models.janus.models.modeling_vlm import IMAGE_SUBMODULES
+from models.janus.utils.device import resolve_device, resolve_dtype, configure_cpu_threads
 
 
-def load_pretrained_model(model_path: str):
-    vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(model_path)
-    tokenizer = vl_chat_processor.tokenizer
+def load_vl_gpt(model_path, device="auto", dtype="auto", attn_implementation="sdpa", text_only=False):
+    """
+
+    Loads the weights straight into their final dtype and device: the model is initialized on the meta device and the
+    checkpoint tensors are memory-mapped (safetensors, or torch.load(mmap=True) for .bin shards), so the peak memory
+    stays close to the size of the loaded model instead of a full float32 copy.
+
+    Args:
+        model_path (str): Local directory or hub id of the model.
+        device (str): "cuda", "cpu" or "auto" (cuda when available).
+        dtype (str): "bfloat16", "float16", "float32" or "auto" (bfloat16 on cuda, float32 on cpu).
+        attn_implementation (str): Attention of the language model. "sdpa" uses the fused kernels of PyTorch, on CPU
+            as well.
+        text_only (bool): Only build and load the language model, see load_image_modules. Needs a local model_path.
 
+    Returns:
+        vl_gpt (MultiModalityCausalLM): The model in eval mode.
+
+    """
+    device = resolve_device(device)
+    config = AutoConfig.from_pretrained(model_path)
+    language_config = config.language_config
+    language_config._attn_implementation = attn_implementation
+    if text_only:
+        with init_empty_weights():
+            vl_gpt = MultiModalityCausalLM(config, text_only=True)
+        load_submodules(vl_gpt, model_path, ("language_model",), device, resolve_dtype(dtype, device))
+        return vl_gpt.eval()
     vl_gpt: MultiModalityCausalLM = AutoModelForCausalLM.from_pretrained(
-        model_path, trust_remote_code=True
+        model_path, language_config=language_config, trust_remote_code=True,
+        torch_dtype=resolve_dtype(dtype, device), low_cpu_mem_usage=True, device_map={"": device}
     )
-    vl_gpt = vl_gpt.to(torch.bfloat16).cuda().eval()
+    return vl_gpt.eval()
+
+
+def load_image_modules(vl_gpt, model_path):
+    """ Builds and loads the image submodules of a text_only model, on the device and in the dtype of its language
+    model. """
+    if not vl_gpt.text_only:
+        return vl_gpt
+    with init_empty_weights():
+        vl_gpt.build_image_modules()
+    load_submodules(vl_gpt, model_path, IMAGE_SUBMODULES, vl_gpt.language_model.device, vl_gpt.language_model.dtype)
+    return vl_gpt.eval()
+
+
+def load_submodules(vl_gpt, model_path, names, device, dtype):
+    """ Loads the checkpoint weights of the given submodules of vl_gpt, built on the meta device.
+
+    The weights are cast to dtype. Non-persistent buffers, computed when the modules are built (e.g. the rotary
+    inv_freq), keep their dtype as they do in from_pretrained, so that both load modes give the same logits.
+    """
+    tensors = checkpoint_tensors(model_path, tuple(name + "." for name in names))
+    for name in names:
+        prefix = name + "."
+        module = getattr(vl_gpt, name)
+        module.load_state_dict({key[len(prefix):]: tensor for key, tensor in tensors.items()
+                                if key.startswith(prefix)}, assign=True)
+        persistent = set(module.state_dict())
+        kept = {key: buffer for key, buffer in module.named_buffers() if key not in persistent}
+        module.to(device=device, dtype=dtype)
+        for key, buffer in kept.items():
+            owner, _, buffer_name = key.rpartition(".")
+            module.get_submodule(owner).register_buffer(buffer_name, buffer.to(device), persistent=False)
+
+
+def checkpoint_tensors(model_path, prefixes):
+    """ Reads the tensors of the checkpoint in model_path whose name starts with one of prefixes. Only the shards
+    holding them are opened, and they are memory-mapped. """
+    model_path = Path(model_path)
+    for index_name, single_name in (("model.safetensors.index.json", "model.safetensors"),
+                                    ("pytorch_model.bin.index.json", "pytorch_model.bin")):
+        if (model_path / index_name).exists():
+            weight_map = load_json(model_path / index_name)["weight_map"]
+            shards = sorted({shard for name, shard in weight_map.items() if name.startswith(prefixes)})
+            break
+        if (model_path / single_name).exists():
+            shards = [single_name]
+            break
+    else:
+        raise FileNotFoundError(f"No checkpoint found in {model_path}")
+
+    tensors = {}
+    for shard in shards:
+        if shard.endswith(".safetensors"):
+            with safe_open(model_path / shard, framework="pt") as f:
+                tensors.update({name: f.get_tensor(name) for name in f.keys() if name.startswith(prefixes)})
+        else:
+            state_dict = torch.load(model_path / shard, map_location="cpu", mmap=True, weights_only=True)
+            tensors.update({name: tensor for name, tensor in state_dict.items() if name.startswith(prefixes)})
+    return tensors
+
+
+def load_pretrained_model(model_path: str, device="auto", dtype="auto", attn_implementation="sdpa"):
+    """
+
+    Args:
+        model_path (str): Local directory or hub id of the model.
+        device (str): "cuda", "cpu" or "auto" (cuda when available).
+        dtype (str): "bfloat16", "float16", "float32" or "auto" (bfloat16 on cuda, float32 on cpu).
+        attn_implementation (str): Attention of the language model, see load_vl_gpt.
+
+    """
+    vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(model_path)
+    tokenizer = vl_chat_processor.tokenizer
+
+    if resolve_device(device).type == "cpu":
+        configure_cpu_threads()
+    vl_gpt = load_vl_gpt(model_path, device, dtype, attn_implementation)
 
     return tokenizer, vl_chat_processor, vl_gpt
 
@@ -0,0 +1,106 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+from torch import nn
+
+QUANTIZATION_MODES = ("int8_dynamic", "int8_weight_only")
+# Submodules of MultiModalityCausalLM whose nn.Linear layers are quantized. The vision towers are left untouched.
+QUANTIZED_SUBMODULES = ("language_model", "gen_head", "aligner", "gen_aligner")
+
+
+class Int8WeightOnlyLinear(nn.Module):
+    """ nn.Linear with int8 weights and a float scale per output channel. The activations stay in floating point.
+    Halves the weight memory of bfloat16 (quarters float32), on any device.
+
+    On cpu with bfloat16 or float16 inputs the matmul runs on the int8 weights directly (torch._weight_int8pack_mm).
+    Otherwise the weights are cast to the input dtype for each call and the scales are applied to the output, which
+    allocates a full size copy of the weight of the layer while it runs. That path is several times slower than
+    nn.Linear on cpu, so float32 cpu models use int8_dynamic instead. """
+
+    def __init__(self, in_features, out_features, bias=True, dtype=torch.float32, device=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("weight", torch.zeros((out_features, in_features), dtype=torch.int8, device=device))
+        self.register_buffer("scale", torch.ones(out_features, dtype=dtype, device=device))
+        self.register_buffer("bias", torch.zeros(out_features, dtype=dtype, device=device) if bias else None)
+
+    @classmethod
+    def from_float(cls, linear):
+        weight = linear.weight.detach().float()
+        scale = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+        module = cls(linear.in_features, linear.out_features, linear.bias is not None, linear.weight.dtype,
+                     linear.weight.device)
+        module.weight.copy_(torch.round(weight / scale[:, None]).clamp(-127, 127).to(torch.int8))
+        module.scale.copy_(scale)
+        if linear.bias is not None:
+            module.bias.copy_(linear.bias.detach())
+        return module
+
+    def forward(self, x):
+        if x.device.type == "cpu" and x.dtype in (torch.bfloat16, torch.float16) and \
+                hasattr(torch, "_weight_int8pack_mm"):
+            out = torch._weight_int8pack_mm(x.reshape(-1, self.in_features), self.weight, self.scale.to(x.dtype))
+            out = out.reshape(*x.shape[:-1], self.out_features)
+        else:
+            out = nn.functional.linear(x, self.weight.to(x.dtype)) * self.scale.to(x.dtype)
+        return out + self.bias.to(x.dtype) if self.bias is not None else out
+
+    def extra_repr(self):
+        return "in_features={}, out_features={}, bias={}".format(self.in_features, self.out_features,
+                                                                 self.bias is not None)
+
+
+def _replace_linears(module):
+    for name, child in module.named_children():
+        if isinstance(child, nn.Linear):
+            setattr(module, name, Int8WeightOnlyLinear.from_float(child))
+        else:
+            _replace_linears(child)
+
+
+def quantize_model(vl_gpt, mode):
+    """ Quantizes the nn.Linear layers of the language model, the image generation head and the aligners in place.
+    Already quantized layers are left as is, so it can be called again after loading the image submodules.
+
+    Args:
+        vl_gpt (MultiModalityCausalLM): The model, already on its final device and dtype.
+        mode (str): "int8_dynamic": int8 weights and activations quantized on the fly (torch dynamic quantization,
+            cpu and float32 only, fastest on cpu). "int8_weight_only": int8 weights, floating point activations
+            (bfloat16 or float16 on cpu, any dtype on accelerators).
+
+    Returns:
+        vl_gpt (MultiModalityCausalLM): The same model.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode: {mode}")
+    language_model = vl_gpt.language_model
+    if mode == "int8_dynamic" and (language_model.device.type != "cpu" or language_model.dtype != torch.float32):
+        raise ValueError("int8_dynamic quantization needs a float32 model on cpu")
+    if mode == "int8_weight_only" and language_model.device.type == "cpu" and language_model.dtype == torch.float32:
+        raise ValueError("int8_weight_only quantization is slower than float32 on cpu, use int8_dynamic for a float32 "
+                         "cpu model or a bfloat16 model")
+
+    for name in QUANTIZED_SUBMODULES:
+        submodule = getattr(vl_gpt, name)
+        if submodule is None:  # Image submodules of a text only model, quantized once loaded
+            continue
+        if mode == "int8_dynamic":
+            torch.ao.quantization.quantize_dynamic(submodule, {nn.Linear}, dtype=torch.qint8, inplace=True)
+        else:
+            _replace_linears(submodule)
+    return vl_gpt
+
+
+def model_nbytes(module):
+    """ Memory of the weights and buffers of module, packed quantized weights included. """
+
+    def nbytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(nbytes(v) for v in value)
+        return 0
+
+    return sum(nbytes(value) for value in module.state_dict().values())
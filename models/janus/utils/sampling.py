@@ -0,0 +1,66 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+
+# At temperatures this low softmax(logits / temperature) is one-hot up to float rounding, so sampling is an argmax
+# without the softmax over the whole vocabulary (the image profiles use 0.00001)
+GREEDY_TEMPERATURE = 1e-4
+# Candidates kept before the top-p cumulative sum, so that it sorts a few tokens instead of the whole vocabulary
+TOP_P_PREFILTER_K = 1024
+
+
+def _multinomial(probs, generator):
+    """ One sample per row. A list of generators seeds each row on its own (per request seeding in a batch). """
+    if isinstance(generator, (list, tuple)):
+        return torch.cat([torch.multinomial(row, num_samples=1, generator=g) for row, g in zip(probs, generator)])
+    return torch.multinomial(probs, num_samples=1, generator=generator).squeeze(dim=-1)
+
+
+def sample_tokens(logits, temperature=0.0, top_k=None, top_p=None, generator=None):
+    """ Samples the next token of each row of logits.
+
+    Greedy (argmax) when the temperature is at most GREEDY_TEMPERATURE. Otherwise the logits are divided by the
+    temperature and the sample is drawn among the top_k most likely tokens, then within the smallest set whose
+    probability reaches top_p. top_p alone first keeps the TOP_P_PREFILTER_K most likely tokens. Without top_k and
+    top_p the sample is drawn from the full softmax.
+
+    Args:
+        logits (torch.Tensor): [rows, vocab_size]
+        temperature (Union[float, torch.Tensor]): Sampling temperature, or a [rows, 1] tensor of one per row. Rows at
+            a greedy temperature take the argmax.
+        top_k (int, optional): Number of most likely tokens to sample from.
+        top_p (float, optional): Nucleus probability mass to sample from.
+        generator (Union[torch.Generator, List[torch.Generator]], optional): Random generator of the request, or one
+            per row.
+
+    Returns:
+        tokens (torch.LongTensor): [rows]
+    """
+    if not torch.is_tensor(temperature):
+        if temperature is None or temperature <= GREEDY_TEMPERATURE:
+            return torch.argmax(logits, dim=-1)
+        temperature = torch.tensor([[temperature]], dtype=torch.float32, device=logits.device)
+    greedy = temperature <= GREEDY_TEMPERATURE
+    if bool(greedy.all()):
+        return torch.argmax(logits, dim=-1)
+
+    greedy_tokens = torch.argmax(logits, dim=-1) if bool(greedy.any()) else None
+    logits = logits.float() / temperature.clamp(min=GREEDY_TEMPERATURE)
+    if top_p is not None and top_k is None:
+        top_k = TOP_P_PREFILTER_K
+    indices = None
+    if top_k is not None and top_k < logits.shape[-1]:
+        logits, indices = torch.topk(logits, top_k, dim=-1)  # Sorted in descending order
+    if top_p is not None:
+        if indices is None:
+            logits, indices = torch.sort(logits, dim=-1, descending=True)
+        probs = torch.softmax(logits, dim=-1)
+        # Drop the tokens once the mass before them reaches top_p, the most likely one is always kept
+        logits = logits.masked_fill(probs.cumsum(dim=-1) - probs >= top_p, float("-inf"))
+    tokens = _multinomial(torch.softmax(logits, dim=-1), generator)
+    if indices is not None:
+        tokens = indices.gather(-1, tokens.unsqueeze(-1)).squeeze(-1)
+    if greedy_tokens is not None:
+        tokens = torch.where(greedy.reshape(-1), greedy_tokens, tokens)
+    return tokens
@@ -0,0 +1,681 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+"""CPU benchmarks of the LLM backend on a tiny random-weight Janus model.
+
+Usage:
+    python -m src.benchmark <name> [<name> ...]
+    python -m src.benchmark all
+"""
+
+import argparse
+import time
+import torch
+from models.janus.models.modeling_vlm import MultiModalityConfig, MultiModalityCausalLM
+from src.llm_backend import MultimodalLlm
+
+
+def tiny_janus_config(hidden_size=256, num_layers=4, num_heads=4, vocab_size=4096, attn_implementation="sdpa"):
+    """ Same module layout as Janus-Pro, with a small language model. The vision tower keeps a single SigLIP block
+    and the VQ model keeps its real shape (codebook ids and decode_code must stay compatible)."""
+    return MultiModalityConfig(
+        vision_config={"cls": "CLIPVisionTower",
+                       "params": {"model_name": "siglip_large_patch16_384", "image_size": 384,
+                                  "select_feature": "same", "select_layer": 1}},
+        aligner_config={"cls": "MlpProjector",
+                        "params": {"projector_type": "mlp_gelu", "depth": 2, "input_dim": 1024,
+                                   "n_embed": hidden_size}},
+        gen_vision_config={"cls": "VQ-16", "params": {"image_token_size": 16384, "n_embed": 8}},
+        gen_aligner_config={"cls": "MlpProjector",
+                            "params": {"projector_type": "mlp_gelu", "depth": 2, "input_dim": 8,
+                                       "n_embed": hidden_size}},
+        gen_head_config={"cls": "vision_head",
+                         "params": {"image_token_embed": hidden_size, "image_token_size": 16384,
+                                    "n_embed": hidden_size}},
+        language_config={"hidden_size": hidden_size, "intermediate_size": hidden_size * 2,
+                         "num_hidden_layers": num_layers, "num_attention_heads": num_heads,
+                         "num_key_value_heads": num_heads, "vocab_size": vocab_size,
+                         "max_position_embeddings": 4096, "bos_token_id": 0, "eos_token_id": 1,
+                         "attn_implementation": attn_implementation},
+    )
+
+
+def build_tiny_llm(seed=0, dtype=torch.float32, device="cpu", quantization=None, **config_kwargs):
+    torch.manual_seed(seed)
+    vl_gpt = MultiModalityCausalLM(tiny_janus_config(**config_kwargs)).to(device=device, dtype=dtype)
+    return MultimodalLlm(vl_gpt=vl_gpt, model_id=None, quantization=quantization)
+
+
+def random_prompt(llm, length, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    vocab_size = llm.vl_gpt.language_model.config.vocab_size
+    return torch.randint(2, vocab_size, (1, length), generator=generator).to(llm.device)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _proc_status_bytes(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024  # In kB
+    raise KeyError(field)
+
+
+class PeakRss:
+    """ Peak RSS growth of this process over a with block, in bytes (peak attribute). ru_maxrss cannot be used: it is
+    the high-water mark of the whole process lifetime, inherited from the parent across fork and exec. On Linux the
+    high-water mark (VmHWM) is reset by writing 5 to /proc/self/clear_refs, otherwise the RSS is sampled with psutil
+    every interval seconds. """
+
+    def __init__(self, interval=1e-3):
+        self.interval = interval
+        self.peak = 0
+        self._baseline = 0
+        self._process = None
+        self._sampler = None
+        self._done = None
+
+    def __enter__(self):
+        try:
+            with open("/proc/self/clear_refs", "w") as clear_refs:
+                clear_refs.write("5")
+            self._baseline = _proc_status_bytes("VmRSS")
+        except OSError:
+            import threading
+            import psutil
+            self._process = psutil.Process()
+            self._baseline = self.peak = self._process.memory_info().rss
+            self._done = threading.Event()
+
+            def sample():
+                while not self._done.wait(self.interval):
+                    self.peak = max(self.peak, self._process.memory_info().rss)
+
+            self._sampler = threading.Thread(target=sample, daemon=True)
+            self._sampler.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._sampler is None:
+            self.peak = _proc_status_bytes("VmHWM")
+        else:
+            self._done.set()
+            self._sampler.join()
+            self.peak = max(self.peak, self._process.memory_info().rss)
+        self.peak -= self._baseline
+        return False
+
+
+def run_isolated(target, *args):
+    """Runs target(*args, queue) in a fresh process and returns what it put in the queue. Used to measure the peak
+    RSS (PeakRss) of one setup at a time."""
+    import multiprocessing
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def bench_text_decode(prompt_len=256, new_tokens=64):
+    """Uncached vs KV-cached greedy text decoding."""
+    llm = build_tiny_llm()
+    input_ids = random_prompt(llm, prompt_len)
+    results = {}
+    for use_cache in (False, True):
+        output_ids, elapsed = timed(llm.generate_ids, input_ids, max_new_tokens=new_tokens, use_cache=use_cache,
+                                    ignore_eos=True)
+        results[use_cache] = (output_ids, len(output_ids) / elapsed)
+
+    assert results[True][0] == results[False][0], "Cached decoding diverged from the uncached greedy output"
+    print(f"text_decode: prompt={prompt_len} new_tokens={new_tokens}")
+    print(f"  no cache : {results[False][1]:8.1f} tokens/s")
+    print(f"  kv cache : {results[True][1]:8.1f} tokens/s  (x{results[True][1] / results[False][1]:.1f})")
+    return results
+
+
+def bench_prefix_cache(prefix_len=512, suffix_len=32, calls=5, new_tokens=16):
+    """Game-like calls sharing a long prompt prefix, with and without the radix prefix cache."""
+    llm = build_tiny_llm()
+    prefix = random_prompt(llm, prefix_len)
+    prompts = [torch.cat([prefix, random_prompt(llm, suffix_len, seed=i + 1)], dim=-1) for i in range(calls)]
+    prefix_cache = llm.prefix_cache
+    results = {}
+    for name, cache in (("no prefix cache", None), ("prefix cache", prefix_cache)):
+        llm.prefix_cache = cache
+        outputs, elapsed = timed(lambda: [llm.generate_ids(p, max_new_tokens=new_tokens, ignore_eos=True)
+                                          for p in prompts])
+        results[name] = (outputs, elapsed)
+
+    assert results["prefix cache"][0] == results["no prefix cache"][0], "Prefix cache changed the greedy output"
+    stats = prefix_cache.stats()
+    print(f"prefix_cache: {calls} calls, shared prefix={prefix_len} suffix={suffix_len} new_tokens={new_tokens}")
+    for name, (_, elapsed) in results.items():
+        print(f"  {name:15s}: {elapsed:6.2f}s")
+    print(f"  hit rate {stats['hit_rate']:.0%}, token hit rate {stats['token_hit_rate']:.0%}, "
+          f"{stats['bytes_saved'] / 2 ** 20:.1f} MB of KV reused, {stats['stored_bytes'] / 2 ** 20:.1f} MB stored")
+    return results
+
+
+def bench_text_batch(batch_sizes=(1, 2, 4, 8), prompt_len=128, new_tokens=32):
+    """Throughput of generate_ids_batch for growing batch sizes, prompts of different lengths."""
+    llm = build_tiny_llm()
+    llm.prefix_cache = None
+    prompts = [random_prompt(llm, prompt_len - 8 * i, seed=i)[0].tolist() for i in range(max(batch_sizes))]
+    singles = [llm.generate_ids(torch.LongTensor([p]), max_new_tokens=new_tokens, ignore_eos=True) for p in prompts]
+    print(f"text_batch: prompt~{prompt_len} new_tokens={new_tokens}")
+    results = {}
+    for batch_size in batch_sizes:
+        outputs, elapsed = timed(llm.generate_ids_batch, prompts[:batch_size], max_new_tokens=new_tokens,
+                                 ignore_eos=True)
+        matches = sum(out == single for out, single in zip(outputs, singles))
+        results[batch_size] = batch_size * new_tokens / elapsed
+        print(f"  batch {batch_size:2d}: {results[batch_size]:8.1f} tokens/s  "
+              f"({matches}/{batch_size} rows equal to unbatched greedy)")
+    return results
+
+
+def bench_tokenization(turns=5):
+    """Full re-encoding vs incremental tokenization of game-like conversations. Needs the tokenizer in MODEL_PATH."""
+    from configs.config import MODEL_PATH
+    from models.janus.models import VLChatProcessor
+    from src.llm_backend import create_message, USER
+    from src.prompt_misc import init_pr, env_pr, dialogue_single_exchange_gen_pr
+    from src.tokenized_conversation import TokenizedConversation
+    if not (MODEL_PATH / 'preprocessor_config.json').exists():
+        print(f"tokenization: skipped, no tokenizer in {MODEL_PATH}")
+        return None
+    processor = VLChatProcessor.from_pretrained(MODEL_PATH)
+    tokenizer = processor.tokenizer
+    level_conv = [create_message(USER, init_pr), create_message(content="Provide the questions."),
+                  create_message(USER, env_pr), create_message(content="A misty forest with tall dark trees.")]
+    conversations = [level_conv + [create_message(USER, dialogue_single_exchange_gen_pr.format("bird") * (i + 1)),
+                                   create_message()] for i in range(turns)]
+
+    def full():
+        return [tokenizer.encode(processor.apply_sft_template_for_multi_turn_prompts(c, processor.sft_format, ""))
+                for c in conversations]
+
+    segment_cache = {}
+
+    def incremental():
+        return [TokenizedConversation.from_messages(tokenizer, c, processor.sft_format,
+                                                    segment_cache=segment_cache).get_prompt_ids()
+                for c in conversations]
+
+    expected, full_time = timed(full)
+    got, incremental_time = timed(incremental)
+    assert got == expected, "Incremental tokenization differs from the full encode"
+    print(f"tokenization: {turns} game prompts, full encode {full_time * 1e3:.2f}ms, "
+          f"incremental {incremental_time * 1e3:.2f}ms")
+    return full_time, incremental_time
+
+
+def bench_speculative(prompt_len=128, new_tokens=64, num_draft_tokens=4):
+    """Plain vs speculative greedy decoding, with a draft made of the first layer of the target and a random draft."""
+    import copy
+    from transformers import LlamaForCausalLM
+    llm = build_tiny_llm()
+    llm.prefix_cache = None
+    target = llm.vl_gpt.language_model
+    input_ids = random_prompt(llm, prompt_len)
+    expected, plain_time = timed(llm.generate_ids, input_ids, max_new_tokens=new_tokens, ignore_eos=True)
+    print(f"speculative: prompt={prompt_len} new_tokens={new_tokens} draft tokens={num_draft_tokens}")
+    print(f"  plain greedy  : {new_tokens / plain_time:8.1f} tokens/s")
+
+    draft_config = copy.deepcopy(target.config)
+    draft_config.num_hidden_layers = 1
+    torch.manual_seed(1)
+    shallow_draft = LlamaForCausalLM(draft_config).to(target.dtype)
+    shallow_draft.load_state_dict(target.state_dict(), strict=False)
+    results = {}
+    for name, draft in (("shallow draft", shallow_draft), ("random draft", LlamaForCausalLM(draft_config))):
+        llm.set_draft_model(draft, num_draft_tokens)
+        llm.speculative_stats = type(llm.speculative_stats)()
+        output_ids, elapsed = timed(llm.generate_ids, input_ids, max_new_tokens=new_tokens, ignore_eos=True)
+        assert output_ids == expected, "Speculative decoding diverged from the plain greedy output"
+        results[name] = (new_tokens / elapsed, llm.speculative_stats)
+        print(f"  {name:14s}: {results[name][0]:8.1f} tokens/s  (x{plain_time / elapsed:.2f}, "
+              f"{llm.speculative_stats})")
+    llm.draft_model = None
+    return results
+
+
+def bench_prompt_lookup(prompt_len=256, new_tokens=128):
+    """Plain vs prompt lookup greedy decoding. The random model tends to fall into loops, which it can copy from."""
+    from src.generation_profiles import TextGenProfile
+    llm = build_tiny_llm()
+    llm.prefix_cache = None
+    input_ids = random_prompt(llm, prompt_len)
+    results = {}
+    for prompt_lookup in (False, True):
+        profile = TextGenProfile("prompt_lookup" if prompt_lookup else "plain", new_tokens, prompt_lookup=prompt_lookup)
+        output_ids, elapsed = timed(llm.generate_ids, input_ids, ignore_eos=True, profile=profile)
+        results[prompt_lookup] = (output_ids, new_tokens / elapsed)
+
+    assert results[True][0] == results[False][0], "Prompt lookup diverged from the plain greedy output"
+    print(f"prompt_lookup: prompt={prompt_len} new_tokens={new_tokens}")
+    print(f"  plain greedy  : {results[False][1]:8.1f} tokens/s")
+    print(f"  prompt lookup : {results[True][1]:8.1f} tokens/s  (x{results[True][1] / results[False][1]:.2f}, "
+          f"{llm.speculative_stats})")
+    return results
+
+
+def bench_devices(prompt_len=256, new_tokens=64):
+    """Cached greedy decoding tokens/s per device, dtype and attention implementation."""
+    from configs.config import CPU_NUM_THREADS
+    from models.janus.utils.device import configure_cpu_threads
+    print(f"devices: prompt={prompt_len} new_tokens={new_tokens}, {configure_cpu_threads(CPU_NUM_THREADS)} cpu threads")
+    setups = [("cpu", torch.float32, "eager"), ("cpu", torch.float32, "sdpa"), ("cpu", torch.bfloat16, "sdpa")]
+    if torch.cuda.is_available():
+        setups += [("cuda", torch.float32, "sdpa"), ("cuda", torch.bfloat16, "sdpa")]
+    results = {}
+    for device, dtype, attn_implementation in setups:
+        llm = build_tiny_llm(dtype=dtype, device=device, attn_implementation=attn_implementation)
+        llm.prefix_cache = None
+        input_ids = random_prompt(llm, prompt_len)
+        llm.generate_ids(input_ids, max_new_tokens=4, ignore_eos=True)  # Warm up
+        _, elapsed = timed(llm.generate_ids, input_ids, max_new_tokens=new_tokens, ignore_eos=True)
+        results[(device, dtype, attn_implementation)] = new_tokens / elapsed
+        print(f"  {device:4s} {str(dtype):14s} {attn_implementation:5s}: {new_tokens / elapsed:8.1f} tokens/s")
+    return results
+
+
+def bench_quantization(prompt_len=128, new_tokens=32, num_prompts=8):
+    """Memory, tokens/s and greedy agreement of the int8 modes against the float32 and bfloat16 models on cpu.
+    int8_dynamic quantizes the float32 model and int8_weight_only the bfloat16 one."""
+    from models.janus.utils.quantization import model_nbytes
+    setups = [("float32", torch.float32, None), ("bfloat16", torch.bfloat16, None),
+              ("int8_dynamic", torch.float32, "int8_dynamic"), ("int8_weight_only", torch.bfloat16, "int8_weight_only")]
+    print(f"quantization: {num_prompts} prompts={prompt_len} new_tokens={new_tokens}")
+    reference, results = None, {}
+    for name, dtype, quantization in setups:
+        llm = build_tiny_llm(dtype=dtype, quantization=quantization, hidden_size=512)
+        llm.prefix_cache = None
+        prompts = [random_prompt(llm, prompt_len, seed=i) for i in range(num_prompts)]
+        outputs, elapsed = timed(lambda: [llm.generate_ids(p, max_new_tokens=new_tokens, ignore_eos=True)
+                                          for p in prompts])
+        reference = reference or outputs
+        exact = sum(out == ref for out, ref in zip(outputs, reference))
+        agreement = sum(sum(a == b for a, b in zip(out, ref)) for out, ref in zip(outputs, reference)) / \
+            (num_prompts * new_tokens)
+        results[name] = (model_nbytes(llm.vl_gpt.language_model), num_prompts * new_tokens / elapsed, exact)
+        print(f"  {name:16s}: language model {results[name][0] / 2 ** 20:7.1f} MB, {results[name][1]:8.1f} tokens/s, "
+              f"{exact}/{num_prompts} outputs equal to float32, {agreement:.0%} tokens agree")
+    return results
+
+
+def _measure_startup(model_path, mode, queue):
+    """Runs in a fresh process, so that the memory freed by earlier loads does not hide the growth of this one."""
+    from transformers import AutoModelForCausalLM
+    from models.janus.utils.io import load_vl_gpt
+    torch.set_grad_enabled(False)
+    with PeakRss() as rss:
+        start = time.perf_counter()
+        if mode != "cast":
+            vl_gpt = load_vl_gpt(model_path, "cpu", "bfloat16", text_only=mode == "text_only")
+        else:  # Loading path before low precision loading: float32 weights, cast afterwards
+            vl_gpt = AutoModelForCausalLM.from_pretrained(model_path, trust_remote_code=True).to(torch.bfloat16).eval()
+        loaded = time.perf_counter() - start
+        llm = MultimodalLlm(vl_gpt=vl_gpt, model_id=None, quantization=None)
+        llm.generate_ids(random_prompt(llm, 16), max_new_tokens=1, ignore_eos=True)
+        ready = time.perf_counter() - start
+    queue.put((loaded, ready, rss.peak, sum(p.numel() * p.element_size() for p in vl_gpt.parameters())))
+
+
+def bench_startup():
+    """Time-to-ready (load + first token) and peak RSS of loading a bfloat16 checkpoint on cpu: float32 load + cast,
+    direct low precision loading, and text only loading. Uses a tiny checkpoint saved in safetensors format."""
+    import tempfile
+    llm = build_tiny_llm(hidden_size=1024, num_layers=8, num_heads=8)
+    results = {}
+    with tempfile.TemporaryDirectory() as model_path:
+        llm.vl_gpt.to(torch.bfloat16).save_pretrained(model_path, safe_serialization=True)
+        del llm
+        print("startup: tiny bfloat16 checkpoint on cpu")
+        for name, mode in (("float32 + cast", "cast"), ("direct bfloat16", "direct"), ("text only", "text_only")):
+            results[name] = run_isolated(_measure_startup, model_path, mode)
+            loaded, ready, peak, size = results[name]
+            print(f"  {name:15s}: loaded in {loaded:5.2f}s, ready in {ready:5.2f}s, peak RSS +{peak / 2 ** 20:7.1f} MB "
+                  f"for a {size / 2 ** 20:.1f} MB model")
+    return results
+
+
+def bench_residency(turns=3, new_tokens=32):
+    """Text turns followed by an image step (generation head + VQ decode) under a memory budget that only fits the
+    language model and the generation head, cpu being the slow tier. Needs cuda."""
+    from src.residency import ResidencyManager
+    if not torch.cuda.is_available():
+        print("residency: skipped, needs cuda (cpu is the slow tier)")
+        return None
+    llm = build_tiny_llm(device="cuda")
+    llm.prefix_cache = None
+    vl_gpt = llm.vl_gpt
+    full = ResidencyManager(vl_gpt, max_bytes=None)
+    budget = full.nbytes("language_model") + sum(full.nbytes(name) for name in ("gen_head", "gen_aligner", "gen_embed"))
+    codes = torch.randint(0, 16384, (1, 576), device="cuda")
+
+    def image_step(prefetch):
+        if prefetch:
+            llm.prefetch_image_modules()
+        for _ in range(turns):
+            llm.generate_ids(random_prompt(llm, 64), max_new_tokens=new_tokens, ignore_eos=True)
+        llm.residency.prefetch("gen_vision_model")
+        with llm.residency.use("gen_head", "gen_aligner", "gen_embed"):
+            for _ in range(64):
+                vl_gpt.gen_head(vl_gpt.prepare_gen_img_embeds(codes[0, :2]))
+        with llm.residency.use("gen_vision_model"):
+            vl_gpt.gen_vision_model.decode_code(codes, shape=[1, 8, 24, 24])
+        torch.cuda.synchronize()
+
+    print(f"residency: budget {budget / 2 ** 20:.1f} MB of {full.resident_bytes() / 2 ** 20:.1f} MB")
+    results = {}
+    for name, max_bytes, prefetch in (("all resident", None, False), ("budget", budget, False),
+                                      ("budget + prefetch", budget, True)):
+        llm.residency = ResidencyManager(vl_gpt, max_bytes=max_bytes)
+        image_step(prefetch)  # Warm up, and leaves the VQ decoder resident
+        _, elapsed = timed(image_step, prefetch)
+        stats = llm.residency.stats()
+        results[name] = (elapsed, stats)
+        print(f"  {name:17s}: {elapsed:6.2f}s, resident {stats['resident_bytes'] / 2 ** 20:7.1f} MB, "
+              f"{stats['misses']} misses, {stats['prefetches']} prefetches, {stats['evictions']} evictions, "
+              f"transfers {stats['transfer_seconds']:.2f}s blocking + {stats['prefetch_seconds']:.2f}s background, "
+              f"{stats['saved_seconds']:.2f}s saved by hits")
+    return results
+
+
+def dynamic_cache_image_tokens(vl_gpt, inputs_embeds, image_token_num_per_image, cfg_weight, temperature, generator):
+    """The image token loop as generate_image ran it before the static cache: the KV cache grows every step."""
+    parallel_size = inputs_embeds.shape[0] // 2
+    generated_tokens = torch.zeros((parallel_size, image_token_num_per_image), dtype=torch.int,
+                                   device=inputs_embeds.device)
+    past_key_values = None
+    for i in range(image_token_num_per_image):
+        outputs = vl_gpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True,
+                                              past_key_values=past_key_values)
+        past_key_values = outputs.past_key_values
+        logits = vl_gpt.gen_head(outputs.last_hidden_state[:, -1, :])
+        logits = logits[1::2, :] + cfg_weight * (logits[0::2, :] - logits[1::2, :])
+        next_token = torch.multinomial(torch.softmax(logits / temperature, dim=-1), num_samples=1,
+                                       generator=generator)
+        generated_tokens[:, i] = next_token.squeeze(dim=-1)
+        inputs_embeds = vl_gpt.prepare_gen_img_embeds(next_token.squeeze(dim=-1).repeat_interleave(2)).unsqueeze(1)
+    return generated_tokens
+
+
+def bench_image_decode(prompt_len=64, image_tokens=576, parallel_size=1, cfg_weight=5.0, temperature=1.0, seed=0):
+    """Image token loop: growing KV cache vs static KV cache, eager and compiled (CUDA graphs on cuda)."""
+    from models.janus.utils.image_generation import ImageTokenGenerator
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    vl_gpt = llm.vl_gpt
+    prompt = random_prompt(llm, prompt_len).repeat(parallel_size * 2, 1)
+    inputs_embeds = vl_gpt.language_model.get_input_embeddings()(prompt)
+    print(f"image_decode on {device}: prompt={prompt_len} image tokens={image_tokens} parallel_size={parallel_size}")
+
+    def run(fn):
+        fn(torch.Generator(device).manual_seed(seed))  # Warm up (and compile)
+        return timed(fn, torch.Generator(device).manual_seed(seed))
+
+    results = {"dynamic cache": run(lambda g: dynamic_cache_image_tokens(vl_gpt, inputs_embeds, image_tokens,
+                                                                         cfg_weight, temperature, g))}
+    for name, compile in (("static cache", False), ("static compiled", True)):
+        generator = ImageTokenGenerator(vl_gpt, parallel_size, prompt_len + image_tokens, compile=compile)
+        results[name] = run(lambda g: generator.generate(inputs_embeds, image_tokens, cfg_weight, temperature, g))
+        if compile and not generator.compiled:
+            name += " (compile failed, eager)"
+        print(f"  {name:17s}: {results[name][1] / image_tokens * 1e3:6.2f} ms/step")
+    print(f"  dynamic cache    : {results['dynamic cache'][1] / image_tokens * 1e3:6.2f} ms/step")
+    same = torch.equal(results["static cache"][0], results["static compiled"][0])
+    print(f"  compiled tokens identical to eager under seed {seed}: {same}")
+    return results
+
+
+def bench_image_batch(batch_sizes=(1, 2, 4, 8), prompt_len=64, image_tokens=576, temperature=1e-5):
+    """Images per minute of the image token loop for growing batches of prompts of different lengths (left padded),
+    and agreement of the batched tokens with one call per prompt (near greedy sampling)."""
+    from types import SimpleNamespace
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    llm.vl_chat_processor = SimpleNamespace(pad_id=2)  # The CFG rows only need the pad id of the processor
+    prompts = [random_prompt(llm, prompt_len - 8 * i, seed=i)[0].tolist() for i in range(max(batch_sizes))]
+    singles = [llm.generate_image_tokens([prompt], 5.0, temperature, image_tokens)[0] for prompt in prompts]
+    print(f"image_batch on {device}: prompt~{prompt_len} image tokens={image_tokens}")
+    results = {}
+    for batch_size in batch_sizes:
+        llm.generate_image_tokens(prompts[:batch_size], 5.0, temperature, image_tokens)  # Warm up (and compile)
+        tokens, elapsed = timed(llm.generate_image_tokens, prompts[:batch_size], 5.0, temperature, image_tokens)
+        agreement = sum((row == single).float().mean().item() for row, single in zip(tokens, singles)) / batch_size
+        results[batch_size] = batch_size * 60 / elapsed
+        print(f"  batch {batch_size:2d}: {results[batch_size]:8.1f} images/min  "
+              f"({agreement:.1%} of the tokens equal to one prompt per call)")
+    return results
+
+
+def bench_image_preview(prompt_len=64, every_rows=(8, 4, 1), max_overheads=(0.1, 1.0)):
+    """Image token loop time with progressive previews decoded every N rows, under different overhead bounds."""
+    from types import SimpleNamespace
+    from src.image_preview import ImagePreview
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    llm.vl_chat_processor = SimpleNamespace(pad_id=2)  # The CFG rows only need the pad id of the processor
+    prompts = [random_prompt(llm, prompt_len)[0].tolist()]
+    llm.generate_image_tokens(prompts, 5.0, 1.0)  # Warm up (and compile)
+    _, baseline = timed(llm.generate_image_tokens, prompts, 5.0, 1.0)
+    print(f"image_preview on {device}: no previews {baseline:.2f}s")
+    results = {}
+    for max_overhead in max_overheads:
+        for rows in every_rows:
+            preview = ImagePreview(llm.decode_images, lambda images, num_rows: None, 24, rows, max_overhead)
+            _, elapsed = timed(llm.generate_image_tokens, prompts, 5.0, 1.0, callback=preview)
+            results[(rows, max_overhead)] = elapsed
+            print(f"  every {rows} rows, max overhead {max_overhead:.0%}: {elapsed:.2f}s "
+                  f"(+{elapsed / baseline - 1:.1%}), {preview.previews} previews, {preview.skipped} skipped")
+    return results
+
+
+def bench_image_prefill(calls=4, prefix_len=32, suffix_len=24, image_tokens=16):
+    """Prefill of the CFG rows of game-like image prompts (a shared wrapper and a varying description), with and
+    without the image prefix cache."""
+    from types import SimpleNamespace
+    from src.prefix_cache import RadixPrefixCache
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    llm.vl_chat_processor = SimpleNamespace(pad_id=2)  # The CFG rows only need the pad id of the processor
+    wrapper = random_prompt(llm, prefix_len, seed=100)[0].tolist()
+    prompts = [wrapper + random_prompt(llm, suffix_len + 4 * i, seed=i)[0].tolist() for i in range(calls)]
+    llm.image_prefix_cache = None
+    llm.generate_image_tokens(prompts[:1], 5.0, 1.0, image_tokens)  # Warm up (and compile)
+    print(f"image_prefill on {device}: {calls} prompts of {prefix_len} shared + ~{suffix_len} tokens")
+    results = {}
+    for name, cache in (("no cache", None), ("prefix cache", RadixPrefixCache(2 ** 28))):
+        llm.image_prefix_cache = cache
+        seconds = reused = tokens = batched = 0
+        for prompt in prompts:
+            llm.generate_image_tokens([prompt], 5.0, 1.0, image_tokens)
+            prefill = llm.image_generator(1, len(prompt) + image_tokens).last_prefill
+            seconds += prefill["seconds"]
+            reused += prefill["reused"]
+            tokens += prefill["tokens"]
+            batched += prefill["batched"]
+        results[name] = seconds / calls
+        print(f"  {name:12s}: {results[name] * 1e3:7.2f} ms prefill per image, {reused}/{tokens} prompt tokens "
+              f"reused, {batched}/{calls} batched prefills")
+    print(f"  measured saving: {(results['no cache'] - results['prefix cache']) * 1e3:.2f} ms per image")
+    return results
+
+
+def bench_cfg_schedule(num_prompts=4, prompt_len=48, image_tokens=576, cfg_weight=5.0, temperature=1e-5):
+    """Speed vs quality of guidance schedules on a fixed prompt set. Quality is the share of image tokens equal to
+    those of constant guidance over all the tokens (near greedy sampling), the reference output."""
+    from types import SimpleNamespace
+    from models.janus.utils.cfg_schedule import CfgSchedule
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    llm.vl_chat_processor = SimpleNamespace(pad_id=2)  # The CFG rows only need the pad id of the processor
+    llm.image_prefix_cache = None
+    prompts = [random_prompt(llm, prompt_len - 4 * i, seed=i)[0].tolist() for i in range(num_prompts)]
+    schedules = {
+        "constant": CfgSchedule(cfg_weight),
+        "linear": CfgSchedule(cfg_weight, "linear"),
+        "cosine": CfgSchedule(cfg_weight, "cosine"),
+        "constant [0, 0.5]": CfgSchedule(cfg_weight, "constant", (0.0, 0.5)),
+        "linear [0, 0.5]": CfgSchedule(cfg_weight, "linear", (0.0, 0.5)),
+        "cosine [0, 0.25]": CfgSchedule(cfg_weight, "cosine", (0.0, 0.25)),
+        "no guidance": CfgSchedule(cfg_weight, "constant", (0.0, 0.0)),
+    }
+    print(f"cfg_schedule on {device}: {num_prompts} prompts, image tokens={image_tokens}, cfg_weight={cfg_weight}")
+    reference, results = None, {}
+    for name, schedule in schedules.items():
+        llm.generate_image_tokens(prompts, schedule, temperature, image_tokens)  # Warm up (and compile)
+        tokens, elapsed = timed(llm.generate_image_tokens, prompts, schedule, temperature, image_tokens)
+        reference = tokens if reference is None else reference
+        agreement = (tokens == reference).float().mean().item()
+        results[name] = (elapsed, agreement)
+        print(f"  {name:18s}: {elapsed / image_tokens * 1e3:6.2f} ms/token, "
+              f"{results['constant'][0] / elapsed:.2f}x, {agreement:.1%} tokens equal to constant guidance")
+    return results
+
+
+def bench_sampling(rows=(1, 8), vocab_sizes=(16384, 102400), repeats=200):
+    """Per call latency of sample_tokens on random logits of the image (16384) and text (~100k) vocabularies,
+    against the former full softmax + multinomial at temperature 0.00001."""
+    from models.janus.utils.sampling import sample_tokens
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    modes = {
+        "softmax + multinomial": lambda logits, g: torch.multinomial(torch.softmax(logits / 0.00001, dim=-1), 1,
+                                                                     generator=g),
+        "greedy": lambda logits, g: sample_tokens(logits, 0.00001),
+        "temperature 1": lambda logits, g: sample_tokens(logits, 1.0, generator=g),
+        "top-k 50": lambda logits, g: sample_tokens(logits, 1.0, top_k=50, generator=g),
+        "top-p 0.9": lambda logits, g: sample_tokens(logits, 1.0, top_p=0.9, generator=g),
+    }
+    print(f"sampling on {device}: {repeats} calls per setting")
+    results = {}
+    for vocab_size in vocab_sizes:
+        for num_rows in rows:
+            logits = torch.randn((num_rows, vocab_size), generator=torch.Generator().manual_seed(0)).to(device)
+            for name, fn in modes.items():
+                generator = torch.Generator(device).manual_seed(0)
+
+                def run():
+                    for _ in range(repeats):
+                        fn(logits, generator)
+                    if device == "cuda":
+                        torch.cuda.synchronize()
+
+                run()  # Warm up
+                _, elapsed = timed(run)
+                results[(vocab_size, num_rows, name)] = elapsed / repeats
+                print(f"  vocab {vocab_size:6d} x {num_rows} rows, {name:22s}: {elapsed / repeats * 1e6:8.1f} us")
+    return results
+
+
+def bench_image_assets(num_images=4, repeats=5):
+    """Disk bytes of an image stored as its VQ token grid vs as PNG and JPEG, and the time to get its pixels back:
+    decode_code on a miss vs the in-memory LRU on a hit."""
+    import io
+    import tempfile
+    from pathlib import Path
+    from PIL import Image
+    from src.image_assets import ImageAssetStore
+    llm = build_tiny_llm()
+    codes = torch.randint(0, 16384, (num_images, 576), generator=torch.Generator().manual_seed(0))
+    decode = lambda tokens: llm.decode_images(torch.from_numpy(tokens))
+    with tempfile.TemporaryDirectory() as asset_dir:
+        store = ImageAssetStore(Path(asset_dir), max_decoded=num_images)
+        asset_ids = [store.put(ImageAssetStore.make_key("bench", i), i, codes[i], "prompt {}".format(i))
+                     for i in range(num_images)]
+        _, miss = timed(lambda: [store.image(asset_id, decode) for asset_id in asset_ids])
+        _, hit = timed(lambda: [[store.image(asset_id, decode) for asset_id in asset_ids] for _ in range(repeats)])
+        image = store.image(asset_ids[0], decode)
+        sizes = {"tokens (json)": store.stats()["bytes_per_asset"]}
+        for fmt in ("PNG", "JPEG"):
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format=fmt)
+            sizes[fmt] = buffer.tell()
+    print(f"image_assets: {num_images} images of 576 tokens")
+    for name, size in sizes.items():
+        print(f"  {name:13s}: {size / 1024:7.1f} KB per image")
+    print(f"  decode_code on a miss: {miss / num_images * 1e3:7.2f} ms, LRU hit: "
+          f"{hit / (num_images * repeats) * 1e6:7.2f} us per image")
+    return {"sizes": sizes, "miss": miss / num_images, "hit": hit / (num_images * repeats)}
+
+
+def _measure_kv_cache(static, prompt_len, image_tokens, parallel_size, queue):
+    from models.janus.utils.image_generation import ImageTokenGenerator
+    torch.set_grad_enabled(False)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    llm = build_tiny_llm(device=device)
+    vl_gpt = llm.vl_gpt
+    inputs_embeds = vl_gpt.language_model.get_input_embeddings()(
+        random_prompt(llm, prompt_len).repeat(parallel_size * 2, 1))
+    if static:
+        generator = ImageTokenGenerator(vl_gpt, parallel_size, prompt_len + image_tokens, compile=False)
+        run = lambda: generator.generate(inputs_embeds, image_tokens, 5.0, 1.0)
+    else:
+        run = lambda: dynamic_cache_image_tokens(vl_gpt, inputs_embeds, image_tokens, 5.0, 1.0, None)
+    # Memory of the first run, latency of the second one
+    if device == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated()
+        run()
+        torch.cuda.synchronize()
+        peak = torch.cuda.max_memory_allocated() - baseline
+    else:
+        with PeakRss() as rss:
+            run()
+        peak = rss.peak
+    _, elapsed = timed(run)
+    queue.put((elapsed / image_tokens, peak, device))
+
+
+def bench_kv_cache(prompt_len=64, image_tokens=576, parallel_size=4):
+    """Peak memory and per step latency of the image token loop, growing vs preallocated static KV cache (eager)."""
+    print(f"kv_cache: prompt={prompt_len} image tokens={image_tokens} parallel_size={parallel_size}")
+    results = {}
+    for name, static in (("growing cache", False), ("static cache", True)):
+        results[name] = run_isolated(_measure_kv_cache, static, prompt_len, image_tokens, parallel_size)
+        step, peak, device = results[name]
+        memory = "peak allocated" if device == "cuda" else "peak RSS growth"
+        print(f"  {name:13s} on {device}: {step * 1e3:6.2f} ms/step, {memory} {peak / 2 ** 20:7.1f} MB")
+    return results
+
+
+BENCHMARKS = {
+    "text_decode": bench_text_decode,
+    "prefix_cache": bench_prefix_cache,
+    "text_batch": bench_text_batch,
+    "tokenization": bench_tokenization,
+    "speculative": bench_speculative,
+    "prompt_lookup": bench_prompt_lookup,
+    "devices": bench_devices,
+    "quantization": bench_quantization,
+    "startup": bench_startup,
+    "residency": bench_residency,
+    "image_decode": bench_image_decode,
+    "image_batch": bench_image_batch,
+    "image_preview": bench_image_preview,
+    "image_prefill": bench_image_prefill,
+    "cfg_schedule": bench_cfg_schedule,
+    "sampling": bench_sampling,
+    "image_assets": bench_image_assets,
+    "kv_cache": bench_kv_cache,
+}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("names", nargs="+", choices=list(BENCHMARKS) + ["all"])
+    args = parser.parse_args()
+    torch.set_grad_enabled(False)
+    for name in (BENCHMARKS if "all" in args.names else args.names):
+        BENCHMARKS[name]()
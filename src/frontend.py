@@ -5,13 +5,21 @@ import tkinter as tk
 from tkinter import Text, Scrollbar, filedialog
 from PIL import Image, ImageTk
 from configs.config import FINAL_IMG_PATH
-from src.game_backend import TheWandererGame
+from src.log import logger
 import threading
 import time
 
 class WandererGameUI:
-    def __init__(self, root):
+    def __init__(self, root, start_time=None):
+        """
+        Args:
+            root (tk.Tk): The main window.
+            start_time (float, optional): time.perf_counter() at program start, to measure the time to first window.
+        """
         self.root = root
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.game_ctrl = None
+        self.move_time = None  # time.perf_counter() of the last movement input, to measure the time to first text
         self.root.title("The Wanderer")
 
         # Set window size
@@ -45,11 +53,44 @@ class WandererGameUI:
 
         # === Example Usage ===
         self.update_chat("Game started. Welcome to The Wanderer game!")
-        self.game_ctrl = TheWandererGame()
-        env_desc = self.game_ctrl.generate_env_desc()
-        self.load_image()
-        self.update_chat(f"Environment description: {env_desc}")
-        self.update_chat(f"'{self.game_ctrl.generate_entity_exchange()}'")
+        self.set_input_enabled(False)  # Until the first level is ready
+        self.root.after_idle(self.log_first_window)
+        # The model and the first level are loaded in the background, the window shows up right away
+        threading.Thread(target=self.startup, daemon=True).start()
+
+    def log_first_window(self):
+        logger.info("First window after {:.2f}s".format(time.perf_counter() - self.start_time))
+
+    def set_input_enabled(self, enabled):
+        state = tk.NORMAL if enabled else tk.DISABLED
+        self.input_entry.config(state=state)
+        self.submit_button.config(state=state)
+
+    def report_progress(self, message):
+        """Shows a startup progress event. Can be called from the worker thread."""
+        logger.info("{} ({:.1f}s after start)".format(message, time.perf_counter() - self.start_time))
+        self.root.after(0, self.update_chat, message)
+
+    def startup(self):
+        """Loads the model and generates the first level. Runs in a worker thread, the UI is updated through
+        root.after."""
+        try:
+            self.report_progress("Loading the model...")
+            # Imported here: importing torch and transformers alone takes seconds
+            from src.game_backend import TheWandererGame
+            self.game_ctrl = TheWandererGame()
+            self.game_ctrl.image_preview = lambda image: self.root.after(0, self.load_image, image)
+            self.game_ctrl.on_env_img = self.env_img_ready
+            self.report_progress("Generating the first area...")
+            env_desc = self.game_ctrl.generate_env_desc()
+            self.root.after(0, self.update_chat, f"Environment description: {env_desc}")
+            self.stream_chat(self.game_ctrl.generate_entity_exchange_stream())
+        except Exception as e:
+            logger.exception("Startup failed")
+            self.root.after(0, self.update_chat, f"Startup failed: {e}")
+            return
+        logger.info("First level ready after {:.2f}s".format(time.perf_counter() - self.start_time))
+        self.root.after(0, self.set_input_enabled, True)
 
     def update_chat(self, message):
         """Appends a message to the chat display."""
@@ -58,6 +99,46 @@ class WandererGameUI:
         self.chat_text.config(state=tk.DISABLED)
         self.chat_text.yview(tk.END)  # Auto-scroll to the bottom
 
+    def begin_stream(self):
+        """Starts a chat line that is filled while it is being generated."""
+        self.chat_text.mark_set("stream_start", "end-1c")
+        self.chat_text.mark_gravity("stream_start", tk.LEFT)
+        self.update_chat_fragment("'")
+
+    def update_chat_fragment(self, fragment):
+        """Appends a fragment to the chat line being streamed."""
+        self.chat_text.config(state=tk.NORMAL)
+        self.chat_text.insert(tk.END, fragment)
+        self.chat_text.config(state=tk.DISABLED)
+        self.chat_text.yview(tk.END)
+
+    def end_stream(self, message):
+        """Replaces the streamed chat line by its final (cleaned) message."""
+        self.chat_text.config(state=tk.NORMAL)
+        self.chat_text.delete("stream_start", tk.END)
+        self.chat_text.config(state=tk.DISABLED)
+        self.update_chat(message)
+
+    def env_img_ready(self, file_path):
+        """Shows the area image once it is generated. Called from the image worker thread."""
+        if self.move_time is not None:
+            logger.info("Area image after {:.2f}s".format(time.perf_counter() - self.move_time))
+        self.root.after(0, self.load_image)
+
+    def stream_chat(self, stream, start_time=None):
+        """Shows an entity statement stream in the chat. Runs in the worker thread, the UI is updated through
+        root.after. With start_time (time.perf_counter()), logs the time to the first fragment."""
+        self.root.after(0, self.begin_stream)
+        try:
+            fragment = next(stream)
+            if start_time is not None:
+                logger.info("First entity text after {:.2f}s".format(time.perf_counter() - start_time))
+            while True:
+                self.root.after(0, self.update_chat_fragment, fragment)
+                fragment = next(stream)
+        except StopIteration as stop:
+            self.root.after(0, self.end_stream, f"'{stop.value}'")
+
     def process_input(self, event=None):
         """Handles user input and appends it to the chat."""
         user_input = self.input_entry.get().strip()
@@ -72,19 +153,23 @@ class WandererGameUI:
 
     def process_game_logic(self, user_input):
         """Runs the backend logic without blocking the UI."""
-        new_env, entity_exchange = self.game_ctrl.wanderer_input(user_input)
+        start_time = time.perf_counter()
+        new_env, entity_stream = self.game_ctrl.wanderer_input(user_input, stream=True)
         if new_env:
+            # The image of the new area follows in the background, see env_img_ready
+            self.move_time = start_time
+            logger.info("New area text after {:.2f}s".format(time.perf_counter() - start_time))
             self.root.after(0, self.update_chat, f"You have arrived at a new location. Environment description:"
                                                  f" \n {new_env}")
-            self.root.after(0, self.load_image)
-        self.root.after(0, self.update_chat, f"'{entity_exchange}'")
+        self.stream_chat(entity_stream, start_time if new_env else None)
 
 
-    def load_image(self):
-        """Loads an image and displays it."""
+    def load_image(self, image=None):
+        """Loads an image and displays it. A given image (e.g. a preview of the area being generated) is shown
+        instead of the final image."""
         file_path = FINAL_IMG_PATH
-        if file_path:
-            image = Image.open(file_path)
+        if image is not None or file_path:
+            image = image if image is not None else Image.open(file_path)
             new_size = (image.width * 1, image.height * 1)
             upscaled_image = image.resize(new_size, Image.LANCZOS)
             self.img = ImageTk.PhotoImage(upscaled_image)
@@ -93,6 +178,7 @@ class WandererGameUI:
 
 
 if __name__ == "__main__":
+    start_time = time.perf_counter()
     root = tk.Tk()
-    game_ui = WandererGameUI(root)
+    game_ui = WandererGameUI(root, start_time)
     root.mainloop()
@@ -1,11 +1,13 @@
 #  Copyright (c) 2025. Salim Janji. All rights reserved.
 #  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
 
-from src.llm_backend import MultimodalLlm, create_message, USER, ASSISTANT
+from src.llm_backend import MultimodalLlm, ImageGenerationAborted, create_message, USER, ASSISTANT
 from src.prompt_misc import *
-from configs.config import WANDERER_IMG_PATH, ENTITY_IMG_PATH, ENV_IMG_PATH, FINAL_IMG_PATH
+from configs.config import WANDERER_IMG_PATH, ENTITY_IMG_PATH, ENV_IMG_PATH, FINAL_IMG_PATH, ENV_IMG_TEXT_FIRST_TIMEOUT
 from src.log import logger
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
 from src.tools import remove_white_background, overlay_image
 
@@ -20,6 +22,11 @@ class TheWandererGame:
         self.talking_entity = ''  # Not used yet. To define other entities that talk to the wanderer
         self.helpful_entity = 'helpful bird'  # Main talking entity that is helping the wanderer
         self.exchange_conv = []  # Holds the entire conversation history of the current level
+        self.image_preview = None  # Optional callable receiving PIL previews of the area image while it is generated
+        self.on_env_img = None  # Optional callable receiving FINAL_IMG_PATH once the area image is ready
+        self.env_img_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="env_img")
+        self.env_img_future = None  # Future of the latest area image, see submit_env_img
+        self.entity_line_ready = threading.Event()  # Of the current area, set once its first entity line is generated
 
     def generate_env_desc(self):
         """ Called one time after initialization to generate the first level area.
@@ -30,9 +37,9 @@ class TheWandererGame:
         """
         env_conv = (self.init_conv[:-1] + [create_message(content="Provide the questions.")] +
                     [create_message(USER, env_pr), create_message()])
-        self.env_desc = self.llm_model.generate_text(env_conv).replace("Assistant:", "").strip()
+        self.env_desc = self.llm_model.generate_text(env_conv, "paragraph").replace("Assistant:", "").strip()
         self.level_conv = env_conv[:-1] + [create_message(content=self.env_desc)]
-        self.generate_env_img()  # Update image
+        self.submit_env_img()  # Update image, after the first entity line
         return self.env_desc
 
     def update_env_desc(self):
@@ -44,6 +51,7 @@ class TheWandererGame:
 
         """
 
+        self.llm_model.prefetch_image_modules()  # The new area gets an image once described
         # Save previous level conversation. It can be useful for future extensions.
         self.prev_level_conv = (list(self.level_conv) + [create_message(USER, self.get_conv_combined())])
         self.exchange_conv = []  # Clear the current level conversation history
@@ -51,10 +59,12 @@ class TheWandererGame:
         # Decide what is the logical next place that the wanderer reaches
         self.prev_level_conv[-1]['content'] += "After the wanderer's decision of movement, where should they reach?"
         env_conv = self.prev_level_conv + [create_message()]
-        env_conv[-1]['content'] = self.llm_model.generate_text(env_conv).replace("Assistant:", "").strip()
+        next_place = self.llm_model.generate_text(env_conv, "paragraph")
+        env_conv[-1]['content'] = next_place.replace("Assistant:", "").strip()
         self.prev_level_conv = list(env_conv)
         env_desc = self.llm_model.generate_text(
-            env_conv + [create_message(USER, 'Describe the new area that the wanderer reaches'), create_message()])
+            env_conv + [create_message(USER, 'Describe the new area that the wanderer reaches'), create_message()],
+            "paragraph")
         logger.debug(env_desc)
 
         # To not complicate the image, we extract only 5 features of the new area.
@@ -69,13 +79,13 @@ class TheWandererGame:
         self.env_desc = self.llm_model.generate_text([create_message(USER, "Rewrite the environment description in"
                                                                            " a single paragraph: \n"
                                                                      + env_desc_2.replace('wanderer', '').replace(
-            'Wanderer', '').strip()), create_message()])
+            'Wanderer', '').strip()), create_message()], "rewrite")
 
         self.level_conv = (self.init_conv[:-1] + [create_message(content="Provide the questions.")] +
                            [create_message(USER, env_pr), create_message(content=self.env_desc)])
 
-        #Generate new environment image
-        self.generate_env_img()
+        #Generate new environment image, in the background after the first entity line
+        self.submit_env_img()
 
         return self.env_desc
 
@@ -88,9 +98,32 @@ class TheWandererGame:
         Returns:
             entity_exchange (str): The response of the entity.
         """
-        input_conv = self.level_conv + [create_message(USER, dialogue_single_exchange_gen_pr.format(
+        entity_exchange = self.llm_model.generate_text(self._entity_exchange_conv(helpful), "dialogue")
+        return self._add_entity_exchange(entity_exchange, helpful)
+
+    def generate_entity_exchange_stream(self, helpful=True):
+        """ Streaming variant of generate_entity_exchange. Yields the raw text fragments of the response while it is
+        generated, and returns the cleaned response (as returned by generate_entity_exchange) once done.
+
+        Args:
+            helpful (bool): Is it the helpful entity talking?
+
+        Yields:
+            fragment (str): Newly generated text of the raw response.
+        """
+        entity_exchange = ''
+        for fragment in self.llm_model.generate_text_stream(self._entity_exchange_conv(helpful), "dialogue"):
+            entity_exchange += fragment
+            yield fragment
+        return self._add_entity_exchange(entity_exchange, helpful)
+
+    def _entity_exchange_conv(self, helpful):
+        return self.level_conv + [create_message(USER, dialogue_single_exchange_gen_pr.format(
             self.helpful_entity if helpful else self.talking_entity)), create_message()]
-        entity_exchange = self.llm_model.generate_text(input_conv).replace("Assistant:", "").replace('"', '').strip()
+
+    def _add_entity_exchange(self, entity_exchange, helpful):
+        entity_exchange = entity_exchange.replace("Assistant:", "").replace('"', '').strip()
+        self.entity_line_ready.set()  # The area image can start
         # Update the current level chat history
         self.exchange_conv.append(dialogue_entity_response_pr.
                                   format(self.helpful_entity if helpful else self.talking_entity, entity_exchange))
@@ -106,11 +139,31 @@ class TheWandererGame:
         Returns:
             entity_exchange (str): The response of the entity.
         """
-        input_conv = self.level_conv + [create_message(USER, dialogue_single_update_gen_pr.format(
+        entity_exchange = self.llm_model.generate_text(self._entity_update_conv(helpful), "dialogue_echo")
+        return self._add_entity_update(entity_exchange, helpful)
+
+    def update_entity_exchange_stream(self, helpful=True):
+        """ Streaming variant of update_entity_exchange. Yields the raw text fragments of the response while it is
+        generated, and returns the cleaned response (as returned by update_entity_exchange) once done.
+
+        Args:
+            helpful (bool): Is it the helpful entity talking?
+
+        Yields:
+            fragment (str): Newly generated text of the raw response.
+        """
+        entity_exchange = ''
+        for fragment in self.llm_model.generate_text_stream(self._entity_update_conv(helpful), "dialogue_echo"):
+            entity_exchange += fragment
+            yield fragment
+        return self._add_entity_update(entity_exchange, helpful)
+
+    def _entity_update_conv(self, helpful):
+        return self.level_conv + [create_message(USER, dialogue_single_update_gen_pr.format(
             self.get_conv_combined(), self.helpful_entity if helpful else self.talking_entity)), create_message()]
-        entity_exchange = (self.llm_model.generate_text(input_conv).
-                           replace("Assistant:", "").replace('""', '"').
-                           strip())
+
+    def _add_entity_update(self, entity_exchange, helpful):
+        entity_exchange = entity_exchange.replace("Assistant:", "").replace('""', '"').strip()
         logger.debug("The response is: " + entity_exchange)
         # Clean the response. Sometimes the LLM rewrites the entire conversation, or mentions the interlocutor twice.
         try:
@@ -124,18 +177,20 @@ class TheWandererGame:
                                   format(self.helpful_entity if helpful else self.talking_entity, entity_exchange))
         return entity_exchange
 
-    def wanderer_input(self, p_input):
+    def wanderer_input(self, p_input, stream=False):
         """ Handle user input. The wanderer either continues the dialogue with the other talking entity, or moves to
         a new area. This is determined by understanding whether any movement was implied in the input or not. If the
         wanderer is moving, a new area and level are generated.
 
         Args:
             p_input (str): The last input from the user.
+            stream (bool): Return the entity statement as a stream (see generate_entity_exchange_stream) instead of
+                            waiting for the whole statement.
 
         Returns:
             new_env_desc (Optional[str]): The new environment description if movement triggered
                                             a new environment; otherwise, None.
-            entity_exchange (str): A statement told by the entity to the wanderer.
+            entity_exchange (Union[str, Generator]): A statement told by the entity to the wanderer, or its stream.
 
         """
         logger.debug("User inputted: " + str(p_input))
@@ -143,32 +198,101 @@ class TheWandererGame:
         # Update current chat history
         self.exchange_conv.append(dialogue_wanderer_response_pr.format(p_input))
 
-        # Analyze whether any movement was implied by the user
-        result = self.llm_model.generate_text(
-            [create_message(USER, wanderer_input_decision_pr.format(self.exchange_conv[-1])),
-             create_message(ASSISTANT)])
-        result = self.llm_model.generate_text(
-            [create_message(USER, f"If the following text confirm movement, answer '2', else answer '1'. \n {result}"),
-             create_message(ASSISTANT)])
+        # Analyze whether any movement was implied by the user. A single forward pass compares the answers '1'/'2'.
+        result, confidence = self.llm_model.classify(
+            [create_message(USER, wanderer_input_decision_pr.format(self.exchange_conv[-1]) + wanderer_input_choice_pr),
+             create_message(ASSISTANT)], ['1', '2'])
 
-        logger.debug("Analyzing input: '{}'. ".format(p_input) + ' Result: {} -> '.format(
-            result) + ('Dialogue' if '1' in result else 'Movement'))
+        logger.debug("Analyzing input: '{}'. ".format(p_input) + ' Result: {} ({:.0%}) -> '.format(
+            result, confidence) + ('Dialogue' if '1' in result else 'Movement'))
 
         if '2' not in result:  # Continue dialogue
-            return None, self.update_entity_exchange()
+            return None, self.update_entity_exchange_stream() if stream else self.update_entity_exchange()
         else:  # Stop dialogue and change environment
-            return self.update_env_desc(), self.generate_entity_exchange(True)
+            new_env_desc = self.update_env_desc()
+            return new_env_desc, self.generate_entity_exchange_stream(True) if stream \
+                else self.generate_entity_exchange(True)
 
-    def generate_env_img(self):
+    def submit_env_img(self):
+        """ Generates the image of the current area in the background (see generate_env_img), so that the player gets
+        the text first. The image job waits for the first entity line of the area (or ENV_IMG_TEXT_FIRST_TIMEOUT
+        seconds), and its token loop pauses whenever a text call runs. on_env_img is called once the image is ready.
+
+        Returns:
+            future (Future): Resolves to (env_desc, FINAL_IMG_PATH), or None if the player left the area before the
+                image was done. The token loop of an area left meanwhile stops at its next token, to free the worker
+                for the new area.
+        """
+        if self.env_img_future is not None:
+            self.env_img_future.cancel()  # Not started yet, its area is already left
+        # Each area has its own event, so that the line of the new area never releases (or is consumed by) the job
+        # of the previous one. The previous job is released at once, to find out that its area is left.
+        self.entity_line_ready.set()
+        self.entity_line_ready = threading.Event()
+        self.env_img_future = self.env_img_executor.submit(self._env_img_job, self.env_desc, self.entity_line_ready)
+        self.env_img_future.add_done_callback(self._env_img_done)
+        return self.env_img_future
+
+    def _env_img_job(self, env_desc, entity_line_ready):
+        if not entity_line_ready.wait(ENV_IMG_TEXT_FIRST_TIMEOUT):
+            logger.debug("No entity line after {}s, generating the area image".format(ENV_IMG_TEXT_FIRST_TIMEOUT))
+        if env_desc != self.env_desc:
+            logger.debug("Skipping the image of an area already left")
+            return None
+        try:
+            self.generate_env_img(env_desc=env_desc)
+        except ImageGenerationAborted:
+            logger.debug("Stopped the image of an area left during its generation")
+            return None
+        return env_desc, FINAL_IMG_PATH
+
+    def _env_img_done(self, future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            logger.error("Area image generation failed", exc_info=error)
+            return
+        if future.result() is None:
+            return
+        env_desc, file_path = future.result()
+        if env_desc != self.env_desc:
+            logger.debug("Dropping the image of an area left during its generation")
+        elif self.on_env_img is not None:
+            self.on_env_img(file_path)
+
+    def generate_env_img(self, wanderer_desc_pr=None, entity_desc_pr=None, env_desc=None):
         """ After reaching a new area, a new image is generated. The character image is also overlayed on top of the
-        new area. """
+        new area.
+
+        Args:
+            wanderer_desc_pr (str, optional): Also regenerate the Wanderer image from this description, in the same
+                batch as the area image.
+            entity_desc_pr (str, optional): Also regenerate the talking entity image, in the same batch.
+            env_desc (str, optional): Description of the area. Defaults to the current one. A lone area image raises
+                ImageGenerationAborted once the player leaves that area.
+        """
+        env_desc = self.env_desc if env_desc is None else env_desc
         #This next step summarizes the description. It enhances the final image result
         summarized = self.llm_model.generate_text([create_message(USER,
-                                          "Summarize in a single paragraph the area described by: \n" + self.env_desc),
-                                                   create_message()])
+                                          "Summarize in a single paragraph the area described by: \n" + env_desc),
+                                                   create_message()], "rewrite")
         description = 'Draw the area: ' + summarized
         logger.debug("Generating env image with the following description: " + description)
-        self.llm_model.generate_image(description, file_path=ENV_IMG_PATH)
+        descriptions, file_paths, profiles = [description], [ENV_IMG_PATH], ["area"]
+        for desc_pr, file_path in ((wanderer_desc_pr, WANDERER_IMG_PATH), (entity_desc_pr, ENTITY_IMG_PATH)):
+            if desc_pr is not None:
+                descriptions.append(desc_pr + character_white_bkg_pr)
+                file_paths.append(file_path)
+                profiles.append("character")
+        preview = None
+        if self.image_preview is not None:
+            # Previews of an area left meanwhile are not shown over the new one
+            preview = lambda images, num_rows: self.image_preview(Image.fromarray(images[0])) \
+                if env_desc == self.env_desc else None
+        # A lone area image is dropped once its area is left. The character images are needed in any area
+        should_stop = (lambda: env_desc != self.env_desc) if len(descriptions) == 1 else None
+        self.llm_model.generate_images(descriptions, file_paths, profiles, preview=preview, should_stop=should_stop)
 
         background = overlay_image(ENV_IMG_PATH, WANDERER_IMG_PATH, (-20, 150), (300, 300))
         background.save(FINAL_IMG_PATH, format='PNG')
@@ -185,11 +309,18 @@ class TheWandererGame:
             None
         """
         description = wanderer_desc_pr + character_white_bkg_pr
-        self.llm_model.generate_image(description, file_path=WANDERER_IMG_PATH)
+        self.llm_model.generate_image(description, "character", file_path=WANDERER_IMG_PATH)
 
     def generate_talking_entity_img(self, entity_desc_pr="Generate an image of a helpful talking bird"):
         description = entity_desc_pr + character_white_bkg_pr
-        self.llm_model.generate_image(description=description, file_path=ENTITY_IMG_PATH)
+        self.llm_model.generate_image(description=description, profile="character", file_path=ENTITY_IMG_PATH)
+
+    def generate_character_imgs(self, wanderer_desc_pr=default_wanderer_pr,
+                                entity_desc_pr="Generate an image of a helpful talking bird"):
+        """ Generates the Wanderer and the talking entity images together, in a single batch. """
+        self.llm_model.generate_images([wanderer_desc_pr + character_white_bkg_pr,
+                                        entity_desc_pr + character_white_bkg_pr],
+                                       [WANDERER_IMG_PATH, ENTITY_IMG_PATH], "character")
 
     def get_conv_combined(self):
         return ' '.join(self.exchange_conv) + ' '
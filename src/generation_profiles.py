@@ -0,0 +1,67 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+from models.janus.utils.cfg_schedule import CfgSchedule
+from configs.config import TEXT_GEN_MAX_TOKENS, CFG_WEIGHT_IMG, TEXT_GEN_PROFILES, IMG_GEN_PROFILES
+
+
+def closing_quote(text):
+    """Stops once a quoted sentence is closed."""
+    return text.count('"') >= 2
+
+
+def blank_line(text):
+    """Stops at the first blank line after the paragraph started."""
+    return '\n\n' in text.lstrip()
+
+
+STOP_CRITERIA = {
+    "closing_quote": closing_quote,
+    "blank_line": blank_line,
+}
+
+
+@dataclass
+class TextGenProfile:
+    name: str
+    max_new_tokens: int = TEXT_GEN_MAX_TOKENS
+    stop: Optional[str] = None  # Key of STOP_CRITERIA, checked on the decoded reply after every token
+    prompt_lookup: bool = False  # Speculate by copying n-grams of the prompt, for replies that repeat it
+    temperature: float = 0.0  # Greedy up to GREEDY_TEMPERATURE, sampled above (not cached nor speculated)
+    top_k: Optional[int] = None
+    top_p: Optional[float] = None
+
+    @property
+    def stop_criterion(self):
+        return STOP_CRITERIA[self.stop] if self.stop else None
+
+
+@dataclass
+class ImageGenProfile:
+    name: str
+    temperature: float = 0.00001
+    cfg_weight: float = CFG_WEIGHT_IMG
+    parallel_size: int = 1
+    cfg_schedule: str = "constant"  # Key of CFG_SCHEDULES, shape of the guidance weight over the image tokens
+    cfg_interval: Tuple[float, float] = (0.0, 1.0)  # Fractions of the image tokens with guidance, see CfgSchedule
+    top_k: Optional[int] = None  # Sampling of the image tokens, see sample_tokens
+    top_p: Optional[float] = None
+
+    def guidance(self, cfg_weight=None):
+        """ The CfgSchedule of the profile, with cfg_weight overriding the profile weight. """
+        return CfgSchedule(self.cfg_weight if cfg_weight is None else cfg_weight, self.cfg_schedule,
+                           tuple(self.cfg_interval))
+
+
+TEXT_PROFILES = {name: TextGenProfile(name, **params) for name, params in TEXT_GEN_PROFILES.items()}
+IMAGE_PROFILES = {name: ImageGenProfile(name, **params) for name, params in IMG_GEN_PROFILES.items()}
+
+
+def get_text_profile(profile="default"):
+    return profile if isinstance(profile, TextGenProfile) else TEXT_PROFILES[profile]
+
+
+def get_image_profile(profile="default"):
+    return profile if isinstance(profile, ImageGenProfile) else IMAGE_PROFILES[profile]
@@ -0,0 +1,143 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import base64
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from PIL import Image
+from configs.config import IMAGE_ASSET_DIR, IMAGE_ASSET_DECODED_ENTRIES
+from src.log import logger
+
+
+class ImageAssetStore:
+    """ Generated images stored as their VQ token grids. An image is fully described by its 576 codebook ids, about
+    1.2 KB as uint16 against hundreds of KB for the pixels, so every generated image is kept along with its prompt and
+    seed, and decoded again through VQModel.decode_code when it is needed, at any size and file format.
+
+    Assets are indexed by a key hashing the prompt and every parameter the tokens depend on (see make_key), and by
+    seed. Greedy images do not depend on the seed and are stored under the "greedy" seed. Each asset is one JSON file
+    under asset_dir, the decoded pixels of the most recently used assets are kept in an in-memory LRU.
+    """
+
+    def __init__(self, asset_dir=IMAGE_ASSET_DIR, max_decoded=IMAGE_ASSET_DECODED_ENTRIES):
+        self.asset_dir = asset_dir
+        self.max_decoded = max_decoded
+        self.decoded = OrderedDict()  # asset id -> uint8 [H, W, 3]
+        self.index = {}  # key -> {seed: asset id}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.decoded_hits = 0
+        self.decodes = 0
+        self.disk_bytes = 0
+
+        self.asset_dir.mkdir(parents=True, exist_ok=True)
+        for path in self.asset_dir.glob("*/*.json"):
+            key, seed = path.stem.rsplit("-", 1)
+            self.index.setdefault(key, {})[seed] = path.stem
+            self.disk_bytes += path.stat().st_size
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:32]
+
+    def _path(self, asset_id):
+        return self.asset_dir / asset_id[:2] / (asset_id + ".json")
+
+    def find(self, key, seed):
+        """ Returns the asset id of key and seed, or None. """
+        with self.lock:
+            asset_id = self.index.get(key, {}).get(str(seed))
+            if asset_id is not None:
+                self.hits += 1
+            return asset_id
+
+    def put(self, key, seed, tokens, prompt="", image=None, **meta):
+        """ Stores the token grid of an image and returns its asset id.
+
+        Args:
+            key (str): From make_key.
+            seed (Union[int, str]): Seed of the sampling, "greedy" for greedy images.
+            tokens (Union[np.ndarray, torch.Tensor]): [image_token_num_per_image] codebook ids.
+            prompt (str): The image description.
+            image (np.ndarray, optional): The decoded pixels, if already available.
+            meta: Other JSON serializable parameters worth keeping (profile, grid size...).
+        """
+        tokens = np.asarray(tokens.cpu() if hasattr(tokens, "cpu") else tokens, dtype="<u2")
+        asset_id = "{}-{}".format(key, seed)
+        path = self._path(asset_id)
+        path.parent.mkdir(exist_ok=True)
+        with self.lock:
+            old_size = path.stat().st_size if path.exists() else 0
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"prompt": prompt, "seed": seed, "tokens": base64.b64encode(tokens.tobytes()).decode("ascii"),
+                           **meta}, f)
+            os.replace(tmp_path, path)
+            self.disk_bytes += path.stat().st_size - old_size
+            self.index.setdefault(key, {})[str(seed)] = asset_id
+            self.decoded.pop(asset_id, None)
+        if image is not None:
+            self._remember(asset_id, image)
+        return asset_id
+
+    def _remember(self, asset_id, image):
+        with self.lock:
+            self.decoded[asset_id] = image
+            self.decoded.move_to_end(asset_id)
+            while len(self.decoded) > self.max_decoded:
+                self.decoded.popitem(last=False)
+
+    def load(self, asset_id):
+        """ The stored record of asset_id, with its tokens as a uint16 array. """
+        with open(self._path(asset_id), "r", encoding="utf-8") as f:
+            record = json.load(f)
+        record["tokens"] = np.frombuffer(base64.b64decode(record["tokens"]), dtype="<u2")
+        return record
+
+    def tokens(self, asset_id):
+        return self.load(asset_id)["tokens"]
+
+    def image(self, asset_id, decode):
+        """ The pixels of asset_id, decoded on first use.
+
+        Args:
+            asset_id (str): From put or find.
+            decode (Callable): Token ids [n, image_token_num_per_image] -> uint8 images [n, H, W, 3].
+
+        Returns:
+            image (np.ndarray): [H, W, 3] uint8
+        """
+        with self.lock:
+            image = self.decoded.get(asset_id)
+            if image is not None:
+                self.decoded.move_to_end(asset_id)
+                self.decoded_hits += 1
+                return image
+        image = decode(self.tokens(asset_id)[None].astype(np.int64))[0]
+        self.decodes += 1
+        self._remember(asset_id, image)
+        return image
+
+    def export(self, asset_id, file_path, decode, size=None):
+        """ Saves asset_id as an image file, in the format of the file extension, resized to size (w, h) if given. """
+        image = Image.fromarray(self.image(asset_id, decode))
+        if size is not None:
+            image = image.resize(size, Image.LANCZOS)
+        os.makedirs(file_path.parent, exist_ok=True)
+        image.save(file_path)
+        logger.debug("Exported image asset {} to {}".format(asset_id, file_path))
+
+    def stats(self):
+        num_assets = sum(len(seeds) for seeds in self.index.values())
+        return {
+            "assets": num_assets,
+            "disk_bytes": self.disk_bytes,
+            "bytes_per_asset": self.disk_bytes / max(num_assets, 1),
+            "hits": self.hits,
+            "decoded_hits": self.decoded_hits,
+            "decodes": self.decodes,
+        }
@@ -0,0 +1,59 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import time
+from configs.config import IMG_PREVIEW_EVERY_ROWS, IMG_PREVIEW_MAX_OVERHEAD, IMG_PREVIEW_PLACEHOLDER_TOKEN
+from src.log import logger
+
+
+class ImagePreview:
+    """ Progressive previews of the image token loop. The tokens fill the grid row by row, so every every_rows rows
+    the partial grid is decoded, the rows that are not generated yet being drawn with a placeholder token, and the
+    images are passed to callback. The area then materializes from the top while the loop runs.
+
+    A VQ decode costs many decode steps, so a preview is skipped whenever the time spent decoding previews would
+    exceed max_overhead times the time spent in the token loop. The final image is not a preview: the caller decodes
+    it once the grid is complete.
+    """
+
+    def __init__(self, decode, callback, grid_size, every_rows=IMG_PREVIEW_EVERY_ROWS,
+                 max_overhead=IMG_PREVIEW_MAX_OVERHEAD, placeholder=IMG_PREVIEW_PLACEHOLDER_TOKEN):
+        """
+        Args:
+            decode (Callable): Image tokens [n, grid_size ** 2] -> uint8 images [n, H, W, 3].
+            callback (Callable): Called with the preview images [n, H, W, 3] and the number of generated rows.
+            grid_size (int): Tokens per row of the grid (img_size // patch_size).
+            every_rows (int): Rows between two previews, 0 disables the previews.
+            max_overhead (float): Bound of the preview decoding time, as a fraction of the token loop time.
+            placeholder (int): Token id of the rows not generated yet.
+        """
+        self.decode = decode
+        self.callback = callback
+        self.grid_size = grid_size
+        self.every_tokens = every_rows * grid_size
+        self.max_overhead = max_overhead
+        self.placeholder = placeholder
+        self.start = time.perf_counter()
+        self.preview_seconds = 0.
+        self.previews = 0
+        self.skipped = 0
+
+    def __call__(self, generated_tokens, num_tokens):
+        """ Token callback of ImageTokenGenerator.generate. """
+        if not self.every_tokens or num_tokens % self.every_tokens or num_tokens == generated_tokens.shape[1]:
+            return
+        loop_seconds = time.perf_counter() - self.start - self.preview_seconds
+        if self.preview_seconds > self.max_overhead * loop_seconds:
+            self.skipped += 1
+            return
+        start = time.perf_counter()
+        partial = generated_tokens.clone()
+        partial[:, num_tokens:] = self.placeholder
+        self.callback(self.decode(partial), num_tokens // self.grid_size)
+        self.preview_seconds += time.perf_counter() - start
+        self.previews += 1
+
+    def log_stats(self):
+        logger.debug("{} image previews in {:.2f}s ({:.1%} of the token loop), {} skipped".format(
+            self.previews, self.preview_seconds,
+            self.preview_seconds / max(time.perf_counter() - self.start - self.preview_seconds, 1e-9), self.skipped))
@@ -3,14 +3,37 @@
 
 from PIL import Image
 import torch
-from transformers import AutoModelForCausalLM
+import time
+from transformers import DynamicCache
 from models.janus.models import MultiModalityCausalLM, VLChatProcessor
+from models.janus.utils.device import resolve_device, resolve_dtype, configure_cpu_threads
+from models.janus.utils.io import load_vl_gpt, load_image_modules
+from models.janus.utils.image_generation import get_image_token_generator
+from models.janus.utils.quantization import quantize_model, model_nbytes
+from models.janus.utils.sampling import GREEDY_TEMPERATURE, sample_tokens
 import random
 import os
+import functools
+import inspect
+import threading
+from contextlib import contextmanager
 import numpy as np
 from pathlib import Path
 from src.log import logger
-from configs.config import BASE_DIR, MODEL_PATH, TEXT_GEN_MAX_TOKENS, CFG_WEIGHT_IMG, FINAL_IMG_PATH, MODEL_NAME
+from src.prefix_cache import RadixPrefixCache
+from src.generation_profiles import get_text_profile, get_image_profile
+from src.response_cache import ResponseCache
+from src.tokenized_conversation import TokenizedConversation
+from src.residency import ResidencyManager
+from src.image_preview import ImagePreview
+from src.image_assets import ImageAssetStore
+from src.speculative import DraftModelProposer, PromptLookupProposer, SpeculativeStats, speculative_greedy_steps
+from dataclasses import astuple, replace
+from configs.config import BASE_DIR, MODEL_PATH, FINAL_IMG_PATH, MODEL_NAME, MODEL_ID, PREFIX_CACHE_MAX_BYTES, \
+    RESPONSE_CACHE_DIR, DRAFT_MODEL_ID, DRAFT_MODEL_PATH, SPECULATIVE_NUM_DRAFT_TOKENS, PROMPT_LOOKUP_NUM_TOKENS, \
+    PROMPT_LOOKUP_MAX_NGRAM, DEVICE, DTYPE, CPU_NUM_THREADS, ATTN_IMPLEMENTATION, QUANTIZATION, TEXT_ONLY, \
+    IMG_GEN_COMPILE, IMG_GEN_CACHE_BUCKET, IMG_PREFIX_CACHE_MAX_BYTES, IMAGE_ASSET_DIR, \
+    IMG_PREFIX_MIN_REUSE
 from huggingface_hub import snapshot_download
 
 USER = '<|User|>'
@@ -21,88 +44,555 @@ def create_message(role: str = ASSISTANT, content: str = "") -> dict:
     return {"role": role, "content": content}
 
 
+class IncrementalDecoder:
+    """ Decodes a stream of token ids into text fragments.
+
+    Decoding tokens one by one breaks both multi-token characters (byte-fallback pieces decode to U+FFFD until the
+    character is complete) and the leading spaces that depend on the previous token. Each new token is therefore
+    decoded together with the tokens of the previous fragment, and only the added text is returned once it does not
+    end with an incomplete character.
+    """
+
+    def __init__(self, tokenizer, skip_special_tokens=True):
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.token_ids = []
+        self.prefix_offset = 0  # Start of the tokens decoded as context
+        self.read_offset = 0  # End of the tokens already returned as text
+
+    def _decode(self, token_ids):
+        return self.tokenizer.decode(token_ids, skip_special_tokens=self.skip_special_tokens)
+
+    def push(self, token_id):
+        """ Returns the text added by token_id, or '' when it has to wait for the next tokens. """
+        self.token_ids.append(token_id)
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+    def flush(self):
+        """ Returns the text still held back at the end of the stream. """
+        prefix_text = self._decode(self.token_ids[self.prefix_offset:self.read_offset])
+        new_text = self._decode(self.token_ids[self.prefix_offset:])
+        self.prefix_offset = self.read_offset = len(self.token_ids)
+        return new_text[len(prefix_text):]
+
+
+class ImageGenerationAborted(Exception):
+    """ Raised by the image token loop when its should_stop callable returns True. """
+
+
+def text_call(method):
+    """ Runs a text method of MultimodalLlm in a text turn (see MultimodalLlm.text_turn). Generator methods hold the
+    turn for their whole iteration. """
+    if inspect.isgeneratorfunction(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.text_turn():
+                return (yield from method(self, *args, **kwargs))
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.text_turn():
+                return method(self, *args, **kwargs)
+    return wrapper
+
+
 class MultimodalLlm:
-    def __init__(self, model_path=MODEL_PATH):
+    def __init__(self, model_path=MODEL_PATH, vl_gpt=None, vl_chat_processor=None, model_id=MODEL_ID,
+                 quantization=QUANTIZATION, text_only=TEXT_ONLY):
+        """
+        Args:
+            model_path (Path): Local directory of the Janus model. Downloaded from MODEL_NAME if missing.
+            vl_gpt (MultiModalityCausalLM, optional): An already built model. Skips loading from model_path
+                (e.g. the tiny random model of src.benchmark).
+            vl_chat_processor (VLChatProcessor, optional): Processor to use along with vl_gpt.
+            model_id (str): Identifies the weights in the response cache keys. None disables the response cache and
+                the image asset store.
+            quantization (str, optional): "int8_dynamic" or "int8_weight_only", see QUANTIZATION.
+            text_only (bool): Only load the language model from model_path. The image submodules are loaded by the
+                first generate_image call.
+        """
+        self.model_path = model_path
+        if vl_gpt is not None:
+            self.vl_chat_processor = vl_chat_processor
+            self.tokenizer = vl_chat_processor.tokenizer if vl_chat_processor is not None else None
+            self.vl_gpt = vl_gpt.eval()
+        else:
+            self.load_model(model_path, text_only)
+        self.text_only = vl_gpt is None and text_only  # Load mode, part of the response cache keys
+        self.quantization = quantization
+        if quantization is not None:
+            nbytes = model_nbytes(self.vl_gpt)
+            quantize_model(self.vl_gpt, quantization)
+            logger.info("Quantized the model ({}): {:.2f} GB -> {:.2f} GB".format(
+                quantization, nbytes / 2 ** 30, model_nbytes(self.vl_gpt) / 2 ** 30))
+        self.residency = ResidencyManager(self.vl_gpt)
+        self.model_id = model_id
+        self.prefix_cache = RadixPrefixCache(PREFIX_CACHE_MAX_BYTES) if PREFIX_CACHE_MAX_BYTES > 0 else None
+        # Prompt KV of the CFG rows: unconditional rows of every length and the shared wrappers of the image prompts
+        self.image_prefix_cache = RadixPrefixCache(IMG_PREFIX_CACHE_MAX_BYTES) if IMG_PREFIX_CACHE_MAX_BYTES > 0 \
+            else None
+        self.image_prefill_saved_seconds = 0.
+        self.image_batched_prefill_rate = None  # Seconds per token of the last batched image prefill
+        self.image_assets = ImageAssetStore() if IMAGE_ASSET_DIR is not None and model_id is not None else None
+        self.last_asset_ids = []  # Asset ids of the images of the last generate_image(s) call
+        # Text calls of different threads run one at a time, and the image token loop pauses while one runs or waits
+        self.text_lock = threading.RLock()
+        self._text_calls = threading.Condition()
+        self._num_text_calls = 0
+        self.image_paused_seconds = 0.  # Time the image token loop spent waiting for text calls
+        self.response_cache = ResponseCache() if RESPONSE_CACHE_DIR is not None and model_id is not None else None
+        self.segment_cache = {}  # Token ids of conversation messages, shared by all encode_conversation calls
+        self.draft_model = None
+        self.num_draft_tokens = SPECULATIVE_NUM_DRAFT_TOKENS
+        self.speculative_stats = SpeculativeStats()
+        if vl_gpt is None and DRAFT_MODEL_ID:
+            self.set_draft_model(self.load_vl_gpt(DRAFT_MODEL_PATH, "deepseek-ai/" + DRAFT_MODEL_ID, text_only=True))
+        self.eos_token_id = (self.tokenizer.eos_token_id if self.tokenizer is not None
+                             else self.vl_gpt.language_model.config.eos_token_id)
+
+    @property
+    def device(self):
+        """ Device of the language model, where the text and image token inputs go. Not vl_gpt.device: that is the
+        device of its first parameter, in the vision tower, which the residency manager may offload. """
+        return self.vl_gpt.language_model.device
+
+    def load_model(self, model_path=MODEL_PATH, text_only=False):
+        self.vl_gpt = self.load_vl_gpt(model_path, MODEL_NAME, text_only=text_only)
+        self.vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(model_path)
+        self.tokenizer = self.vl_chat_processor.tokenizer
+
+    @staticmethod
+    def load_vl_gpt(model_path, model_name, device=DEVICE, dtype=DTYPE, text_only=False):
+        """ Loads a Janus model from model_path, downloading model_name first if needed.
+
+        Args:
+            model_path (Path): Local directory of the model.
+            model_name (str): Hugging Face repository of the model.
+            device (str): "cuda", "cpu" or "auto", see DEVICE.
+            dtype (str): Weights dtype or "auto", see DTYPE.
+            text_only (bool): Only build and load the language model.
+        """
         if model_path.exists() and any(model_path.iterdir()) and (model_path/'preprocessor_config.json').exists():
             logger.info("Model files found")
         else:
             logger.info("Model files not found. Downloading..")
             model_path.mkdir(parents=True, exist_ok=True)
-            snapshot_download(repo_id=MODEL_NAME, local_dir=str(model_path), local_dir_use_symlinks=False)
-
-        self.vl_chat_processor: VLChatProcessor = VLChatProcessor.from_pretrained(model_path)
-        self.tokenizer = self.vl_chat_processor.tokenizer
-
-        self.vl_gpt: MultiModalityCausalLM = AutoModelForCausalLM.from_pretrained(
-            model_path, trust_remote_code=True
-        )
-        self.vl_gpt = self.vl_gpt.to(torch.bfloat16).cuda().eval()
-
-    def generate_text(self, conversation):
-        #The different way of generating embeddings bellow was found to generate better results than the commented one.
-        sft_format = self.vl_chat_processor.apply_sft_template_for_multi_turn_prompts(
+            snapshot_download(repo_id=model_name, local_dir=str(model_path), local_dir_use_symlinks=False)
+
+        device = resolve_device(device)
+        dtype = resolve_dtype(dtype, device)
+        if device.type == "cpu":
+            logger.info("Running on cpu with {} threads".format(configure_cpu_threads(CPU_NUM_THREADS)))
+        start = time.perf_counter()
+        vl_gpt: MultiModalityCausalLM = load_vl_gpt(model_path, device, dtype, ATTN_IMPLEMENTATION, text_only)
+        logger.info("Loaded {}{} on {} ({}, {} attention) in {:.1f}s, {:.2f} GB".format(
+            model_name, " (text only)" if text_only else "", device, dtype, ATTN_IMPLEMENTATION,
+            time.perf_counter() - start, model_nbytes(vl_gpt) / 2 ** 30))
+        return vl_gpt
+
+    def ensure_image_modules(self):
+        """ Loads the image submodules of a text only model. """
+        if not self.vl_gpt.text_only:
+            return
+        start = time.perf_counter()
+        load_image_modules(self.vl_gpt, self.model_path)
+        if self.quantization is not None:
+            quantize_model(self.vl_gpt, self.quantization)
+        self.residency.enforce_budget()
+        logger.info("Loaded the image submodules in {:.1f}s".format(time.perf_counter() - start))
+
+    def prefetch_image_modules(self):
+        """ Hint that an image is about to be generated. Moves the offloaded image generation submodules back to the
+        accelerator in the background. """
+        self.residency.prefetch("gen_head", "gen_aligner", "gen_embed")
+
+    def image_generator(self, parallel_size, length):
+        """ Returns the image token generator whose static KV cache fits length positions, reused across calls. """
+        # CUDA graphs keep the addresses of the weights, which offloading would move
+        return get_image_token_generator(self.vl_gpt, parallel_size, length, IMG_GEN_CACHE_BUCKET,
+                                         compile=IMG_GEN_COMPILE, cuda_graphs=self.residency.max_bytes is None)
+
+    def set_draft_model(self, draft_model, num_draft_tokens=SPECULATIVE_NUM_DRAFT_TOKENS):
+        """ Enables speculative decoding of the text replies with a small draft model.
+
+        Args:
+            draft_model (Union[MultiModalityCausalLM, LlamaForCausalLM]): Model sharing the tokenizer of the main model.
+                Only its language model is kept.
+            num_draft_tokens (int): Tokens proposed by the draft model per verification step.
+        """
+        draft_model = getattr(draft_model, "language_model", draft_model)
+        if draft_model.config.vocab_size != self.vl_gpt.language_model.config.vocab_size:
+            raise ValueError("The draft model must share the vocabulary of the main model.")
+        self.draft_model = draft_model.eval()
+        self.num_draft_tokens = num_draft_tokens
+
+    def sft_prompt(self, conversation):
+        """ Applies the SFT template to the conversation. """
+        #Encoding the sft template directly was found to generate better results than going through the processor
+        # (vl_chat_processor(...) + prepare_inputs_embeds).
+        return self.vl_chat_processor.apply_sft_template_for_multi_turn_prompts(
             conversations=conversation,
             sft_format=self.vl_chat_processor.sft_format,
             system_prompt="",
         )
 
-        # Encode the text
-        input_ids = self.vl_chat_processor.tokenizer.encode(sft_format, return_tensors="pt").to(self.vl_gpt.device)
-
-        # Ensure batch dimension is present
-        if len(input_ids.shape) == 1:
-            input_ids = input_ids.unsqueeze(0)  # Shape: [1, seq_len]
-
-        # Create attention mask (all ones, assuming no padding)
-        attention_mask = torch.ones_like(input_ids).to(self.vl_gpt.device)
+    def encode_conversation(self, conversation):
+        """ Applies the SFT template to the conversation and tokenizes it. Messages already seen in previous calls are
+        not tokenized again (see TokenizedConversation), the ids are the same as encoding sft_prompt(conversation).
+
+        Returns:
+            input_ids (List[int]): The prompt token ids.
+        """
+        return TokenizedConversation.from_messages(self.tokenizer, conversation, self.vl_chat_processor.sft_format,
+                                                   segment_cache=self.segment_cache).get_prompt_ids()
+
+    def _response_key(self, sft_format, profile):
+        """ Response cache key of a greedy reply, None when the response cache is disabled or the profile samples. """
+        if self.response_cache is None or profile.temperature > GREEDY_TEMPERATURE:
+            return None
+        return self.response_cache.make_key(self.model_id, str(self.vl_gpt.dtype), self.quantization, self.text_only,
+                                            sft_format, astuple(profile))
+
+    def _cached_response(self, key):
+        response = self.response_cache.get(key) if key is not None else None
+        if response is not None:
+            logger.debug("Response cache hit ({})".format(self.response_cache.stats()))
+        return response
+
+    @contextmanager
+    def text_turn(self):
+        """ Serializes the text calls of different threads, which share the prefix and response caches. Image token
+        loops running in the background (e.g. the area image) pause between two tokens until no text call is running
+        or waiting, so that the text the player waits for comes first. """
+        with self._text_calls:
+            self._num_text_calls += 1
+        try:
+            with self.text_lock:
+                yield
+        finally:
+            with self._text_calls:
+                self._num_text_calls -= 1
+                self._text_calls.notify_all()
+
+    def wait_for_text(self):
+        """ Blocks while text calls are running or waiting. Returns the seconds waited. """
+        with self._text_calls:
+            if not self._num_text_calls:
+                return 0.
+            start = time.perf_counter()
+            self._text_calls.wait_for(lambda: not self._num_text_calls)
+            return time.perf_counter() - start
+
+    @text_call
+    def generate_text(self, conversation, profile="default"):
+        """ Greedy reply to the conversation. Replies are memoized in the response cache, so identical prompts (e.g.
+        the opening area of a new game) are only generated once.
+
+        Args:
+            conversation (List[dict]): The conversation, ending with an empty assistant message.
+            profile (Union[str, TextGenProfile]): Generation profile of the call site (token budget and stop criterion).
+
+        Returns:
+            answer (str): The reply.
+        """
+        profile = get_text_profile(profile)
+        sft_format = self.sft_prompt(conversation)
+        key = self._response_key(sft_format, profile)
+        answer = self._cached_response(key)
+        if answer is not None:
+            return answer
+
+        input_ids = torch.LongTensor([self.encode_conversation(conversation)]).to(self.device)
+        output_ids = self.generate_ids(input_ids, profile=profile)
+        answer = self.tokenizer.decode(output_ids, skip_special_tokens=True)
+        if key is not None:
+            self.response_cache.put(key, answer, sft_format)
+        return answer
 
-        # Convert input_ids to embeddings
-        inputs_embeds = self.vl_gpt.language_model.get_input_embeddings()(input_ids)
+    @text_call
+    def generate_text_stream(self, conversation, profile="default"):
+        """ Streaming variant of generate_text. The concatenation of the yielded fragments is the reply.
+        A memoized reply is yielded at once.
+
+        Yields:
+            fragment (str): Newly decoded text, as soon as it forms complete characters.
+        """
+        profile = get_text_profile(profile)
+        sft_format = self.sft_prompt(conversation)
+        key = self._response_key(sft_format, profile)
+        answer = self._cached_response(key)
+        if answer is not None:
+            yield answer
+            return
+
+        input_ids = torch.LongTensor([self.encode_conversation(conversation)]).to(self.device)
+        decoder = IncrementalDecoder(self.tokenizer)
+        answer = ''
+        for token_id in self.iter_generate_ids(input_ids, profile=profile):
+            fragment = decoder.push(token_id)
+            if fragment:
+                answer += fragment
+                yield fragment
+        fragment = decoder.flush()
+        if fragment:
+            answer += fragment
+            yield fragment
+        if key is not None:
+            self.response_cache.put(key, answer, sft_format)
+
+    @text_call
+    def generate_text_batch(self, conversations, profile="default"):
+        """ Generates the replies of several independent conversations in a single batch.
+
+        Args:
+            conversations (List[List[dict]]): The conversations, each one as accepted by generate_text.
+            profile (Union[str, TextGenProfile]): Generation profile shared by all the rows.
+
+        Returns:
+            answers (List[str]): The replies, in the same order as conversations.
+        """
+        profile = get_text_profile(profile)
+        sft_formats = [self.sft_prompt(c) for c in conversations]
+        keys = [self._response_key(sft_format, profile) for sft_format in sft_formats]
+        answers = [self._cached_response(key) for key in keys]
+        missing = [i for i, answer in enumerate(answers) if answer is None]
+        if missing:
+            output_ids = self.generate_ids_batch([self.encode_conversation(conversations[i]) for i in missing],
+                                                 profile=profile)
+            for i, ids in zip(missing, output_ids):
+                answers[i] = self.tokenizer.decode(ids, skip_special_tokens=True)
+                if keys[i] is not None:
+                    self.response_cache.put(keys[i], answers[i], sft_formats[i])
+        return answers
+
+    def generate_ids(self, input_ids, max_new_tokens=None, use_cache=True, ignore_eos=False, profile="default",
+                     speculative=True, generator=None):
+        """ Decoding of a single prompt, see iter_generate_ids.
+
+        Returns:
+            output_ids (List[int]): The generated token ids, EOS excluded.
+        """
+        return list(self.iter_generate_ids(input_ids, max_new_tokens, use_cache, ignore_eos, profile, speculative,
+                                           generator))
+
+    def _cached_prefix(self, input_ids):
+        """ Returns the KV cache to start from and the prompt ids that still have to be prefilled. """
+        if self.prefix_cache is not None:
+            matched, cached = self.prefix_cache.lookup(input_ids[0].tolist())
+            if cached is not None:
+                return cached, input_ids[:, matched:]
+        return DynamicCache(), input_ids
 
-        outputs = self.vl_gpt.language_model.generate(
-            inputs_embeds=inputs_embeds,
-            attention_mask=attention_mask,  # Pass the mask explicitly
-            pad_token_id=self.tokenizer.eos_token_id,
-            bos_token_id=self.tokenizer.bos_token_id,
-            eos_token_id=self.tokenizer.eos_token_id,
-            max_new_tokens=TEXT_GEN_MAX_TOKENS,
-            do_sample=False,
-            use_cache=False,
-        )
+    @torch.inference_mode()
+    def next_token_logits(self, input_ids):
+        """ Runs a single prefill of the prompt and returns the logits of the next token.
+
+        Args:
+            input_ids (torch.LongTensor): [1, seq_len] prompt token ids.
+
+        Returns:
+            logits (torch.Tensor): [vocab_size]
+        """
+        language_model = self.vl_gpt.language_model
+        past_key_values, step_ids = self._cached_prefix(input_ids)
+        outputs = language_model.model(input_ids=step_ids, past_key_values=past_key_values, use_cache=True)
+        if self.prefix_cache is not None:
+            self.prefix_cache.insert(input_ids[0].tolist(), past_key_values)
+        return language_model.lm_head(outputs.last_hidden_state[:, -1, :])[0]
+
+    @text_call
+    def classify(self, conversation, choices):
+        """ Picks the answer of the conversation among choices from the next token logits, in one forward pass
+        instead of generating a reply and parsing it.
+
+        Each choice is scored by the probability mass of its first token, with or without a leading space. Tokens
+        shared by several choices are ignored, so the choices must start differently (e.g. '1' and '2').
+
+        Args:
+            conversation (List[dict]): The conversation, ending with an empty assistant message.
+            choices (List[str]): The candidate answers.
+
+        Returns:
+            label (str): The most likely choice.
+            confidence (float): Its probability, normalized over the choices.
+        """
+        candidates = [{self.tokenizer.encode(text, add_special_tokens=False)[0] for text in (choice, ' ' + choice)}
+                      for choice in choices]
+        shared = {token_id for i, token_ids in enumerate(candidates) for j, other in enumerate(candidates)
+                  if i != j for token_id in token_ids & other}
+        candidates = [token_ids - shared for token_ids in candidates]
+        for choice, token_ids in zip(choices, candidates):
+            if not token_ids:
+                raise ValueError(f"Choice '{choice}' cannot be told apart from the others by its first token.")
+
+        input_ids = torch.LongTensor([self.encode_conversation(conversation)]).to(self.device)
+        logits = self.next_token_logits(input_ids).float()
+        scores = torch.stack([torch.logsumexp(logits[list(token_ids)], dim=0) for token_ids in candidates])
+        probs = torch.softmax(scores, dim=0)
+        best = int(torch.argmax(probs))
+        return choices[best], probs[best].item()
 
-        # prepare_inputs = self.vl_chat_processor(
-        #     conversations=conversation,
-        #     images = [],
-        #     force_batchify=True
-        # ).to(self.vl_gpt.device)
-        #
-        # inputs_embeds = self.vl_gpt.prepare_inputs_embeds(**prepare_inputs)
-        #
-        # outputs = self.vl_gpt.language_model.generate(
-        #     inputs_embeds=inputs_embeds,
-        #     attention_mask=prepare_inputs.attention_mask,
-        #     pad_token_id=self.tokenizer.eos_token_id,
-        #     bos_token_id=self.tokenizer.bos_token_id,
-        #     eos_token_id=self.tokenizer.eos_token_id,
-        #     max_new_tokens=TEXT_GEN_MAX_TOKENS,
-        #     do_sample=True,
-        #     temperature=0.005,
-        #     use_cache=False,
-        # )
-
-        answer = self.tokenizer.decode(outputs[0].cpu().tolist(), skip_special_tokens=True)
-        return answer
+    @torch.inference_mode()
+    def iter_generate_ids(self, input_ids, max_new_tokens=None, use_cache=True, ignore_eos=False, profile="default",
+                          speculative=True, generator=None):
+        """ Decoding of a single prompt, greedy unless the profile sets a sampling temperature. With use_cache the
+        prompt is prefilled once and every following step only feeds the last token against the KV cache, instead of
+        recomputing attention over the whole sequence. All greedy paths produce the same tokens as
+        language_model.generate(do_sample=False).
+        When the prefix cache is enabled, only the part of the prompt that is not already cached is prefilled.
+        With speculative decoding, proposals of the draft model, or n-grams copied from the prompt when the profile
+        enables prompt_lookup, are verified several tokens per forward pass.
+
+        Args:
+            input_ids (torch.LongTensor): [1, seq_len] prompt token ids.
+            max_new_tokens (int, optional): Maximum number of generated tokens. Defaults to the profile budget.
+            use_cache (bool): Reuse the KV cache between steps. False is kept for benchmarking against the old path.
+            ignore_eos (bool): Keep decoding after EOS (used by the benchmarks to get fixed length outputs).
+            profile (Union[str, TextGenProfile]): Generation profile. Its stop criterion is checked on the decoded
+                reply after every token, the token that satisfies it is the last one yielded.
+            speculative (bool): Use prompt lookup or the draft model, if any. Greedy profiles only.
+            generator (torch.Generator, optional): Random generator of a sampling profile.
+
+        Yields:
+            token_id (int): The generated token ids as soon as they are produced, EOS excluded.
+        """
+        profile = get_text_profile(profile)
+        max_new_tokens = max_new_tokens or profile.max_new_tokens
+        stop_criterion = profile.stop_criterion
+        decoder, text = IncrementalDecoder(self.tokenizer) if stop_criterion else None, ''
+        past_key_values, step_ids = self._cached_prefix(input_ids) if use_cache else (None, input_ids)
+        stats, proposer = None, None
+        speculative = speculative and use_cache and profile.temperature <= GREEDY_TEMPERATURE
+        if speculative and profile.prompt_lookup:
+            proposer = PromptLookupProposer(input_ids[0].tolist(), PROMPT_LOOKUP_NUM_TOKENS, PROMPT_LOOKUP_MAX_NGRAM)
+        elif speculative and self.draft_model is not None:
+            proposer = DraftModelProposer(self.draft_model, input_ids[0].tolist(), self.num_draft_tokens)
+        if proposer is not None:
+            stats = SpeculativeStats()
+            steps = speculative_greedy_steps(self.vl_gpt.language_model, step_ids, past_key_values, proposer, stats)
+        else:
+            steps = self._sample_steps(step_ids, past_key_values, use_cache, profile, generator)
+
+        output_ids = []
+        stop_reason = "max_new_tokens"
+        start = time.perf_counter()
+        first_token_time = None
+        for token_id in steps:
+            if token_id == self.eos_token_id and not ignore_eos:
+                stop_reason = "eos"
+                break
+            output_ids.append(token_id)
+            if first_token_time is None:
+                first_token_time = time.perf_counter() - start
+            yield token_id
+            if stop_criterion is not None:
+                text += decoder.push(token_id)
+                if stop_criterion(text):
+                    stop_reason = profile.stop
+                    break
+            if len(output_ids) >= max_new_tokens:
+                break
+        steps.close()
+
+        if use_cache and self.prefix_cache is not None:
+            self.prefix_cache.insert(input_ids[0].tolist() + output_ids, past_key_values)
+        elapsed = time.perf_counter() - start
+        logger.debug("[{}] Generated {} tokens in {:.2f}s ({:.1f} tokens/s, first token after {:.2f}s, cache={}), "
+                     "stopped by {}".format(profile.name, len(output_ids), elapsed,
+                                            len(output_ids) / max(elapsed, 1e-9), first_token_time or elapsed,
+                                            use_cache, stop_reason))
+        if stats is not None:
+            self.speculative_stats.add(stats)
+            logger.debug("[{}] Speculative decoding ({}): {}".format(profile.name, type(proposer).__name__, stats))
+
+    def _sample_steps(self, step_ids, past_key_values, use_cache, profile, generator=None):
+        """ Yields the continuation one forward pass per token, EOS included, sampled as set by the profile. """
+        language_model = self.vl_gpt.language_model
+        while True:
+            outputs = language_model.model(input_ids=step_ids, past_key_values=past_key_values, use_cache=use_cache)
+            next_token = sample_tokens(language_model.lm_head(outputs.last_hidden_state[:, -1, :]), profile.temperature,
+                                       profile.top_k, profile.top_p, generator).unsqueeze(-1)
+            yield next_token.item()
+            step_ids = next_token if use_cache else torch.cat([step_ids, next_token], dim=-1)
 
     @torch.inference_mode()
-    def generate_image(self,
-                       description: str,
-                       temperature: float = 0.00001,
-                       parallel_size: int = 1,
-                       cfg_weight: float = CFG_WEIGHT_IMG,
-                       image_token_num_per_image: int = 576,
-                       img_size: int = 384,
-                       patch_size: int = 16,
-                       file_path: Path = BASE_DIR / 'images' / 'img.jpg'):
+    def generate_ids_batch(self, prompts, max_new_tokens=None, ignore_eos=False, profile="default", generators=None):
+        """ KV-cached decoding of several prompts of different lengths, greedy unless the profile sets a sampling
+        temperature. The prompts are left padded, like in VLChatProcessor.batchify, so that the next token of every
+        row is always at the last position. Padding is excluded through the attention mask and the position ids. Rows
+        that reached EOS keep being fed a pad token until every row is finished.
+
+        Args:
+            prompts (List[List[int]]): Prompt token ids of each row.
+            max_new_tokens (int, optional): Maximum number of generated tokens per row. Defaults to the profile budget.
+            ignore_eos (bool): Keep decoding after EOS.
+            profile (Union[str, TextGenProfile]): Generation profile, its stop criterion is checked per row.
+            generators (List[torch.Generator], optional): Random generator of each row, for sampling profiles.
+
+        Returns:
+            output_ids (List[List[int]]): The generated token ids of each row, EOS excluded, in input order.
+        """
+        profile = get_text_profile(profile)
+        max_new_tokens = max_new_tokens or profile.max_new_tokens
+        stop_criterion = profile.stop_criterion
+        language_model = self.vl_gpt.language_model
+        device = self.device
+        batch_size = len(prompts)
+        max_len = max(len(prompt) for prompt in prompts)
+        pad_id = self.eos_token_id
+
+        input_ids = torch.full((batch_size, max_len), pad_id, dtype=torch.long)
+        attention_mask = torch.zeros((batch_size, max_len), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            # left-padding
+            input_ids[i, max_len - len(prompt):] = torch.LongTensor(prompt)
+            attention_mask[i, max_len - len(prompt):] = 1
+        input_ids, attention_mask = input_ids.to(device), attention_mask.to(device)
+        position_ids = (attention_mask.cumsum(-1) - 1).masked_fill_(attention_mask == 0, 1)
+
+        past_key_values = DynamicCache()
+        finished = torch.zeros(batch_size, dtype=torch.bool, device=device)
+        output_ids = [[] for _ in range(batch_size)]
+        decoders = [IncrementalDecoder(self.tokenizer) for _ in range(batch_size)] if stop_criterion else None
+        texts = [''] * batch_size
+        stopped = 0
+        step_ids = input_ids
+        start = time.perf_counter()
+        for _ in range(max_new_tokens):
+            outputs = language_model.model(input_ids=step_ids, attention_mask=attention_mask,
+                                           position_ids=position_ids, past_key_values=past_key_values, use_cache=True)
+            logits = language_model.lm_head(outputs.last_hidden_state[:, -1, :])
+            next_tokens = sample_tokens(logits, profile.temperature, profile.top_k, profile.top_p,
+                                        generators).masked_fill_(finished, pad_id)
+            if not ignore_eos:
+                finished |= next_tokens == self.eos_token_id
+            for i, (token_id, done) in enumerate(zip(next_tokens.tolist(), finished.tolist())):
+                if not done:
+                    output_ids[i].append(token_id)
+                    if stop_criterion is not None:
+                        texts[i] += decoders[i].push(token_id)
+                        if stop_criterion(texts[i]):
+                            finished[i] = True
+                            stopped += 1
+            if finished.all():
+                break
+            step_ids = next_tokens.unsqueeze(-1)
+            attention_mask = torch.cat([attention_mask, attention_mask.new_ones((batch_size, 1))], dim=-1)
+            position_ids = position_ids[:, -1:] + 1
+
+        elapsed = time.perf_counter() - start
+        num_tokens = sum(len(ids) for ids in output_ids)
+        logger.debug("[{}] Generated {} tokens over {} rows in {:.2f}s ({:.1f} tokens/s), {} rows stopped by {}".format(
+            profile.name, num_tokens, batch_size, elapsed, num_tokens / max(elapsed, 1e-9), stopped, profile.stop))
+        return output_ids
+
+    def image_prompt_ids(self, description):
+        """ Token ids of the image generation prompt of description, ending with the image start tag. """
         conversation = [
             {
                 "role": USER,
@@ -117,48 +607,265 @@ class MultimodalLlm:
             system_prompt="",
         ) + self.vl_chat_processor.image_start_tag
 
-        input_ids = self.vl_chat_processor.tokenizer.encode(prompt)
-        input_ids = torch.LongTensor(input_ids)
-
-        tokens = torch.zeros((parallel_size * 2, len(input_ids)), dtype=torch.int).cuda()
-        for i in range(parallel_size * 2):
-            tokens[i, :] = input_ids
-            if i % 2 != 0:
-                tokens[i, 1:-1] = self.vl_chat_processor.pad_id
-
+        return self.vl_chat_processor.tokenizer.encode(prompt)
+
+    def cfg_batch(self, prompts):
+        """ Classifier-free guidance rows of one image per prompt. Row 2 * i is prompt i and row 2 * i + 1 its
+        unconditional version, where everything but the first and the last token (BOS and the image start tag) is
+        replaced by the pad token. Both rows of a pair have the same length and shorter pairs are left padded.
+
+        Args:
+            prompts (List[List[int]]): Prompt token ids of each image.
+
+        Returns:
+            tokens (torch.IntTensor): [len(prompts) * 2, max_len]
+            attention_mask (Optional[torch.LongTensor]): [len(prompts) * 2, max_len] 0 on the left padding, None if
+                all the prompts have the same length.
+        """
+        pad_id = self.vl_chat_processor.pad_id
+        max_len = max(len(prompt) for prompt in prompts)
+        tokens = torch.full((len(prompts) * 2, max_len), pad_id, dtype=torch.int)
+        attention_mask = torch.zeros((len(prompts) * 2, max_len), dtype=torch.long)
+        for i, prompt in enumerate(prompts):
+            # left-padding
+            tokens[2 * i, max_len - len(prompt):] = torch.IntTensor(prompt)
+            tokens[2 * i + 1, max_len - len(prompt)] = prompt[0]
+            tokens[2 * i + 1, -1] = prompt[-1]
+            attention_mask[2 * i:2 * i + 2, max_len - len(prompt):] = 1
+        device = self.device
+        if bool(attention_mask.all()):
+            return tokens.to(device), None
+        return tokens.to(device), attention_mask.to(device)
+
+    def generate_image_tokens(self, prompts, cfg_weight, temperature, image_token_num_per_image=576, callback=None,
+                              top_k=None, top_p=None, generator=None, should_stop=None):
+        """ Image tokens of one image per prompt, generated in a single CFG batch.
+
+        Args:
+            prompts (List[List[int]]): Prompt token ids of each image, e.g. from image_prompt_ids.
+            cfg_weight (Union[float, CfgSchedule, Sequence]): Guidance weight or schedule, or one per prompt.
+            temperature (Union[float, Sequence[float]]): Sampling temperature, or one per prompt.
+            image_token_num_per_image (int): Tokens of the image grid.
+            callback (Callable, optional): Token callback of ImageTokenGenerator.generate, e.g. an ImagePreview.
+            top_k (int, optional): Sample among the top_k most likely image tokens.
+            top_p (float, optional): Sample within the top_p probability mass.
+            generator (Union[torch.Generator, List[torch.Generator]], optional): Random generator of the request, or
+                one per prompt.
+            should_stop (Callable[[], bool], optional): Checked after each token, the loop raises
+                ImageGenerationAborted once it returns True (e.g. the image is no longer needed).
+
+        Returns:
+            generated_tokens (torch.IntTensor): [len(prompts), image_token_num_per_image]
+        """
+        self.ensure_image_modules()
+        start = time.perf_counter()
+        tokens, attention_mask = self.cfg_batch(prompts)
         inputs_embeds = self.vl_gpt.language_model.get_input_embeddings()(tokens)
 
-        generated_tokens = torch.zeros((parallel_size, image_token_num_per_image), dtype=torch.int).cuda()
-
-        for i in range(image_token_num_per_image):
-            outputs = self.vl_gpt.language_model.model(inputs_embeds=inputs_embeds, use_cache=True,
-                                                       past_key_values=outputs.past_key_values if i != 0 else None)
-            hidden_states = outputs.last_hidden_state
-
-            logits = self.vl_gpt.gen_head(hidden_states[:, -1, :])
-            logit_cond = logits[0::2, :]
-            logit_uncond = logits[1::2, :]
-
-            logits = logit_uncond + cfg_weight * (logit_cond - logit_uncond)
-            probs = torch.softmax(logits / temperature, dim=-1)
-
-            next_token = torch.multinomial(probs, num_samples=1)
-            generated_tokens[:, i] = next_token.squeeze(dim=-1)
-
-            next_token = torch.cat([next_token.unsqueeze(dim=1), next_token.unsqueeze(dim=1)], dim=1).view(-1)
-            img_embeds = self.vl_gpt.prepare_gen_img_embeds(next_token)
-            inputs_embeds = img_embeds.unsqueeze(dim=1)
-
-        dec = self.vl_gpt.gen_vision_model.decode_code(generated_tokens.to(dtype=torch.int),
-                                                       shape=[parallel_size, 8, img_size // patch_size,
-                                                              img_size // patch_size])
+        # The VQ decoder is only needed after the token loop
+        self.residency.prefetch("gen_vision_model")
+        paused = 0.
+
+        def step_callback(image_tokens, num_tokens):
+            nonlocal paused
+            paused += self.wait_for_text()
+            if should_stop is not None and should_stop():
+                logger.debug("Image generation aborted after {} tokens".format(num_tokens))
+                raise ImageGenerationAborted()
+            if callback is not None:
+                callback(image_tokens, num_tokens)
+
+        with self.residency.use("gen_head", "gen_aligner", "gen_embed"):
+            token_generator = self.image_generator(len(prompts), tokens.shape[1] + image_token_num_per_image)
+            generated_tokens = token_generator.generate(inputs_embeds, image_token_num_per_image, cfg_weight,
+                                                        temperature, attention_mask=attention_mask,
+                                                        callback=step_callback, token_ids=tokens,
+                                                        prefix_cache=self.image_prefix_cache, top_k=top_k,
+                                                        top_p=top_p, generator=generator,
+                                                        prefix_min_reuse=IMG_PREFIX_MIN_REUSE)
+
+        elapsed = time.perf_counter() - start - paused
+        self.image_paused_seconds += paused
+        prefill = token_generator.last_prefill
+        if prefill["batched"]:
+            self.image_batched_prefill_rate = prefill["seconds"] / max(prefill["tokens"], 1)
+            logger.debug("Image prefill: {} prompt tokens in one batch, {:.3f}s".format(prefill["tokens"],
+                                                                                       prefill["seconds"]))
+        elif self.image_batched_prefill_rate is not None:
+            # Against the last batched prefill, measured on the same model
+            saved = self.image_batched_prefill_rate * prefill["tokens"] - prefill["seconds"]
+            self.image_prefill_saved_seconds += saved
+            logger.debug("Image prefill: {}/{} prompt tokens reused, {:.3f}s, {:.3f}s saved against the batched "
+                         "prefill".format(prefill["reused"], prefill["tokens"], prefill["seconds"], saved))
+        else:
+            logger.debug("Image prefill: {}/{} prompt tokens reused, {:.3f}s".format(
+                prefill["reused"], prefill["tokens"], prefill["seconds"]))
+        logger.debug("Generated {} image tokens x {} in {:.2f}s ({:.1f} images/min, compiled={}), guidance on {} "
+                     "tokens, {:.2f}s paused for text calls".format(image_token_num_per_image, len(prompts), elapsed,
+                                                                   len(prompts) * 60 / max(elapsed, 1e-9),
+                                                                   token_generator.compiled,
+                                                                   token_generator.last_guided_steps, paused))
+        return generated_tokens
+
+    def image_preview(self, callback, img_size=384, patch_size=16):
+        """ Token callback decoding progressive previews for callback(images, num_rows), None without callback. """
+        if callback is None:
+            return None
+        return ImagePreview(lambda tokens: self.decode_images(tokens, img_size, patch_size), callback,
+                            img_size // patch_size)
+
+    def decode_images(self, generated_tokens, img_size=384, patch_size=16):
+        """ Decodes image tokens with the VQ model.
+
+        Returns:
+            visual_img (np.ndarray): [num_images, img_size, img_size, 3] uint8 RGB images.
+        """
+        num_images = generated_tokens.shape[0]
+        with self.residency.use("gen_vision_model"):
+            dec = self.vl_gpt.gen_vision_model.decode_code(generated_tokens.to(self.residency.fast_device, torch.int),
+                                                           shape=[num_images, 8, img_size // patch_size,
+                                                                  img_size // patch_size])
         dec = dec.to(torch.float32).cpu().numpy().transpose(0, 2, 3, 1)
 
         dec = np.clip((dec + 1) / 2 * 255, 0, 255)
 
-        visual_img = np.zeros((parallel_size, img_size, img_size, 3), dtype=np.uint8)
+        visual_img = np.zeros((num_images, img_size, img_size, 3), dtype=np.uint8)
         visual_img[:, :, :] = dec
+        return visual_img
+
+    @torch.inference_mode()
+    def generate_image(self,
+                       description: str,
+                       profile="default",
+                       temperature: float = None,
+                       parallel_size: int = None,
+                       cfg_weight: float = None,
+                       image_token_num_per_image: int = 576,
+                       img_size: int = 384,
+                       patch_size: int = 16,
+                       file_path: Path = BASE_DIR / 'images' / 'img.jpg',
+                       preview=None,
+                       seed: int = None):
+        """ Generates an image of the description and saves the first sample to file_path.
+        temperature, parallel_size and cfg_weight default to the values of the generation profile.
+        preview (Callable[[np.ndarray, int], None], optional) receives progressive previews of the samples
+        ([parallel_size, img_size, img_size, 3] uint8) and the number of generated rows, see ImagePreview.
+        seed (int, optional) seeds the sampling of the first sample, the next ones use seed + 1, seed + 2...
+        """
+        profile = get_image_profile(profile)
+        parallel_size = profile.parallel_size if parallel_size is None else parallel_size
+        profile = replace(profile, temperature=profile.temperature if temperature is None else temperature,
+                          cfg_weight=profile.cfg_weight if cfg_weight is None else cfg_weight)
+        seeds = [seed + i for i in range(parallel_size)] if seed is not None else None
+        visual_img = self.generate_images([description] * parallel_size, None, profile, image_token_num_per_image,
+                                          img_size, patch_size, preview, seeds)
 
         os.makedirs(file_path.parent, exist_ok=True)
         Image.fromarray(visual_img[0]).save(file_path)
 
+    def _image_key(self, description, profile, image_token_num_per_image, img_size, patch_size):
+        """ Asset key of the image tokens of description: the prompt and everything the tokens depend on. """
+        return ImageAssetStore.make_key(self.model_id, str(self.vl_gpt.dtype), self.quantization, description,
+                                        repr(profile.guidance()), profile.temperature, profile.top_k, profile.top_p,
+                                        image_token_num_per_image, img_size, patch_size)
+
+    @torch.inference_mode()
+    def generate_images(self,
+                        descriptions,
+                        file_paths=None,
+                        profiles="default",
+                        image_token_num_per_image: int = 576,
+                        img_size: int = 384,
+                        patch_size: int = 16,
+                        preview=None,
+                        seeds=None,
+                        should_stop=None):
+        """ Generates one image per description in a single batch: the prompts, of different lengths, share the
+        decode steps of the image token loop, which raises the images per minute over one generate_image call each.
+
+        Every image is stored in the asset store as its token grid, prompt and seed. Images already in the store
+        (same prompt, parameters and seed, or any seed for greedy profiles) are only decoded again.
+
+        Args:
+            descriptions (List[str]): The image descriptions.
+            file_paths (List[Path], optional): Where to save each image. Not saved if None.
+            profiles (Union[str, ImageGenProfile, List]): Generation profile, or one per description. Their
+                temperature and guidance apply per image, parallel_size is ignored.
+            preview (Callable[[np.ndarray, int], None], optional): Receives progressive previews of the images and
+                the number of generated rows, see ImagePreview.
+            seeds (List[int], optional): Seed of the sampling of each image, independent of the batch it runs in.
+                Drawn at random when None, and stored with the image so that it can be reproduced.
+            should_stop (Callable[[], bool], optional): Aborts the image token loop with ImageGenerationAborted once
+                it returns True. Nothing is stored nor saved then.
+
+        Returns:
+            visual_img (np.ndarray): [len(descriptions), img_size, img_size, 3] uint8 RGB images.
+        """
+        if not isinstance(profiles, (list, tuple)):
+            profiles = [profiles] * len(descriptions)
+        profiles = [get_image_profile(profile) for profile in profiles]
+        if len({(profile.top_k, profile.top_p) for profile in profiles}) > 1:
+            raise ValueError("Images generated in one batch must share top_k and top_p")
+        seeds = [seed if seed is not None else random.randrange(2 ** 31) for seed in (seeds or [None] * len(profiles))]
+        labels = ["greedy" if profile.temperature <= GREEDY_TEMPERATURE else seed
+                  for profile, seed in zip(profiles, seeds)]
+        keys = [self._image_key(description, profile, image_token_num_per_image, img_size, patch_size)
+                for description, profile in zip(descriptions, profiles)]
+        asset_ids = [self.image_assets.find(key, label) if self.image_assets is not None else None
+                     for key, label in zip(keys, labels)]
+        missing = [i for i, asset_id in enumerate(asset_ids) if asset_id is None]
+        # Requests of the same image (e.g. the greedy samples of one description) are generated and stored once
+        rows, batch = {}, []  # (key, label) -> row of the batch, request of each row
+        for i in missing:
+            if (keys[i], labels[i]) not in rows:
+                rows[(keys[i], labels[i])] = len(batch)
+                batch.append(i)
+        row_of = [rows[(keys[i], labels[i])] for i in missing]
+        logger.debug("[{}] Generating {} images in one batch for {} requests, {} from the asset store".format(
+            ",".join(profile.name for profile in profiles), len(batch), len(missing), len(descriptions) - len(missing)))
+
+        visual_img = np.zeros((len(descriptions), img_size, img_size, 3), dtype=np.uint8)
+        for i, asset_id in enumerate(asset_ids):
+            if asset_id is not None:
+                visual_img[i] = self.image_assets.image(
+                    asset_id, lambda tokens: self.decode_images(torch.from_numpy(tokens), img_size, patch_size))
+
+        if batch:
+            prompts = [self.image_prompt_ids(descriptions[i]) for i in batch]
+            generators = [torch.Generator(self.device).manual_seed(seeds[i]) for i in batch]
+            image_preview = None
+            if preview is not None:
+                def merged_preview(images, num_rows):
+                    frames = visual_img.copy()
+                    frames[missing] = images[row_of]
+                    preview(frames, num_rows)
+                image_preview = self.image_preview(merged_preview, img_size, patch_size)
+            generated_tokens = self.generate_image_tokens(prompts, [profiles[i].guidance() for i in batch],
+                                                          [profiles[i].temperature for i in batch],
+                                                          image_token_num_per_image, image_preview,
+                                                          profiles[0].top_k, profiles[0].top_p, generators,
+                                                          should_stop)
+            if image_preview is not None:
+                image_preview.log_stats()
+            decoded = self.decode_images(generated_tokens, img_size, patch_size)
+            visual_img[missing] = decoded[row_of]
+            if self.image_assets is not None:
+                batch_ids = [self.image_assets.put(keys[i], labels[i], generated_tokens[j], descriptions[i],
+                                                   decoded[j], profile=profiles[i].name, img_size=img_size,
+                                                   patch_size=patch_size) for j, i in enumerate(batch)]
+                for i, row in zip(missing, row_of):
+                    asset_ids[i] = batch_ids[row]
+        self.last_asset_ids = asset_ids
+
+        for img, file_path in zip(visual_img, file_paths or ()):
+            os.makedirs(file_path.parent, exist_ok=True)
+            Image.fromarray(img).save(file_path)
+        return visual_img
+
+    def export_image(self, asset_id, file_path, size=None):
+        """ Decodes a stored image asset again and saves it to file_path, in the format of its extension. """
+        record = self.image_assets.load(asset_id)
+        img_size, patch_size = record.get("img_size", 384), record.get("patch_size", 16)
+        self.image_assets.export(asset_id, file_path, lambda tokens: self.decode_images(
+            torch.from_numpy(tokens), img_size, patch_size), size)
+
@@ -0,0 +1,193 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import itertools
+import torch
+from transformers import DynamicCache
+from configs.config import PREFIX_CACHE_MAX_BYTES
+from src.log import logger
+
+
+def _common_length(a, b):
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def _kv_bytes(kv):
+    return sum(k.numel() * k.element_size() + v.numel() * v.element_size() for k, v in kv)
+
+
+class _RadixNode:
+    __slots__ = ("tokens", "kv", "children", "parent", "last_access")
+
+    def __init__(self, tokens=(), kv=(), parent=None, last_access=0):
+        self.tokens = tuple(tokens)  # Token ids on the edge leading to this node
+        self.kv = kv  # Per layer (key, value) of self.tokens only, each [1, heads, len(tokens), head_dim]
+        self.children = {}  # First token id of the child edge -> child node
+        self.parent = parent
+        self.last_access = last_access
+
+    @property
+    def nbytes(self):
+        return _kv_bytes(self.kv)
+
+
+class RadixPrefixCache:
+    """ KV cache of previously prefilled prompts, shared across generate calls. Prompts are stored in a radix tree
+    keyed by token ids, so the game prompts that all start with init_conv + env_pr + env_desc only prefill their
+    new suffix. Leaves are evicted in LRU order when the stored KV exceeds max_bytes.
+
+    Single sequence (batch size 1) caches only.
+    """
+
+    def __init__(self, max_bytes=PREFIX_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.root = _RadixNode()
+        self.total_bytes = 0
+        self._clock = itertools.count(1)
+
+        self.lookups = 0
+        self.hits = 0
+        self.lookup_tokens = 0
+        self.matched_tokens = 0
+        self.bytes_saved = 0
+        self.evictions = 0
+
+    def lookup(self, token_ids):
+        """ Finds the longest cached prefix of token_ids. The last token is never matched, since it has to be fed to
+        the model to get the next token logits.
+
+        Args:
+            token_ids (List[int]): The full prompt.
+
+        Returns:
+            matched (int): Number of leading tokens covered by the returned cache.
+            past_key_values (Optional[DynamicCache]): KV cache of token_ids[:matched], None if nothing matched.
+        """
+        token_ids = list(token_ids)
+        query = token_ids[:-1]
+        node, matched, segments = self.root, 0, []
+        while matched < len(query):
+            child = node.children.get(query[matched])
+            if child is None:
+                break
+            common = _common_length(child.tokens, query[matched:])
+            child.last_access = next(self._clock)
+            segments.append([(k[:, :, :common], v[:, :, :common]) for k, v in child.kv])
+            matched += common
+            if common < len(child.tokens):
+                break
+            node = child
+
+        self.lookups += 1
+        self.lookup_tokens += len(token_ids)
+        if not segments:
+            logger.debug("Prefix cache miss ({} tokens)".format(len(token_ids)))
+            return 0, None
+
+        legacy = tuple((torch.cat([segment[layer][0] for segment in segments], dim=-2),
+                        torch.cat([segment[layer][1] for segment in segments], dim=-2))
+                       for layer in range(len(segments[0])))
+        saved = _kv_bytes(legacy)
+        self.hits += 1
+        self.matched_tokens += matched
+        self.bytes_saved += saved
+        logger.debug("Prefix cache hit: {}/{} tokens reused ({:.1f} MB of KV not recomputed)".format(
+            matched, len(token_ids), saved / 2 ** 20))
+        return matched, DynamicCache.from_legacy_cache(legacy)
+
+    def match_length(self, token_ids):
+        """ Number of leading tokens lookup(token_ids) would match, without building their KV nor counting a lookup.
+        """
+        query = list(token_ids)[:-1]
+        node, matched = self.root, 0
+        while matched < len(query):
+            child = node.children.get(query[matched])
+            if child is None:
+                break
+            common = _common_length(child.tokens, query[matched:])
+            matched += common
+            if common < len(child.tokens):
+                break
+            node = child
+        return matched
+
+    def insert(self, token_ids, past_key_values):
+        """ Stores the KV of token_ids. Shared prefixes are stored once.
+
+        Args:
+            token_ids (List[int]): Tokens whose KV is held in past_key_values. Extra trailing tokens (e.g. a
+                generated token that was never fed to the model) are ignored, as is KV beyond token_ids.
+            past_key_values (Union[DynamicCache, tuple]): KV cache of token_ids, batch size 1.
+        """
+        legacy = past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") \
+            else past_key_values
+        if self.max_bytes <= 0 or not legacy:
+            return
+        token_ids = list(token_ids)[:legacy[0][0].shape[-2]]
+        node, pos = self.root, 0
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                end = len(token_ids)
+                child = _RadixNode(token_ids[pos:], [(k[:, :, pos:end].clone(), v[:, :, pos:end].clone())
+                                                     for k, v in legacy], node, next(self._clock))
+                node.children[token_ids[pos]] = child
+                self.total_bytes += child.nbytes
+                break
+            common = _common_length(child.tokens, token_ids[pos:])
+            if common < len(child.tokens):
+                child = self._split(child, common)
+            child.last_access = next(self._clock)
+            pos += common
+            node = child
+        self._evict()
+
+    def _split(self, node, at):
+        """ Splits the edge of node after `at` tokens and returns the new upper node. """
+        upper = _RadixNode(node.tokens[:at], [(k[:, :, :at].clone(), v[:, :, :at].clone()) for k, v in node.kv],
+                           node.parent, node.last_access)
+        self.total_bytes -= node.nbytes
+        node.parent.children[upper.tokens[0]] = upper
+        node.tokens = node.tokens[at:]
+        node.kv = [(k[:, :, at:].clone(), v[:, :, at:].clone()) for k, v in node.kv]
+        node.parent = upper
+        upper.children[node.tokens[0]] = node
+        self.total_bytes += upper.nbytes + node.nbytes
+        return upper
+
+    def _leaves(self):
+        stack = list(self.root.children.values())
+        while stack:
+            node = stack.pop()
+            if node.children:
+                stack.extend(node.children.values())
+            else:
+                yield node
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            leaf = min(self._leaves(), key=lambda n: n.last_access, default=None)
+            if leaf is None:
+                break
+            del leaf.parent.children[leaf.tokens[0]]
+            self.total_bytes -= leaf.nbytes
+            self.evictions += 1
+
+    def clear(self):
+        self.root = _RadixNode()
+        self.total_bytes = 0
+
+    def stats(self):
+        return {
+            "lookups": self.lookups,
+            "hit_rate": self.hits / max(self.lookups, 1),
+            "token_hit_rate": self.matched_tokens / max(self.lookup_tokens, 1),
+            "bytes_saved": self.bytes_saved,
+            "stored_bytes": self.total_bytes,
+            "evictions": self.evictions,
+        }
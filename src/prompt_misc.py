@@ -43,6 +43,7 @@ wanderer_input_decision_pr = ('{}. Analyze what the wanderer said and decide if
                               'reading, and other similar actions. '
                               'Is there any intention of moving?')
 
+wanderer_input_choice_pr = " Answer '2' if there is any intention of moving, else answer '1'."
 
 update_env_pr = ('According to the wanderer movement, create a new area different than the first one. \n '
                  + env_pr)
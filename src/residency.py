@@ -0,0 +1,177 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import itertools
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import torch
+from configs.config import RESIDENCY_MAX_BYTES, RESIDENCY_SLOW_DEVICE
+from models.janus.models.modeling_vlm import IMAGE_SUBMODULES
+from models.janus.utils.quantization import model_nbytes
+from src.log import logger
+
+
+class ResidencyManager:
+    """ Keeps the submodules of a MultiModalityCausalLM on the fast device (the accelerator) within max_bytes.
+
+    The language model, needed by every text and image call, always stays resident and counts towards the budget.
+    Callers declare the image submodules they are about to run with use(). Missing ones are moved to the fast device
+    and, if the budget is exceeded, the least recently used submodules that are not in use are moved to the slow
+    device (cpu). prefetch() starts such a move in the background, e.g. the image generation head while the
+    text of the new area is still being generated. Submodules that are None (text only models) are ignored.
+
+    With max_bytes None nothing is ever evicted and use() only records the hits.
+    """
+
+    def __init__(self, vl_gpt, max_bytes=RESIDENCY_MAX_BYTES, fast_device=None, slow_device=RESIDENCY_SLOW_DEVICE,
+                 names=IMAGE_SUBMODULES):
+        self.vl_gpt = vl_gpt
+        self.max_bytes = max_bytes
+        self.fast_device = torch.device(fast_device) if fast_device is not None else vl_gpt.language_model.device
+        if self.fast_device.type == "cuda" and self.fast_device.index is None:
+            self.fast_device = torch.device("cuda", torch.cuda.current_device())
+        self.slow_device = torch.device(slow_device)
+        self.names = names
+        self.last_use = {name: 0 for name in names}
+        self._clock = itertools.count(1)
+        self._lock = threading.RLock()
+        self._in_use = Counter()
+        self._pending = {}  # name -> Future of a running prefetch
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        self._stream = torch.cuda.Stream(self.fast_device) if self.fast_device.type == "cuda" else None
+        self._nbytes = {}  # name -> (id of the module, bytes)
+
+        self.hits = 0
+        self.misses = 0
+        self.prefetches = 0
+        self.evictions = 0
+        self.bytes_moved = 0
+        self.transfer_seconds = 0.  # Moves that blocked a caller
+        self.prefetch_seconds = 0.  # Moves done in the background
+        self.hit_bytes = 0
+
+        self.enforce_budget()
+
+    def _module(self, name):
+        return getattr(self.vl_gpt, name)
+
+    def nbytes(self, name):
+        module = self._module(name)
+        cached = self._nbytes.get(name)
+        if cached is None or cached[0] != id(module):
+            cached = self._nbytes[name] = (id(module), model_nbytes(module))
+        return cached[1]
+
+    def is_resident(self, name):
+        module = self._module(name)
+        tensor = next(itertools.chain(module.parameters(), module.buffers()), None)
+        return tensor is None or tensor.device == self.fast_device
+
+    def resident_bytes(self):
+        return self.nbytes("language_model") + sum(self.nbytes(name) for name in self.names
+                                                   if self._module(name) is not None and self.is_resident(name))
+
+    def _move(self, name, device):
+        """ Moves a submodule and returns the seconds it took. Modules offloaded to cpu are pinned, which speeds up
+        their way back to the accelerator. """
+        module = self._module(name)
+        start = time.perf_counter()
+        if self._stream is not None and device == self.fast_device:
+            with torch.cuda.stream(self._stream):
+                module.to(device, non_blocking=True)
+            self._stream.synchronize()
+        else:
+            module.to(device)
+            if device.type == "cpu" and self.fast_device.type == "cuda":
+                for param in module.parameters():
+                    param.data = param.data.pin_memory()
+        self.bytes_moved += self.nbytes(name)
+        return time.perf_counter() - start
+
+    def _make_room(self, needed, keep=()):
+        """ Evicts LRU submodules until needed more bytes fit in the budget. """
+        if self.max_bytes is None:
+            return
+        resident = self.resident_bytes()
+        while resident + needed > self.max_bytes:
+            candidates = [name for name in self.names if self._module(name) is not None and self.is_resident(name)
+                          and not self._in_use[name] and name not in keep]
+            if not candidates:
+                logger.warning("Residency budget exceeded: {:.2f} GB needed, {:.2f} GB allowed".format(
+                    (resident + needed) / 2 ** 30, self.max_bytes / 2 ** 30))
+                break
+            victim = min(candidates, key=lambda n: self.last_use[n])
+            self.transfer_seconds += self._move(victim, self.slow_device)
+            resident -= self.nbytes(victim)
+            self.evictions += 1
+            logger.debug("Offloaded {} to {}".format(victim, self.slow_device))
+
+    def enforce_budget(self):
+        """ Offloads LRU submodules until the resident ones fit in the budget, e.g. after loading new submodules. """
+        with self._lock:
+            self._make_room(0)
+
+    def _load(self, names, background=False):
+        with self._lock:
+            for name in names:
+                if self._module(name) is None or self.is_resident(name):
+                    continue
+                self._make_room(self.nbytes(name), keep=names)
+                elapsed = self._move(name, self.fast_device)
+                if background:
+                    self.prefetch_seconds += elapsed
+                    self.prefetches += 1
+                else:
+                    self.transfer_seconds += elapsed
+                    self.misses += 1
+                logger.debug("Loaded {} on {} in {:.2f}s{}".format(name, self.fast_device, elapsed,
+                                                                  " (prefetch)" if background else ""))
+
+    def prefetch(self, *names):
+        """ Hint that the submodules will be used soon: moves them to the fast device in the background. """
+        names = tuple(name for name in names if self._module(name) is not None)
+        if self.max_bytes is None or not names:
+            return
+        future = self._executor.submit(self._load, names, True)
+        for name in names:
+            self._pending[name] = future
+
+    @contextmanager
+    def use(self, *names):
+        """ Makes the submodules resident on the fast device for the duration of the block. """
+        for name in names:
+            future = self._pending.pop(name, None)
+            if future is not None:
+                future.result()
+        with self._lock:
+            for name in names:
+                self._in_use[name] += 1
+                self.last_use[name] = next(self._clock)
+                if self._module(name) is not None and self.is_resident(name):
+                    self.hits += 1
+                    self.hit_bytes += self.nbytes(name)
+            self._load(names)
+        try:
+            yield
+        finally:
+            with self._lock:
+                for name in names:
+                    self._in_use[name] -= 1
+
+    def stats(self):
+        """ Transfer time spent, and the time saved by the hits, estimated at the measured transfer bandwidth. """
+        moving_seconds = self.transfer_seconds + self.prefetch_seconds
+        bandwidth = self.bytes_moved / moving_seconds if moving_seconds > 0 else None
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetches": self.prefetches,
+            "evictions": self.evictions,
+            "resident_bytes": self.resident_bytes(),
+            "transfer_seconds": self.transfer_seconds,
+            "prefetch_seconds": self.prefetch_seconds,
+            "saved_seconds": self.hit_bytes / bandwidth if bandwidth else 0.,
+        }
@@ -0,0 +1,110 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from configs.config import RESPONSE_CACHE_DIR, RESPONSE_CACHE_MEMORY_ENTRIES, RESPONSE_CACHE_MAX_DISK_BYTES
+from src.log import logger
+
+
+class ResponseCache:
+    """ Content-addressed cache of generated replies. Text generation is greedy, so a reply only depends on the model,
+    its dtype, the sft prompt and the generation parameters, which together form the key.
+
+    Entries are kept in an in-memory LRU and persisted as one JSON file per key under cache_dir. The disk store is
+    capped to max_disk_bytes, the least recently used files (by mtime) being removed first.
+    """
+
+    def __init__(self, cache_dir=RESPONSE_CACHE_DIR, max_entries=RESPONSE_CACHE_MEMORY_ENTRIES,
+                 max_disk_bytes=RESPONSE_CACHE_MAX_DISK_BYTES):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.disk_bytes = 0
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self.disk_bytes = sum(path.stat().st_size for path in self.cache_dir.glob("*/*.json"))
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / (key + ".json")
+
+    def get(self, key):
+        """ Returns the cached reply of key, or None. """
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+
+            if self.cache_dir is not None:
+                path = self._path(key)
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        response = json.load(f)["response"]
+                    os.utime(path)  # Mark as recently used for the disk eviction
+                except (OSError, ValueError, KeyError):
+                    response = None
+                if response is not None:
+                    self._remember(key, response)
+                    self.hits += 1
+                    self.disk_hits += 1
+                    return response
+
+            self.misses += 1
+            return None
+
+    def put(self, key, response, prompt=""):
+        with self.lock:
+            self._remember(key, response)
+            if self.cache_dir is None:
+                return
+            path = self._path(key)
+            path.parent.mkdir(exist_ok=True)
+            old_size = path.stat().st_size if path.exists() else 0
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"prompt": prompt, "response": response}, f)
+            os.replace(tmp_path, path)
+            self.disk_bytes += path.stat().st_size - old_size
+            self._evict_disk()
+
+    def _remember(self, key, response):
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def _evict_disk(self):
+        if self.disk_bytes <= self.max_disk_bytes:
+            return
+        files = sorted(self.cache_dir.glob("*/*.json"), key=lambda p: p.stat().st_mtime)
+        for path in files:
+            if self.disk_bytes <= self.max_disk_bytes:
+                break
+            self.disk_bytes -= path.stat().st_size
+            path.unlink()
+            logger.debug("Response cache evicted " + path.name)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / max(lookups, 1),
+            "memory_entries": len(self.memory),
+            "disk_bytes": self.disk_bytes,
+        }
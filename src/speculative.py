@@ -0,0 +1,138 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+from transformers import DynamicCache
+
+
+class SpeculativeStats:
+    def __init__(self):
+        self.verify_steps = 0  # Forward passes of the target model after the prefill
+        self.proposed = 0
+        self.accepted = 0
+
+    def update(self, proposed, accepted):
+        self.verify_steps += 1
+        self.proposed += proposed
+        self.accepted += accepted
+
+    def add(self, other):
+        self.verify_steps += other.verify_steps
+        self.proposed += other.proposed
+        self.accepted += other.accepted
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / max(self.proposed, 1)
+
+    @property
+    def tokens_per_step(self):
+        """Tokens produced per target forward pass: the accepted proposals plus the token of the target itself."""
+        return (self.accepted + self.verify_steps) / max(self.verify_steps, 1)
+
+    def __str__(self):
+        return "acceptance {:.0%} ({}/{}), {:.2f} tokens per target step".format(
+            self.acceptance_rate, self.accepted, self.proposed, self.tokens_per_step)
+
+
+class DraftModelProposer:
+    """ Proposes the greedy continuation of a small draft model sharing the tokenizer of the target model
+    (e.g. Janus-Pro-1B for Janus-Pro-7B). The draft keeps its own KV cache, cropped to the accepted tokens. """
+
+    def __init__(self, draft_model, prompt_ids, num_draft_tokens):
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.past_key_values = DynamicCache()
+        self.pending = list(prompt_ids)  # Tokens of the sequence not fed to the draft model yet
+        self.proposal_start = 0
+
+    def propose(self, token_id):
+        self.pending.append(token_id)
+        step_ids = torch.LongTensor([self.pending]).to(self.draft_model.device)
+        self.pending = []
+        draft = []
+        for i in range(self.num_draft_tokens):
+            outputs = self.draft_model.model(input_ids=step_ids, past_key_values=self.past_key_values, use_cache=True)
+            if i == 0:
+                self.proposal_start = self.past_key_values.get_seq_length()
+            step_ids = torch.argmax(self.draft_model.lm_head(outputs.last_hidden_state[:, -1, :]), dim=-1,
+                                    keepdim=True)
+            draft.append(step_ids.item())
+        return draft
+
+    def accept(self, draft, accepted):
+        # The last proposal was never fed to the draft model
+        self.past_key_values.crop(self.proposal_start + min(accepted, len(draft) - 1))
+        if draft and accepted == len(draft):
+            self.pending.append(draft[-1])
+
+
+class PromptLookupProposer:
+    """ Proposes the tokens that followed the latest earlier occurrence of the last n-gram of the sequence (prompt
+    lookup decoding). Needs no draft model, and pays off when the reply copies spans of the prompt, as in rewrites
+    and summaries. The n-grams are indexed as the sequence grows, so a proposal costs O(max_ngram). """
+
+    def __init__(self, prompt_ids, num_draft_tokens, max_ngram=3, min_ngram=1):
+        self.num_draft_tokens = num_draft_tokens
+        self.ngram_sizes = range(max_ngram, min_ngram - 1, -1)
+        self.tokens = []
+        self.index = {n: {} for n in self.ngram_sizes}  # n -> n-gram -> position of the token that followed it
+        self._extend(prompt_ids)
+
+    def _extend(self, token_ids):
+        for token_id in token_ids:
+            end = len(self.tokens)
+            for n in self.ngram_sizes:
+                if end >= n:
+                    self.index[n][tuple(self.tokens[end - n:end])] = end
+            self.tokens.append(token_id)
+
+    def propose(self, token_id):
+        self._extend([token_id])
+        for n in self.ngram_sizes:
+            end = self.index[n].get(tuple(self.tokens[-n:]))
+            if end is not None:
+                return self.tokens[end:end + self.num_draft_tokens]
+        return []
+
+    def accept(self, draft, accepted):
+        self._extend(draft[:accepted])
+
+
+@torch.inference_mode()
+def speculative_greedy_steps(language_model, step_ids, past_key_values, proposer, stats):
+    """ Yields the greedy continuation of language_model, identical to one token per forward pass decoding.
+
+    After the prefill, each step feeds the last token and the proposals of proposer in a single forward pass. The
+    proposals are accepted as long as they match the greedy prediction of the target, which also gives the next token
+    for free. The KV cache is then cropped to the accepted tokens.
+
+    Args:
+        language_model (LlamaForCausalLM): The target model.
+        step_ids (torch.LongTensor): [1, seq_len] prompt ids that are not in past_key_values yet.
+        past_key_values (DynamicCache): Target KV cache, updated in place.
+        proposer (Union[DraftModelProposer, PromptLookupProposer]): Object with propose(token_id) -> List[int] and
+            accept(draft, accepted). An empty proposal falls back to a regular decoding step.
+        stats (SpeculativeStats): Updated after each verification step.
+
+    Yields:
+        token_id (int): The generated tokens, EOS included. The caller decides when to stop.
+    """
+    outputs = language_model.model(input_ids=step_ids, past_key_values=past_key_values, use_cache=True)
+    token_id = torch.argmax(language_model.lm_head(outputs.last_hidden_state[:, -1, :]), dim=-1).item()
+    yield token_id
+    while True:
+        draft = proposer.propose(token_id)
+        seen = past_key_values.get_seq_length()
+        verify_ids = torch.LongTensor([[token_id] + draft]).to(step_ids.device)
+        outputs = language_model.model(input_ids=verify_ids, past_key_values=past_key_values, use_cache=True)
+        predicted = torch.argmax(language_model.lm_head(outputs.last_hidden_state[0]), dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and predicted[accepted] == draft[accepted]:
+            accepted += 1
+        past_key_values.crop(seen + 1 + accepted)
+        proposer.accept(draft, accepted)
+        stats.update(len(draft), accepted)
+        yield from draft[:accepted]
+        token_id = predicted[accepted]
+        yield token_id
@@ -0,0 +1,95 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import dataclasses
+from typing import Any, Dict, List
+from models.janus.utils.conversation import Conversation, SeparatorStyle, get_conv_template
+
+SEGMENT_CACHE_MAX_ENTRIES = 4096
+
+
+@dataclasses.dataclass
+class TokenizedConversation(Conversation):
+    """ A DeepSeek style Conversation that keeps the token ids of every message, so that appending a message only
+    tokenizes that message.
+
+    With the DeepSeek separator style every message starts with its role tag ('<|User|>', '<|Assistant|>'). When the
+    role tags are added tokens of the tokenizer, the text is split at them before tokenization, so each message is
+    tokenized independently of its neighbours and the concatenation of the per message ids equals the encoding of
+    the whole prompt. Otherwise get_prompt_ids falls back to encoding the whole prompt.
+
+    Message encodings are memoized in segment_cache, which can be shared between conversations to avoid
+    re-tokenizing the long prompts that every call of the game repeats.
+    """
+
+    tokenizer: Any = None
+    segment_cache: Dict[str, List[int]] = None
+
+    def __post_init__(self):
+        if self.sep_style != SeparatorStyle.DeepSeek:
+            raise ValueError(f"Unsupported sep_style: {self.sep_style}")
+        if self.segment_cache is None:
+            self.segment_cache = {}
+        # Added tokens that strip the surrounding whitespace would merge with the previous message
+        added_tokens = {token.content: token for token in self.tokenizer.added_tokens_decoder.values()}
+        self.incremental = all(role in added_tokens and not added_tokens[role].lstrip and not added_tokens[role].rstrip
+                               for role in self.roles)
+        self.segments = []  # Prompt text of each message, separator included
+        self.message_ids = []  # Token ids of each segment
+
+    @classmethod
+    def from_template(cls, tokenizer, name="deepseek", segment_cache=None):
+        template = get_conv_template(name)
+        fields = {field.name: getattr(template, field.name) for field in dataclasses.fields(Conversation)}
+        return cls(**fields, tokenizer=tokenizer, segment_cache=segment_cache)
+
+    @classmethod
+    def from_messages(cls, tokenizer, messages, name="deepseek", system_prompt="", segment_cache=None):
+        """ Same prompt as VLChatProcessor.apply_sft_template_for_multi_turn_prompts. """
+        conv = cls.from_template(tokenizer, name, segment_cache)
+        conv.set_system_message(system_prompt)
+        for message in messages:
+            conv.append_message(message["role"], message["content"].strip())
+        return conv
+
+    def _encode(self, text):
+        ids = self.segment_cache.get(text)
+        if ids is None:
+            if len(self.segment_cache) >= SEGMENT_CACHE_MAX_ENTRIES:
+                self.segment_cache.clear()
+            ids = self.tokenizer.encode(text, add_special_tokens=False)
+            self.segment_cache[text] = ids
+        return ids
+
+    def _segment(self, i, role, message):
+        if message:
+            return role + ": " + message + [self.sep, self.sep2][i % 2]
+        return role + ":"
+
+    def append_message(self, role: str, message: str):
+        super().append_message(role, message)
+        self.segments.append(self._segment(len(self.messages) - 1, role, message))
+        self.message_ids.append(self._encode(self.segments[-1]) if self.incremental else [])
+
+    def update_last_message(self, message: str):
+        super().update_last_message(message)
+        role = self.messages[-1][0]
+        self.segments[-1] = self._segment(len(self.messages) - 1, role, message)
+        self.message_ids[-1] = self._encode(self.segments[-1]) if self.incremental else []
+
+    def reset_message(self):
+        super().reset_message()
+        self.segments = []
+        self.message_ids = []
+
+    def get_prompt_ids(self) -> List[int]:
+        """ Token ids of get_prompt().strip(), special tokens (BOS) included. """
+        if not self.incremental or not self.messages:
+            return self.tokenizer.encode(self.get_prompt().strip())
+        system_prompt = self.system_template.format(system_message=self.system_message)
+        ids = list(self._encode(system_prompt + self.sep)) if system_prompt else []
+        for segment_ids in self.message_ids[:-1]:
+            ids.extend(segment_ids)
+        # The whole prompt is stripped, which only affects the separator of the last message
+        ids.extend(self._encode(self.segments[-1].rstrip()))
+        return self.tokenizer.build_inputs_with_special_tokens(ids)
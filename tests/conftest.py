@@ -0,0 +1,20 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import pytest
+import torch
+from src.benchmark import build_tiny_llm
+
+
+@pytest.fixture(autouse=True)
+def no_grad():
+    with torch.inference_mode():
+        yield
+
+
+@pytest.fixture
+def tiny_llm():
+    """ Tiny random-weight Janus model on cpu, without the prefix cache so that every call runs the full model. """
+    llm = build_tiny_llm()
+    llm.prefix_cache = None
+    return llm
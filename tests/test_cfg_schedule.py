@@ -0,0 +1,34 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import pytest
+from models.janus.utils.cfg_schedule import CfgSchedule
+
+
+def test_constant_weight_over_all_steps():
+    schedule = CfgSchedule.of(5)
+    assert schedule.guided_steps(576) == 576
+    assert [schedule.weight(step, 4) for step in range(4)] == [5.0] * 4
+    assert CfgSchedule.of(schedule) is schedule
+
+
+def test_interval_limits_the_guided_steps():
+    schedule = CfgSchedule(5.0, interval=(0.25, 0.5))
+    assert schedule.guided_steps(10) == 5
+    assert [schedule.weight(step, 10) for step in range(10)] == [1.0] * 3 + [5.0] * 2 + [1.0] * 5
+    assert CfgSchedule(5.0, interval=(0.0, 0.0)).guided_steps(10) == 0
+
+
+@pytest.mark.parametrize("schedule", ["linear", "cosine"])
+def test_decaying_schedules(schedule):
+    weights = [CfgSchedule(5.0, schedule).weight(step, 4) for step in range(4)]
+    assert weights[0] == 5.0
+    assert all(a > b > 1.0 for a, b in zip(weights, weights[1:]))
+    assert CfgSchedule(5.0, "linear").weight(2, 4) == 3.0
+
+
+def test_invalid_schedules():
+    with pytest.raises(ValueError):
+        CfgSchedule(5.0, "exponential")
+    with pytest.raises(ValueError):
+        CfgSchedule(5.0, interval=(0.5, 0.25))
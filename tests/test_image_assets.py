@@ -0,0 +1,48 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import numpy as np
+from src.image_assets import ImageAssetStore
+
+
+def fake_decode(calls):
+    """ Decoder of [n, tokens] ids to [n, 2, 2, 3] images, counting its calls. """
+    def decode(tokens):
+        calls.append(tokens.shape)
+        return np.broadcast_to((tokens[:, :1] % 256).astype(np.uint8)[:, :, None, None], (len(tokens), 2, 2, 3))
+    return decode
+
+
+def test_put_find_reload(tmp_path):
+    store = ImageAssetStore(tmp_path, max_decoded=1)
+    tokens = np.arange(576) * 28 % 16384
+    key = ImageAssetStore.make_key("prompt", 5.0)
+    assert key == ImageAssetStore.make_key("prompt", 5.0) != ImageAssetStore.make_key("prompt", 4.0)
+    assert store.find(key, 7) is None
+
+    asset_id = store.put(key, 7, tokens, "prompt", profile="area")
+    greedy_id = store.put(key, "greedy", tokens[::-1].copy(), "prompt")
+    assert store.find(key, 7) == asset_id and store.find(key, "greedy") == greedy_id
+
+    reloaded = ImageAssetStore(tmp_path)
+    assert reloaded.find(key, 7) == asset_id
+    record = reloaded.load(asset_id)
+    assert np.array_equal(record["tokens"], tokens)
+    assert (record["prompt"], record["seed"], record["profile"]) == ("prompt", 7, "area")
+    assert reloaded.stats()["assets"] == 2
+
+
+def test_decoded_images_are_kept_in_an_lru(tmp_path):
+    store = ImageAssetStore(tmp_path, max_decoded=1)
+    first = store.put("key", 0, np.full(576, 3), "a")
+    second = store.put("key", 1, np.full(576, 4), "b")
+    calls = []
+    decode = fake_decode(calls)
+
+    assert store.image(first, decode)[0, 0, 0] == 3
+    assert store.image(first, decode)[0, 0, 0] == 3
+    assert len(calls) == 1 and calls[0] == (1, 576)
+    store.image(second, decode)  # Evicts first
+    store.image(first, decode)
+    assert len(calls) == 3
+    assert store.stats()["decoded_hits"] == 1
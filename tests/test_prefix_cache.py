@@ -0,0 +1,60 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+from src.prefix_cache import RadixPrefixCache
+
+NUM_LAYERS = 2
+TOKEN_BYTES = NUM_LAYERS * 2 * 4 * 4  # (key, value) x head_dim 4 x float32, one head
+
+
+def kv_of(token_ids):
+    """ Legacy KV cache whose entries encode the token ids, so that cached slices can be checked. """
+    values = torch.tensor(token_ids, dtype=torch.float32).reshape(1, 1, -1, 1).expand(1, 1, -1, 4)
+    return tuple((values + layer, -values - layer) for layer in range(NUM_LAYERS))
+
+
+def assert_kv_of(past_key_values, token_ids):
+    for (key, value), (expected_key, expected_value) in zip(past_key_values.to_legacy_cache(), kv_of(token_ids)):
+        assert torch.equal(key, expected_key) and torch.equal(value, expected_value)
+
+
+def test_lookup_returns_the_longest_cached_prefix():
+    cache = RadixPrefixCache(max_bytes=2 ** 20)
+    assert cache.lookup([1, 2, 3]) == (0, None)
+    cache.insert([1, 2, 3, 4], kv_of([1, 2, 3, 4]))
+
+    matched, past_key_values = cache.lookup([1, 2, 3, 4, 5])
+    assert matched == 4
+    assert_kv_of(past_key_values, [1, 2, 3, 4])
+    # The last token is left to the model
+    assert cache.lookup([1, 2, 3, 4])[0] == 3
+    matched, past_key_values = cache.lookup([1, 2, 9, 9])
+    assert matched == 2
+    assert_kv_of(past_key_values, [1, 2])
+
+
+def test_insert_splits_shared_prefixes():
+    cache = RadixPrefixCache(max_bytes=2 ** 20)
+    cache.insert([1, 2, 3, 4], kv_of([1, 2, 3, 4]))
+    cache.insert([1, 2, 7, 8], kv_of([1, 2, 7, 8]))
+    assert cache.total_bytes == 6 * TOKEN_BYTES  # [1, 2] is stored once
+
+    for token_ids in ([1, 2, 3, 4], [1, 2, 7, 8]):
+        matched, past_key_values = cache.lookup(token_ids + [0])
+        assert matched == 4
+        assert_kv_of(past_key_values, token_ids)
+
+
+def test_evicts_least_recently_used_leaves():
+    cache = RadixPrefixCache(max_bytes=5 * TOKEN_BYTES)
+    cache.insert([1, 2, 3], kv_of([1, 2, 3]))
+    cache.insert([4, 5], kv_of([4, 5]))
+    cache.lookup([1, 2, 3, 0])  # [4, 5] becomes the least recently used
+    cache.insert([6, 7], kv_of([6, 7]))
+
+    assert cache.evictions == 1
+    assert cache.total_bytes <= cache.max_bytes
+    assert cache.lookup([4, 5, 0]) == (0, None)
+    assert cache.lookup([1, 2, 3, 0])[0] == 3
+    assert cache.lookup([6, 7, 0])[0] == 2
@@ -0,0 +1,24 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import pytest
+import torch
+from torch import nn
+from models.janus.utils.quantization import Int8WeightOnlyLinear
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+def test_int8_weight_only_linear_matches_its_dequantized_weights(dtype):
+    torch.manual_seed(0)
+    linear = nn.Linear(64, 32).to(dtype)
+    quantized = Int8WeightOnlyLinear.from_float(linear)
+    x = torch.randn(2, 3, 64, dtype=dtype)
+
+    dequantized = quantized.weight.float() * quantized.scale.float()[:, None]
+    expected = nn.functional.linear(x.float(), dequantized, linear.bias.float())
+    out = quantized(x)
+    assert out.shape == (2, 3, 32) and out.dtype == dtype
+    tolerance = 1e-4 if dtype == torch.float32 else 5e-2
+    torch.testing.assert_close(out.float(), expected, atol=tolerance, rtol=tolerance)
+    # Quantization error of the weights only
+    torch.testing.assert_close(out.float(), linear(x).float(), atol=5e-2, rtol=5e-2)
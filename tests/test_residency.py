@@ -0,0 +1,26 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+from src.benchmark import random_prompt
+from src.residency import ResidencyManager
+
+GEN_MODULES = ("gen_head", "gen_aligner", "gen_embed")
+
+
+def test_text_calls_stay_on_the_language_model_device(tiny_llm):
+    # The meta device as the slow tier splits the model across devices like a cuda budget does, on any machine
+    full = ResidencyManager(tiny_llm.vl_gpt, max_bytes=None)
+    budget = full.nbytes("language_model") + sum(full.nbytes(name) for name in GEN_MODULES)
+    tiny_llm.residency = ResidencyManager(tiny_llm.vl_gpt, max_bytes=budget, slow_device="meta")
+
+    assert tiny_llm.residency.evictions > 0
+    assert not tiny_llm.residency.is_resident("vision_model")  # The first parameters of vl_gpt
+    assert tiny_llm.vl_gpt.device == torch.device("meta")
+    assert tiny_llm.device == torch.device("cpu")
+
+    input_ids = random_prompt(tiny_llm, 16)
+    assert input_ids.device == tiny_llm.device
+    assert len(tiny_llm.generate_ids(input_ids, max_new_tokens=4, ignore_eos=True)) == 4
+    assert [len(ids) for ids in tiny_llm.generate_ids_batch([[3, 4, 5, 6], [7, 8]], max_new_tokens=4,
+                                                            ignore_eos=True)] == [4, 4]
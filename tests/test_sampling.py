@@ -0,0 +1,37 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import torch
+from models.janus.utils.sampling import sample_tokens
+
+
+def random_logits(rows=4, vocab_size=64, seed=0):
+    return torch.randn((rows, vocab_size), generator=torch.Generator().manual_seed(seed))
+
+
+def test_greedy_temperatures_take_the_argmax():
+    logits = random_logits()
+    for temperature in (0.0, None, 1e-5):
+        assert torch.equal(sample_tokens(logits, temperature), logits.argmax(dim=-1))
+    # Truncation to the most likely token is greedy at any temperature
+    assert torch.equal(sample_tokens(logits, 1.0, top_k=1), logits.argmax(dim=-1))
+    assert torch.equal(sample_tokens(logits, 1.0, top_p=1e-6), logits.argmax(dim=-1))
+
+
+def test_per_row_temperature():
+    logits = random_logits(vocab_size=4096)
+    temperature = torch.tensor([[0.0], [100.0], [1e-5], [100.0]])
+    tokens = sample_tokens(logits, temperature, generator=torch.Generator().manual_seed(0))
+    greedy = logits.argmax(dim=-1)
+    assert tokens[0] == greedy[0] and tokens[2] == greedy[2]
+    # Near uniform sampling over 4096 tokens: both sampled rows hitting the argmax is unlikely
+    assert not (tokens[1] == greedy[1] and tokens[3] == greedy[3])
+
+
+def test_per_row_generators_do_not_depend_on_the_batch():
+    logits = random_logits()
+    generators = lambda: [torch.Generator().manual_seed(seed) for seed in range(len(logits))]
+    batch = sample_tokens(logits, 1.0, top_k=16, generator=generators())
+    alone = [sample_tokens(logits[i:i + 1], 1.0, top_k=16, generator=[generator])
+             for i, generator in enumerate(generators())]
+    assert torch.equal(batch, torch.cat(alone))
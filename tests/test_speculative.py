@@ -0,0 +1,57 @@
+#  Copyright (c) 2025. Salim Janji. All rights reserved.
+#  Unauthorized copying, distribution, or modification of this file is strictly prohibited.
+
+import copy
+import itertools
+from transformers import DynamicCache, LlamaForCausalLM
+from src.benchmark import random_prompt
+from src.generation_profiles import TextGenProfile
+from src.speculative import DraftModelProposer, PromptLookupProposer, SpeculativeStats, speculative_greedy_steps
+
+NEW_TOKENS = 32
+
+
+def shallow_draft(target):
+    """ First layer of the target model, which agrees with it on part of the tokens only. """
+    config = copy.deepcopy(target.config)
+    config.num_hidden_layers = 1
+    draft = LlamaForCausalLM(config).to(target.dtype)
+    draft.load_state_dict(target.state_dict(), strict=False)
+    return draft.eval()
+
+
+def speculative_ids(llm, input_ids, proposer):
+    steps = speculative_greedy_steps(llm.vl_gpt.language_model, input_ids, DynamicCache(), proposer,
+                                     SpeculativeStats())
+    return list(itertools.islice(steps, NEW_TOKENS))
+
+
+def test_draft_model_matches_greedy(tiny_llm):
+    input_ids = random_prompt(tiny_llm, 48)
+    expected = tiny_llm.generate_ids(input_ids, max_new_tokens=NEW_TOKENS, ignore_eos=True)
+    target = tiny_llm.vl_gpt.language_model
+    for draft in (shallow_draft(target), LlamaForCausalLM(target.config).eval()):
+        proposer = DraftModelProposer(draft, input_ids[0].tolist(), num_draft_tokens=4)
+        assert speculative_ids(tiny_llm, input_ids, proposer) == expected
+
+        tiny_llm.set_draft_model(draft, 4)
+        assert tiny_llm.generate_ids(input_ids, max_new_tokens=NEW_TOKENS, ignore_eos=True) == expected
+        tiny_llm.draft_model = None
+
+
+def test_prompt_lookup_matches_greedy(tiny_llm):
+    # A repeated span gives the n-gram lookup something to propose
+    input_ids = random_prompt(tiny_llm, 32).repeat(1, 3)
+    expected = tiny_llm.generate_ids(input_ids, max_new_tokens=NEW_TOKENS, ignore_eos=True)
+    proposer = PromptLookupProposer(input_ids[0].tolist(), num_draft_tokens=4)
+    assert speculative_ids(tiny_llm, input_ids, proposer) == expected
+
+    profile = TextGenProfile("prompt_lookup", NEW_TOKENS, prompt_lookup=True)
+    assert tiny_llm.generate_ids(input_ids, ignore_eos=True, profile=profile) == expected
+    assert tiny_llm.speculative_stats.proposed > 0
+
+
+def test_prompt_lookup_proposes_the_continuation():
+    proposer = PromptLookupProposer([5, 6, 7, 8, 9, 5, 6], num_draft_tokens=2)
+    assert proposer.propose(7) == [8, 9]
+    assert proposer.propose(1) == []